@@ -1,44 +1,197 @@
-from flask import Flask, request, jsonify, send_file, send_from_directory
+import time
+# Время импорта сервиса (до первого ответа /health) — в /metrics как startup_import_ms
+_import_started = time.perf_counter()
+
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory, stream_with_context
 from flask_cors import CORS
 import os
-import io
+import hashlib
 import mimetypes
-import random
+import multiprocessing
 import cv2
 import numpy as np
 from datetime import datetime
+from itertools import islice
 
 try:
     # При запуске как пакет: gunicorn back.app:app
-    from .detector import DocumentDetector
-    from .llm import summarize_with_perplexity
+    from .background import encode_png, iter_zip, remove_background_batch
+    from .crop_index import CropIndex, crop_hash
+    from .metrics import metrics
+    from .model_loader import ModelLoader, ModelNotReady
+    from .model_registry import ModelRegistry, UnknownModel
+    from .orientation import PageOrienter
+    from .page_cache import PageCache
+    from .previews import PreviewCache, PreviewRenderer
+    from .responses import StreamingJSONProvider, compress_response
+    from .result_store import ResultStore
+    from .uploads import UploadTooLarge
+    from .llm import SummaryClient
+    from .pipeline import OUTPUTS, DecodeError, DetectionPipeline
     from .utils import *  # noqa: F401,F403
     from .config import Config
-    from . import download_model  # noqa: F401
+    from .cpu import configure_process, configure_torch, settings as cpu_settings
+    from . import download_model
 except ImportError:
     # При прямом запуске файла: python back/app.py
-    from detector import DocumentDetector
-    from llm import summarize_with_perplexity
+    from background import encode_png, iter_zip, remove_background_batch
+    from crop_index import CropIndex, crop_hash
+    from metrics import metrics
+    from model_loader import ModelLoader, ModelNotReady
+    from model_registry import ModelRegistry, UnknownModel
+    from orientation import PageOrienter
+    from page_cache import PageCache
+    from previews import PreviewCache, PreviewRenderer
+    from responses import StreamingJSONProvider, compress_response
+    from result_store import ResultStore
+    from uploads import UploadTooLarge
+    from llm import SummaryClient
+    from pipeline import OUTPUTS, DecodeError, DetectionPipeline
     from utils import *  # noqa: F401,F403
     from config import Config
-    import download_model  # noqa: F401
+    from cpu import configure_process, configure_torch, settings as cpu_settings
+    import download_model
 from dotenv import load_dotenv
 
 app = Flask(__name__, static_folder='../frontend', static_url_path='')
+# Запросы больше лимита обрываются Werkzeug ещё до разбора multipart (413)
+app.config['MAX_CONTENT_LENGTH'] = Config.MAX_REQUEST_SIZE
+# orjson (если установлен) и потоковое тело для больших JSON-ответов
+app.json = StreamingJSONProvider(app)
 CORS(app)
 
 load_dotenv()
 Config.init_app()
 
-# Загрузка модели (single-model режим)
-detector = DocumentDetector(
-    model_path=str(Config.MODEL_PATH),
-    conf_threshold=Config.CONFIDENCE_THRESHOLD
+# Кэш повторяющихся страниц (общий для всех запросов)
+page_cache = PageCache(
+    max_entries=Config.PAGE_CACHE_SIZE,
+    similarity=Config.PAGE_CACHE_SIMILARITY
+) if Config.PAGE_CACHE_SIZE > 0 else None
+
+# Поворот и выравнивание страниц (кэш по хэшу страницы, общий для всех версий модели)
+orienter = PageOrienter(
+    max_skew=Config.ORIENTATION_MAX_SKEW,
+    cache_size=Config.ORIENTATION_CACHE_SIZE
+) if Config.ORIENTATION else None
+
+# Недавние результаты для ленивых кропов (/crops/<result_id>)
+result_store = ResultStore(max_bytes=Config.RESULT_STORE_MB * 1024 * 1024)
+
+# Индекс кропов подписей/печатей: повторно использованные в разных документах (на диске, переживает рестарт)
+crop_index = CropIndex(
+    Config.CROP_INDEX_PATH,
+    max_distance=Config.CROP_MATCH_DISTANCE,
+    max_crops=Config.CROP_INDEX_MAX_CROPS
+) if Config.CROP_INDEX else None
+
+# Превью страниц: уменьшенные WebP/JPEG, закодированные — в кэше
+preview_renderer = PreviewRenderer(
+    max_dim=Config.PREVIEW_MAX_DIM,
+    quality=Config.PREVIEW_QUALITY,
+    fmt=Config.PREVIEW_FORMAT,
+    cache=PreviewCache(max_bytes=Config.PREVIEW_CACHE_MB * 1024 * 1024)
+)
+
+# LLM-саммари (режим 'llm'): общий пул соединений, кэш ответов, хеджирование провайдеров
+summary_client = SummaryClient(
+    perplexity_key=Config.PERPLEXITY_API_KEY,
+    perplexity_model=Config.PERPLEXITY_MODEL,
+    perplexity_url=Config.PERPLEXITY_URL,
+    gemini_key=Config.GEMINI_API_KEY,
+    gemini_model=Config.GEMINI_MODEL,
+    timeout=Config.LLM_TIMEOUT,
+    hedge_delay=Config.LLM_HEDGE_DELAY,
+    cache_size=Config.LLM_CACHE_SIZE,
+    chunk_chars=Config.LLM_CHUNK_CHARS
 )
 
+
+def _load_pipeline() -> DetectionPipeline:
+    """Скачивание весов, импорт torch/ultralytics, загрузка и прогрев YOLO (в фоновом потоке)."""
+    started = time.perf_counter()
+    download_model.ensure_model()
+    metrics.set('model_download_ms', round((time.perf_counter() - started) * 1000, 1))
+
+    configure_torch()
+    started = time.perf_counter()
+    try:
+        from .detector import DocumentDetector
+    except ImportError:
+        from detector import DocumentDetector
+    metrics.set('model_import_ms', round((time.perf_counter() - started) * 1000, 1))
+
+    # Реестр версий: стартовая — MODEL_PATH, новые грузятся через /models/load без рестарта.
+    # Кэш страниц общий, версия входит в его ключ.
+    registry = ModelRegistry(lambda version, path: DocumentDetector(
+        model_path=path,
+        conf_threshold=Config.CONFIDENCE_THRESHOLD,
+        page_cache=page_cache,
+        orienter=orienter,
+        blank_threshold=Config.BLANK_PAGE_THRESHOLD,
+        qr_decode=Config.QR_DECODE,
+        version=version,
+        raw_floor=Config.RAW_CONF_FLOOR
+    ))
+    registry.load(Config.MODEL_VERSION, Config.MODEL_PATH, activate=True)
+    # Общий конвейер: один проход детекции -> любые представления (outputs=...)
+    return DetectionPipeline(registry=registry, result_store=result_store, summary_client=summary_client,
+                             previews=preview_renderer, crop_index=crop_index)
+
+
+model_loader = ModelLoader(_load_pipeline, name='model')
+
+# Spawn-воркеры растеризации PDF импортируют этот файл заново как __mp_main__
+# (при запуске python back/app.py) — модель и affinity им не нужны
+if multiprocessing.parent_process() is None:
+    # Потоки OpenCV/OpenMP и привязка к ядрам — до загрузки модели
+    configure_process()
+    model_loader.start()
+
+
+def get_pipeline() -> DetectionPipeline:
+    """Конвейер с загруженной моделью; ждёт до MODEL_WAIT_TIMEOUT секунд, иначе ModelNotReady (503)."""
+    return model_loader.get(timeout=Config.MODEL_WAIT_TIMEOUT)
+
+
+metrics.set('startup_import_ms', round((time.perf_counter() - _import_started) * 1000, 1))
 print("Flask server started")
 
 
+@app.after_request
+def compress(response):
+    """gzip/brotli для JSON и текста по Accept-Encoding (потоком, без сборки тела в памяти)."""
+    if not Config.COMPRESS_RESPONSES:
+        return response
+    return compress_response(
+        response,
+        request.headers.get('Accept-Encoding'),
+        min_size=Config.COMPRESS_MIN_BYTES,
+        gzip_level=Config.GZIP_LEVEL,
+        brotli_quality=Config.BROTLI_QUALITY
+    )
+
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return create_response(
+        success=False,
+        error=f'Request is too large. Maximum size: {Config.MAX_REQUEST_SIZE // (1024 * 1024)} MB',
+        status_code=413
+    )
+
+
+@app.errorhandler(ModelNotReady)
+def model_not_ready(error):
+    body, status = create_response(success=False, error=str(error), status_code=503)
+    return body, status, {'Retry-After': str(Config.MODEL_RETRY_AFTER)}
+
+
+@app.errorhandler(UnknownModel)
+def unknown_model(error):
+    return create_response(success=False, error=str(error), status_code=404)
+
+
 @app.route('/')
 def index():
     """Главная страница"""
@@ -53,14 +206,27 @@ def task_page():
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Проверка работоспособности сервера"""
+    """Liveness: процесс жив и отвечает (модель может ещё загружаться)."""
     return jsonify({
         'status': 'ok',
         'model': 'YOLOv8m',
+        'ready': model_loader.ready,
         'timestamp': datetime.now().isoformat()
     })
 
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness: 200, когда модель загружена; 503, пока грузится или если загрузка упала."""
+    status = model_loader.status()
+    payload = {
+        'status': 'ready' if model_loader.ready else status['state'],
+        'model': status,
+        'timestamp': datetime.now().isoformat()
+    }
+    return jsonify(payload), 200 if model_loader.ready else 503
+
+
 @app.route('/summarize', methods=['POST'])
 def summarize():
     """Демо-саммари по простому правилу: по количеству детекций или случайный ответ.
@@ -69,111 +235,14 @@ def summarize():
     - 'counts'  — формируем текст на основе количества подписей/печатей/QR
     - 'random'  — возвращаем одну из заранее заготовленных фраз (для демонстрации)
     - 'llm'     — старый режим с OCR/LLM (не рекомендуется для демо)
+
+    Опция `outputs=summary,annotations,...` — дополнительные представления из того же прохода.
     """
     if 'document' not in request.files and 'image' not in request.files:
         return create_response(False, error='No document file provided (use form field "document")', status_code=400)
 
     file = request.files.get('document') or request.files.get('image')
-    filename = file.filename or ''
-    raw_bytes = file.read()
-    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-
-    # Подготовим изображения для детекции (без OCR и без LLM по умолчанию)
-    page_count = 1
-    try:
-        if ext == 'pdf':
-            images_for_detect = _decode_pdf(raw_bytes)
-            page_count = len(images_for_detect)
-        else:
-            img = load_image_from_upload(io.BytesIO(raw_bytes), filename)
-            images_for_detect = img if isinstance(img, list) else [img]
-            page_count = len(images_for_detect)
-    except Exception:
-        # Фолбэк для демо: если не удалось декодировать файл, не падаем — формируем ответ без детекций
-        images_for_detect = []
-        page_count = 1
-
-    # Считаем детекции
-    counts = {'signature': 0, 'stamp': 0, 'qr_code': 0}
-    confidences = []
-    for page_img in images_for_detect:
-        try:
-            res = detector.detect(page_img)
-            counts['signature'] += res['count_by_class']['signature']
-            counts['stamp'] += res['count_by_class']['stamp']
-            counts['qr_code'] += res['count_by_class']['qr_code']
-            if res['detections']:
-                confidences.extend([d['confidence'] for d in res['detections']])
-        except Exception:
-            # Если детектор упал на странице, продолжаем (демо-устойчивость)
-            pass
-    avg_conf = round(sum(confidences)/len(confidences)*100, 1) if confidences else 0
-
-    mode = (Config.SUMMARIZE_MODE or 'counts').lower()
-    summary = ''
-    note = ''
-
-    if mode == 'random':
-        options = [
-            "Система работает: всё выглядит корректно.",
-            "Авто-обзор выполнен. Признаков проблем не обнаружено.",
-            "Демо-режим: анализ завершён успешно.",
-            "Обработка завершена. Никаких критичных замечаний."
-        ]
-        summary = random.choice(options)
-    elif mode == 'llm':
-        # Сохранён старый путь как резервный — но лучше использовать 'counts' для демо
-        full_text = ''
-        if ext == 'pdf':
-            full_text = extract_text_from_pdf_bytes(raw_bytes)
-        else:
-            try:
-                full_text = ocr_text_from_images(images_for_detect, enhance=True)
-            except Exception:
-                full_text = ''
-        if not summary and Config.PERPLEXITY_API_KEY:
-            try:
-                summary = summarize_with_perplexity(
-                    api_key=Config.PERPLEXITY_API_KEY,
-                    text=full_text or '',
-                    model=Config.PERPLEXITY_MODEL,
-                    counts=counts,
-                    language='ru'
-                ) or ''
-            except Exception:
-                summary = ''
-        if not summary:
-            summary = simple_summarize(full_text or '') or ''
-        if not summary:
-            doc_type, reason = guess_document_type(full_text or '')
-            summary = build_fallback_summary(counts, doc_type, reason)
-    else:
-        # counts-режим: простая логика на основе количества детекций
-        sig = counts['signature']
-        stp = counts['stamp']
-        qr = counts['qr_code']
-        if sig > 0 and stp > 0:
-            summary = f"Найдено подписей: {sig} и печатей: {stp}. Документ, вероятно, подписан и заверен. QR: {qr}."
-        elif sig > 0:
-            summary = f"Обнаружено подписей: {sig}. Документ, вероятно, подписан. QR: {qr}."
-        elif stp > 0:
-            summary = f"Обнаружено печатей/штампов: {stp}. Документ, вероятно, заверен. QR: {qr}."
-        elif qr > 0:
-            summary = f"Найдено QR-кодов: {qr}. Подписей и печатей не обнаружено."
-        else:
-            summary = "Подписей, печатей и QR-кодов не обнаружено."
-
-    data = {
-        'summary': summary,
-        'text_preview': '',
-        'word_count': 0,
-        'page_count': page_count,
-        'count_by_class': counts,
-        'avg_confidence': avg_conf,
-        'note': note
-    }
-
-    return create_response(True, data=data)
+    return _run_pipeline(file, file.filename or '', default_outputs=('summary',))
 
 
 @app.route('/detect', methods=['POST'])
@@ -183,6 +252,11 @@ def detect():
     
     Ожидает:
         - Файл изображения в FormData с ключом 'image'
+        - Опционально `classes` (например `qr_code` или `signature,stamp`),
+          `pages` (например `1-3,-1`) и `roi` (`x1,y1,x2,y2` в долях страницы)
+        - Опционально `crops=1` — кропы сразу в ответе (по умолчанию — лениво: GET /crops/<result_id>)
+        - Опционально `outputs` — что вывести из одного прохода
+          (annotations, summary, pdf, crops, dataset; по умолчанию annotations,pdf,crops)
     
     Возвращает:
         JSON с результатами детекции
@@ -214,120 +288,274 @@ def detect():
             status_code=400
         )
     
+    return _run_pipeline(file, file.filename, default_outputs=('annotations', 'pdf', 'crops'))
+
+
+def _run_pipeline(file, filename, default_outputs):
+    """Один проход детекции по загрузке и запрошенные представления результата.
+
+    Общая обработка ошибок: 400 — опции/декодирование, 413 — размер, 500 — остальное.
+    """
     try:
-        # Загрузка изображения/документа
-        image = load_image_from_upload(file, file.filename)
-        
-        # Проверяем, является ли это PDF (список страниц) или одно изображение
-        is_pdf = isinstance(image, list)
-        
-        if is_pdf:
-            # Multi-page PDF processing
-            all_detections = []
-            all_pages_annotated = []
-            total_stats = {'signature': 0, 'stamp': 0, 'qr_code': 0}
-            total_time = 0
-            confidences = []
-            
-            for page_num, page_image in enumerate(image, start=1):
-                # Детекция на каждой странице
-                page_results = detector.detect(page_image)
-                
-                # Рисование результатов
-                page_annotated = detector.draw_detections(page_image, page_results['detections'])
-                all_pages_annotated.append(page_annotated)
-                
-                # Добавляем номер страницы к каждой детекции
-                for det in page_results['detections']:
-                    det['page'] = page_num
-                
-                all_detections.extend(page_results['detections'])
-                
-                # Суммируем статистику
-                total_stats['signature'] += page_results['count_by_class']['signature']
-                total_stats['stamp'] += page_results['count_by_class']['stamp']
-                total_stats['qr_code'] += page_results['count_by_class']['qr_code']
-                total_time += page_results['processing_time_ms']
-                
-                if page_results['detections']:
-                    confidences.extend([d['confidence'] for d in page_results['detections']])
-            
-            # Объединяем все страницы вертикально только для предпросмотра во фронте
-            combined_image = np.vstack(all_pages_annotated)
-            combined_original = np.vstack(image)
-            
-            # Извлекаем crops из оригинального изображения
-            crops = extract_detection_crops(combined_original, all_detections, padding=10)
-            
-            # Сохранение результатов в PDF (по страницам)
-            filename = f"result_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-            img_path, json_path = save_detection_result_pdf(
-                all_pages_annotated,
-                {
-                    'detections': all_detections,
-                    'crops': crops,
-                    'count': len(all_detections),
-                    'count_by_class': total_stats,
-                    'page_count': len(image),
-                    'processing_time_ms': round(total_time, 2)
-                },
-                Config.OUTPUT_DIR,
-                filename
-            )
-            
-            # Формируем ответ
-            results = {
-                'success': True,
-                'detections': all_detections,
-                'crops': crops,
-                'count': len(all_detections),
-                'count_by_class': total_stats,
-                'page_count': len(image),
-                'processing_time_ms': round(total_time, 2),
-                'avg_confidence': round(sum(confidences) / len(confidences) * 100, 1) if confidences else 0,
-                'image_with_boxes': image_to_base64(combined_image),
-                'original_image': image_to_base64(combined_original),
-                'filename': filename
-            }
-        else:
-            # Single image processing
-            results = detector.detect(image)
-            
-            # Рисование результатов
-            image_with_boxes = detector.draw_detections(image, results['detections'])
-            
-            # Извлекаем crops из оригинального изображения
-            crops = extract_detection_crops(image, results['detections'], padding=10)
-            
-            # Сохранение результатов в PDF (1 страница)
-            filename = f"result_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-            img_path, json_path = save_detection_result_pdf(
-                [image_with_boxes],
-                {**results, 'crops': crops},
-                Config.OUTPUT_DIR,
-                filename
-            )
-            
-            # Конвертация изображения в base64 для отправки на фронт
-            results['image_with_boxes'] = image_to_base64(image_with_boxes)
-            results['original_image'] = image_to_base64(image)
-            results['crops'] = crops
-            results['filename'] = filename
-
-        # Полные URL для скачивания (работает даже если фронт открыт как file://)
-        origin = request.host_url.rstrip('/')
-        results['download_url'] = f"{origin}/download/{filename}"
-        json_filename = os.path.splitext(filename)[0] + '.json'
-        results['json_url'] = f"{origin}/download_json/{json_filename}"
-        
-        return create_response(success=True, data=results)
-        
+        options = _parse_detect_options(default_outputs)
+    except ValueError as e:
+        return create_response(success=False, error=str(e), status_code=400)
+    
+    pipeline = get_pipeline()
+    try:
+        with pipeline.run(file, filename, options['classes'], options['page_ranges'], options['roi'],
+                          model=options['model'], conf=options['conf'], iou=options['iou']) as doc:
+            if not doc.pages:
+                return _no_pages_response()
+            data = pipeline.derive(doc, options['outputs'], inline_crops=options['inline_crops'],
+                                   index_crops=options['index_crops'])
+    except UnknownModel as e:
+        return create_response(success=False, error=str(e), status_code=404)
+    except UploadTooLarge as e:
+        return create_response(success=False, error=str(e), status_code=413)
+    except DecodeError as e:
+        return create_response(success=False, error=str(e), status_code=400)
     except Exception as e:
-        return create_response(
-            success=False,
-            error=str(e),
-            status_code=500
+        return create_response(success=False, error=str(e), status_code=500)
+    
+    return create_response(success=True, data=_with_download_urls(data))
+
+
+def _with_download_urls(data):
+    """Полные URL для скачивания (работает даже если фронт открыт как file://)."""
+    origin = request.host_url.rstrip('/')
+    if 'filename' in data:
+        data['download_url'] = f"{origin}/download/{data['filename']}"
+        json_filename = os.path.splitext(data['filename'])[0] + '.json'
+        data['json_url'] = f"{origin}/download_json/{json_filename}"
+    if 'result_id' in data:
+        data['crops_url'] = f"{origin}/crops/{data['result_id']}"
+        data['rethreshold_url'] = f"{origin}/rethreshold/{data['result_id']}"
+    for preview in data.get('previews', []):
+        preview['url'] = origin + preview['url']
+        preview['annotated_url'] = origin + preview['annotated_url']
+    return data
+
+
+@app.route('/rethreshold/<result_id>', methods=['GET', 'POST'])
+def rethreshold(result_id):
+    """Аннотации недавнего результата с другими `conf`, `iou`, `classes` — без растеризации и инференса.
+
+    Сырые предсказания страниц хранятся вместе с результатом, поэтому ответ
+    занимает миллисекунды (ползунок порога на фронте).
+    """
+    entry = result_store.get(result_id)
+    if entry is None or entry.get('raw') is None:
+        return create_response(success=False, error='Result not found or expired', status_code=404)
+    try:
+        data = get_pipeline().rethreshold(
+            entry,
+            conf=parse_threshold(request.values.get('conf'), 'conf'),
+            iou=parse_threshold(request.values.get('iou'), 'iou'),
+            classes=parse_classes(request.values.get('classes'), Config.CLASS_NAMES)
         )
+    except ValueError as e:
+        return create_response(success=False, error=str(e), status_code=400)
+    data['result_id'] = result_id
+    return create_response(success=True, data=data)
+
+
+@app.route('/previews/<result_id>/<int:page>', methods=['GET'])
+def get_preview(result_id, page):
+    """Превью страницы недавнего результата (`annotated=1` — с разметкой, `max_dim=` — другой размер).
+
+    Кодируется при первом запросе и берётся из кэша дальше; WebP — если браузер его принимает.
+    """
+    entry = result_store.get(result_id)
+    if entry is None:
+        return create_response(success=False, error='Result not found or expired', status_code=404)
+    index = entry['pages'].find(page)
+    if index is None:
+        return create_response(success=False, error=f'Page {page} not found in result', status_code=404)
+    try:
+        max_dim = int(request.args.get('max_dim') or Config.PREVIEW_MAX_DIM)
+    except ValueError:
+        return create_response(success=False, error='Invalid max_dim', status_code=400)
+    max_dim = min(max(64, max_dim), 4096)
+
+    fmt = preview_renderer.fmt
+    if fmt == 'webp' and 'image/webp' not in request.headers.get('Accept', 'image/webp'):
+        fmt = 'jpeg'
+    detections, drawer = None, None
+    if parse_flag(request.args.get('annotated'), default=False):
+        detections = entry['detections'][index]
+        drawer = get_pipeline().registry.get(entry.get('model_version')).draw_detections
+    preview = preview_renderer.render(result_id, page, lambda: entry['pages'].image(page), detections, drawer,
+                                      max_dim=max_dim, fmt=fmt)
+    response = Response(preview['data'], mimetype=preview['mime'])
+    # result_id уникален, содержимое превью для него не меняется
+    response.headers['Cache-Control'] = 'private, max-age=3600, immutable'
+    response.headers['Vary'] = 'Accept'
+    return response
+
+
+@app.route('/crops/<result_id>', methods=['GET'])
+def get_crops(result_id):
+    """Ленивые кропы для недавнего результата /detect (опционально `classes=...`)."""
+    entry = result_store.get(result_id)
+    if entry is None:
+        return create_response(False, error='Result not found or expired', status_code=404)
+    try:
+        classes = parse_classes(request.args.get('classes'), Config.CLASS_NAMES)
+    except ValueError as e:
+        return create_response(False, error=str(e), status_code=400)
+
+    pdf_source = PdfSource(entry['pdf_bytes']) if entry['pdf_bytes'] else None
+    try:
+        crops = extract_page_crops(entry['pages'].images(), entry['detections'], pdf_source, classes=classes)
+    finally:
+        if pdf_source is not None:
+            pdf_source.close()
+    return create_response(True, data={'result_id': result_id, 'crops': crops, 'count': len(crops)})
+
+
+@app.route('/crops/<result_id>/nobg.zip', methods=['GET'])
+def download_crops_no_bg(result_id):
+    """ZIP с кропами без фона (прозрачные PNG), опционально `classes=stamp`.
+
+    Архив отдаётся потоком: записи уходят клиенту по мере готовности.
+    """
+    entry = result_store.get(result_id)
+    if entry is None:
+        return create_response(False, error='Result not found or expired', status_code=404)
+    try:
+        classes = parse_classes(request.args.get('classes'), Config.CLASS_NAMES)
+    except ValueError as e:
+        return create_response(False, error=str(e), status_code=400)
+
+    suffix = '_'.join(classes) if classes else 'all'
+    return Response(
+        stream_with_context(_iter_no_bg_zip(entry, classes)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{result_id}_{suffix}_no_bg.zip"'}
+    )
+
+
+def _similar_params():
+    """(limit, max_distance) из запроса; ValueError — неверные значения."""
+    try:
+        limit = int(request.values.get('limit') or 5)
+        max_distance = request.values.get('max_distance')
+        max_distance = int(max_distance) if max_distance else None
+    except ValueError:
+        raise ValueError('Invalid limit or max_distance')
+    return min(max(1, limit), 100), max_distance
+
+
+@app.route('/crops/similar', methods=['POST'])
+def similar_crops():
+    """Ранее виденные подписи/печати, похожие на загруженный кроп (`image`, опционально `class`, `limit`, `max_distance`)."""
+    if crop_index is None:
+        return create_response(False, error='Crop index is disabled (CROP_INDEX=0)', status_code=404)
+    if 'image' not in request.files:
+        return create_response(False, error='No image file provided', status_code=400)
+    class_name = request.values.get('class') or None
+    if class_name is not None and class_name not in Config.CLASS_NAMES:
+        return create_response(False, error=f'Unknown class: {class_name}', status_code=400)
+    try:
+        limit, max_distance = _similar_params()
+        image = load_image_from_upload(request.files['image'], request.files['image'].filename,
+                                       max_bytes=Config.MAX_FILE_SIZE)
+    except UploadTooLarge as e:
+        return create_response(False, error=str(e), status_code=413)
+    except ValueError as e:
+        return create_response(False, error=str(e), status_code=400)
+    if isinstance(image, list):
+        image = image[0] if image else None
+    if image is None:
+        return create_response(False, error='Failed to decode image', status_code=400)
+
+    digest, aspect = crop_hash(image)
+    matches = crop_index.query(digest, aspect, class_name, limit=limit, max_distance=max_distance)
+    return create_response(True, data={'matches': matches, 'count': len(matches)})
+
+
+@app.route('/crops/<result_id>/similar', methods=['GET'])
+def similar_crops_for_result(result_id):
+    """Для каждой подписи/печати недавнего результата — похожие кропы из других документов."""
+    if crop_index is None:
+        return create_response(False, error='Crop index is disabled (CROP_INDEX=0)', status_code=404)
+    entry = result_store.get(result_id)
+    if entry is None:
+        return create_response(False, error='Result not found or expired', status_code=404)
+    try:
+        limit, max_distance = _similar_params()
+    except ValueError as e:
+        return create_response(False, error=str(e), status_code=400)
+
+    # Кропы со страниц того же содержимого (повторные загрузки этого файла) — не совпадения
+    contents = {page.digest.hex() for page in entry['pages']}
+    crops = []
+    for crop_data, crop_image in iter_page_crops(entry['pages'].images(), entry['detections'], padding=0,
+                                                 classes=['signature', 'stamp']):
+        digest, aspect = crop_hash(crop_image)
+        crops.append({
+            'id': crop_data['id'],
+            'page': crop_data.get('page'),
+            'class': crop_data['class'],
+            'bbox': crop_data['bbox'],
+            'matches': crop_index.query(digest, aspect, crop_data['class'], limit=limit,
+                                        max_distance=max_distance, exclude_result=result_id,
+                                        exclude_contents=contents),
+        })
+    return create_response(True, data={'result_id': result_id, 'crops': crops})
+
+
+def _iter_no_bg_zip(entry, classes, batch_size=32):
+    """Кропы -> удаление фона пачками -> PNG в пуле потоков -> потоковый ZIP.
+
+    Кропы вырезаются (и перерисовываются из PDF) пачками по batch_size: следующая пачка
+    готовится только после того, как предыдущая ушла в архив.
+    """
+    pdf_source = PdfSource(entry['pdf_bytes']) if entry['pdf_bytes'] else None
+    try:
+        crops = iter_page_crops(entry['pages'].images(), entry['detections'], pdf_source, classes=classes)
+
+        def entries():
+            counters = {}
+            while True:
+                batch = list(islice(crops, batch_size))
+                if not batch:
+                    break
+                transparent = remove_background_batch([crop_img for _, crop_img in batch])
+                pngs = get_encode_pool().map(encode_png, transparent)
+                for (crop_data, _), png in zip(batch, pngs):
+                    class_name = crop_data['class']
+                    counters[class_name] = counters.get(class_name, 0) + 1
+                    yield f"{class_name}_{counters[class_name]:02d}.png", png
+
+        yield from iter_zip(entries())
+    finally:
+        if pdf_source is not None:
+            pdf_source.close()
+
+
+def _no_pages_response():
+    return create_response(
+        success=False,
+        error='No pages match the requested page range',
+        status_code=400
+    )
+
+
+def _parse_detect_options(default_outputs=('annotations',)):
+    """Опции запроса: classes, pages, roi, outputs, crops, index, model, conf, iou (ValueError — некорректное значение)."""
+    return {
+        'model': (request.values.get('model') or '').strip() or None,
+        'conf': parse_threshold(request.values.get('conf'), 'conf'),
+        'iou': parse_threshold(request.values.get('iou'), 'iou'),
+        'classes': parse_classes(request.values.get('classes'), Config.CLASS_NAMES),
+        'page_ranges': parse_page_ranges(request.values.get('pages')),
+        'roi': parse_roi(request.values.get('roi')),
+        'outputs': parse_outputs(request.values.get('outputs'), OUTPUTS, default_outputs),
+        'inline_crops': parse_flag(request.values.get('crops'), default=Config.INLINE_CROPS),
+        'index_crops': parse_flag(request.values.get('index'), default=True)
+    }
 
 
 @app.route('/detect_batch', methods=['POST'])
@@ -345,14 +573,23 @@ def detect_batch():
     
     files = request.files.getlist('images')
     
+    try:
+        options = _parse_detect_options(default_outputs=('annotations',))
+    except ValueError as e:
+        return create_response(success=False, error=str(e), status_code=400)
+    
+    pipeline = get_pipeline()
+    pipeline.registry.get(options['model'])  # неизвестная версия — 404 до обработки файлов
     results_list = []
     
     for file in files:
         try:
-            image = load_image_from_upload(file)
-            results = detector.detect(image)
+            with pipeline.run(file, file.filename, options['classes'], options['page_ranges'], options['roi'],
+                              model=options['model'], conf=options['conf'], iou=options['iou']) as doc:
+                results = pipeline.derive(doc, options['outputs'], inline_crops=options['inline_crops'],
+                                          index_crops=options['index_crops'])
             results['filename'] = file.filename
-            results_list.append(results)
+            results_list.append(_with_download_urls(results))
         except Exception as e:
             results_list.append({
                 'filename': file.filename,
@@ -380,7 +617,7 @@ def download_result(filename):
         )
     
     mime = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
-    return send_file(file_path, mimetype=mime, as_attachment=True)
+    return _send_result_file(file_path, mime)
 
 
 @app.route('/download_json/<filename>', methods=['GET'])
@@ -393,7 +630,20 @@ def download_json(filename):
             error='File not found',
             status_code=404
         )
-    return send_file(file_path, mimetype='application/json', as_attachment=True)
+    return _send_result_file(file_path, 'application/json')
+
+
+def _send_result_file(file_path: str, mimetype: str):
+    """Файл результата с ETag/Last-Modified: повторный запрос с If-None-Match получает 304 без тела.
+
+    Имена результатов уникальны и файлы не переписываются, поэтому браузеру
+    разрешено кэшировать их DOWNLOAD_MAX_AGE секунд (private — результаты пользователя).
+    """
+    response = send_file(file_path, mimetype=mimetype, as_attachment=True,
+                         conditional=True, etag=True, max_age=Config.DOWNLOAD_MAX_AGE)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
 
 
 @app.route('/stats', methods=['GET'])
@@ -411,6 +661,113 @@ def get_stats():
     return create_response(success=True, data=stats)
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Счётчики процесса: кэш страниц, время импорта и загрузки модели и т.п."""
+    data = {
+        'counters': metrics.snapshot(),
+        'model': model_loader.status(),
+        'page_cache': page_cache.stats() if page_cache is not None else None,
+        'crop_index': crop_index.stats() if crop_index is not None else None,
+        'cpu': cpu_settings()
+    }
+    return create_response(success=True, data=data)
+
+
+def _require_model_admin():
+    """Управление моделями — только с MODEL_ADMIN_TOKEN (веса грузятся через pickle)."""
+    if not Config.MODEL_ADMIN_TOKEN:
+        return create_response(success=False, error='Model admin API is disabled (set MODEL_ADMIN_TOKEN)',
+                               status_code=403)
+    if request.headers.get('X-Admin-Token') != Config.MODEL_ADMIN_TOKEN:
+        return create_response(success=False, error='Invalid admin token', status_code=403)
+    return None
+
+
+@app.route('/models', methods=['GET'])
+def list_models():
+    """Загруженные версии модели, активная и теневая (со статистикой расхождений)."""
+    return create_response(success=True, data=get_pipeline().registry.status())
+
+
+@app.route('/models/load', methods=['POST'])
+def load_model():
+    """Загрузка версии в фоне: version + path (внутри models/) или url [+ sha256]; activate=1 — переключить.
+
+    Ответ 202 сразу; готовность — в GET /models.
+    """
+    denied = _require_model_admin()
+    if denied:
+        return denied
+    version = (request.values.get('version') or '').strip()
+    path = (request.values.get('path') or '').strip()
+    url = (request.values.get('url') or '').strip()
+    sha256 = (request.values.get('sha256') or '').strip() or None
+    if not version or bool(path) == bool(url):
+        return create_response(success=False, error='Provide "version" and exactly one of "path" or "url"',
+                               status_code=400)
+
+    models_dir = (Config.BASE_DIR / 'models').resolve()
+    if path:
+        model_path = (models_dir / path).resolve()
+        if models_dir not in model_path.parents or not model_path.is_file():
+            return create_response(success=False, error=f'Model file not found in models/: {path}', status_code=400)
+        resolve = None
+    else:
+        # Без sha256 файл привязан к url: та же версия с другими весами не возьмёт старый файл
+        name = version if sha256 else f"{version}-{hashlib.sha256(url.encode('utf-8')).hexdigest()[:12]}"
+        model_path = Config.MODEL_VERSIONS_DIR / f'{name}.pt'
+        resolve = lambda: download_model.download_model(url, model_path, sha256=sha256)  # noqa: E731
+
+    registry = get_pipeline().registry
+    try:
+        registry.load_async(version, str(model_path), resolve=resolve,
+                            activate=parse_flag(request.values.get('activate'), default=False))
+    except ValueError as e:
+        return create_response(success=False, error=str(e), status_code=409)
+    body, _ = create_response(success=True, data={'version': version, 'state': 'loading'})
+    return body, 202
+
+
+@app.route('/models/activate', methods=['POST'])
+def activate_model():
+    """Атомарное переключение активной версии (запросы в полёте дорабатывают на старой)."""
+    denied = _require_model_admin()
+    if denied:
+        return denied
+    registry = get_pipeline().registry
+    registry.activate((request.values.get('version') or '').strip())
+    return create_response(success=True, data=registry.status())
+
+
+@app.route('/models/shadow', methods=['POST'])
+def shadow_model():
+    """Теневой режим: version + rate (доля запросов 0..1); без version — выключить."""
+    denied = _require_model_admin()
+    if denied:
+        return denied
+    registry = get_pipeline().registry
+    try:
+        rate = float(request.values.get('rate', Config.MODEL_SHADOW_RATE))
+        registry.set_shadow((request.values.get('version') or '').strip() or None, rate)
+    except ValueError as e:
+        return create_response(success=False, error=str(e), status_code=400)
+    return create_response(success=True, data=registry.status())
+
+
+@app.route('/models/<version>', methods=['DELETE'])
+def unload_model(version):
+    denied = _require_model_admin()
+    if denied:
+        return denied
+    registry = get_pipeline().registry
+    try:
+        registry.unload(version)
+    except ValueError as e:
+        return create_response(success=False, error=str(e), status_code=409)
+    return create_response(success=True, data=registry.status())
+
+
 @app.route('/detect_dataset', methods=['POST'])
 def detect_dataset():
     """Детекция с выводом в формате аннотаций (как в примере: file -> page_X -> annotations).
@@ -430,75 +787,7 @@ def detect_dataset():
         return create_response(False, error='No file provided (use field "image" or "document")', status_code=400)
 
     file = request.files.get('image') or request.files.get('document')
-    filename = file.filename or 'uploaded'
-
-    try:
-        loaded = load_image_from_upload(file, filename)
-    except Exception as e:
-        return create_response(False, error=f'Failed to decode file: {e}', status_code=400)
-
-    is_pdf = isinstance(loaded, list)
-    pages = loaded if is_pdf else [loaded]
-
-    # Выполняем детекцию постранично
-    annotation_root = {filename: {}}
-    total_counts = {'signature': 0, 'stamp': 0, 'qr_code': 0}
-    ann_global_index = 1
-
-    for page_idx, page_img in enumerate(pages, start=1):
-        try:
-            res = detector.detect(page_img)
-        except Exception:
-            # Если детекция упала — пропускаем страницу, но добавляем размер
-            h, w = page_img.shape[:2]
-            annotation_root[filename][f'page_{page_idx}'] = {
-                'annotations': [],
-                'page_size': {'width': w, 'height': h}
-            }
-            continue
-
-        # Размер страницы
-        h, w = page_img.shape[:2]
-        page_key = f'page_{page_idx}'
-        page_entry = {
-            'annotations': [],
-            'page_size': {'width': w, 'height': h}
-        }
-
-        for det in res['detections']:
-            x1, y1, x2, y2 = det['bbox']
-            width = x2 - x1
-            height = y2 - y1
-            area = width * height
-            ann_id = f'annotation_{ann_global_index}'
-            ann_global_index += 1
-            page_entry['annotations'].append({
-                ann_id: {
-                    'category': det['class_name'],
-                    'bbox': {
-                        'x': int(x1),
-                        'y': int(y1),
-                        'width': float(width),
-                        'height': float(height)
-                    },
-                    'area': float(area)
-                }
-            })
-
-        # Суммируем счётчики
-        total_counts['signature'] += res['count_by_class']['signature']
-        total_counts['stamp'] += res['count_by_class']['stamp']
-        total_counts['qr_code'] += res['count_by_class']['qr_code']
-
-        annotation_root[filename][page_key] = page_entry
-
-    data = {
-        'annotations': annotation_root,
-        'counts_total': total_counts,
-        'page_count': len(pages)
-    }
-
-    return create_response(True, data=data)
+    return _run_pipeline(file, file.filename or 'uploaded', default_outputs=('dataset',))
 
 
 if __name__ == '__main__':
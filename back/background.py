@@ -0,0 +1,81 @@
+import io
+import zipfile
+
+import cv2
+import numpy as np
+
+
+def remove_background_batch(crops: list[np.ndarray], white_threshold: int = 235,
+                            chroma_threshold: int = 22, softness: int = 20) -> list[np.ndarray]:
+    """Делает светлый (бумажный) фон кропов прозрачным — одной операцией на всю пачку.
+
+    Пиксели всех кропов склеиваются в один массив N x 3, альфа считается векторно:
+    светлые малонасыщенные пиксели — прозрачные, переход мягкий на `softness`
+    уровнях яркости (без «лесенки» по краям штрихов).
+
+    Returns:
+        список BGRA-изображений в том же порядке
+    """
+    if not crops:
+        return []
+    sizes = [crop.shape[0] * crop.shape[1] for crop in crops]
+    flat = np.concatenate([crop.reshape(-1, 3) for crop in crops])
+
+    minc = flat.min(axis=1).astype(np.float32)
+    chroma = flat.max(axis=1).astype(np.int16) - minc.astype(np.int16)
+
+    # 255 для чернил, 0 для фона, линейный переход между (thr - softness) и thr
+    low = white_threshold - max(1, softness)
+    alpha = np.clip((white_threshold - minc) / (white_threshold - low), 0.0, 1.0)
+    alpha[chroma >= chroma_threshold] = 1.0
+    alpha = (alpha * 255).astype(np.uint8)
+
+    bgra = np.concatenate([flat, alpha[:, None]], axis=1)
+    out = []
+    for part, crop in zip(np.split(bgra, np.cumsum(sizes)[:-1]), crops):
+        out.append(part.reshape(crop.shape[0], crop.shape[1], 4))
+    return out
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    success, buffer = cv2.imencode('.png', image)
+    if not success:
+        raise ValueError('Unable to encode image as PNG')
+    return buffer.tobytes()
+
+
+class _ZipStream(io.RawIOBase):
+    """Неперематываемый приёмник для zipfile: копит байты до следующего drain()."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(entries):
+    """Потоково собирает ZIP из (имя, байты): каждая запись уходит клиенту сразу.
+
+    PNG уже сжаты, поэтому записи хранятся без компрессии (ZIP_STORED).
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        for name, data in entries:
+            archive.writestr(name, data)
+            chunk = stream.drain()
+            if chunk:
+                yield chunk
+    tail = stream.drain()
+    if tail:
+        yield tail
@@ -0,0 +1,362 @@
+"""Пакетная офлайн-обработка без HTTP: папка, glob или ZIP/TAR-архив -> JSONL / Parquet.
+
+Примеры:
+    python back/batch_cli.py scans/ -o outputs/scans.jsonl
+    python back/batch_cli.py "archive/**/*.pdf" docs.zip -o outputs/docs.parquet --batch-size 16
+
+Записи — в схеме /detect_dataset ({'annotations': {file: {page_N: ...}}, 'counts_total', 'page_count'}).
+Прогресс пишется в checkpoint-файл: повторный запуск продолжает с необработанных файлов.
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import io
+import json
+import os
+import tarfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterator
+
+try:
+    from .config import Config
+    from .cpu import configure_torch
+    from .orientation import PageOrienter
+    from .page_cache import PageCache
+    from .utils import (
+        build_page_annotations, load_pages_from_upload, parse_classes, parse_page_ranges, parse_roi
+    )
+except ImportError:
+    from config import Config
+    from cpu import configure_torch
+    from orientation import PageOrienter
+    from page_cache import PageCache
+    from utils import (
+        build_page_annotations, load_pages_from_upload, parse_classes, parse_page_ranges, parse_roi
+    )
+
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+# Строк в одной row group Parquet: в памяти не больше стольких строк таблицы
+PARQUET_ROW_GROUP = 50000
+# Колонки таблицы (_flatten_record); у строки ошибки заполнены только file и error
+PARQUET_COLUMNS = (
+    ('file', 'string'), ('page', 'int64'), ('page_width', 'int64'), ('page_height', 'int64'),
+    ('annotation_id', 'string'), ('category', 'string'), ('x', 'int64'), ('y', 'int64'),
+    ('width', 'float64'), ('height', 'float64'), ('area', 'float64'), ('error', 'string'),
+)
+
+
+def _is_supported(name: str) -> bool:
+    return '.' in name and name.rsplit('.', 1)[1].lower() in Config.ALLOWED_EXTENSIONS
+
+
+def _is_archive(path: Path) -> bool:
+    return path.is_file() and path.name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def _iter_archive(path: Path) -> Iterator[tuple[str, Callable[[], bytes]]]:
+    """Документы внутри архива как (archive/member, загрузчик байтов)."""
+    if path.name.lower().endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        for info in archive.infolist():
+            if not info.is_dir() and _is_supported(info.filename):
+                yield f'{path.name}/{info.filename}', (lambda name=info.filename: archive.read(name))
+        return
+    # tarfile читается последовательно и не потокобезопасен — байты берём сразу
+    with tarfile.open(path) as archive:
+        for member in archive:
+            if member.isfile() and _is_supported(member.name):
+                data = archive.extractfile(member).read()
+                yield f'{path.name}/{member.name}', (lambda data=data: data)
+
+
+def iter_sources(inputs: list[str]) -> Iterator[tuple[str, Callable[[], bytes]]]:
+    """Разворачивает входы (папки, glob-шаблоны, архивы, файлы) в поток документов."""
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            paths = sorted(p for p in path.rglob('*') if p.is_file())
+        elif path.exists():
+            paths = [path]
+        else:
+            paths = sorted(Path(p) for p in glob.glob(item, recursive=True) if os.path.isfile(p))
+
+        for file_path in paths:
+            if _is_archive(file_path):
+                yield from _iter_archive(file_path)
+            elif _is_supported(file_path.name):
+                yield str(file_path), file_path.read_bytes
+
+
+def _decode_document(name: str, load: Callable[[], bytes], page_ranges) -> tuple[str, list, str | None]:
+    """Читает и растеризует документ целиком (выполняется в пуле декодирования)."""
+    try:
+        # Параллельность — на уровне документов (потоки --workers), страницы одного PDF
+        # рендерятся последовательно: иначе workers x PDF_RENDER_WORKERS процессов
+        # растеризации делят CPU с инференсом
+        pages, pdf_source = load_pages_from_upload(io.BytesIO(load()), name, page_ranges, render_workers=1)
+        if pdf_source is not None:
+            with pdf_source:
+                pages = list(pages)
+        return name, list(pages), None
+    except Exception as e:
+        return name, [], f'Failed to decode file: {e}'
+
+
+def _prefetch(sources, page_ranges, workers: int):
+    """Параллельное декодирование с ограниченным окном — в памяти не больше 2 x workers документов."""
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='decode') as pool:
+        window = deque()
+        for name, load in sources:
+            window.append(pool.submit(_decode_document, name, load, page_ranges))
+            if len(window) >= workers * 2:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def _document_record(name: str, pages: list, results: list, error: str | None) -> dict:
+    """Запись документа в схеме ответа /detect_dataset."""
+    file_root = {}
+    counts = {'signature': 0, 'stamp': 0, 'qr_code': 0}
+    ann_index = 1
+    for (page_num, image), res in zip(pages, results):
+        h, w = image.shape[:2]
+        entry = build_page_annotations(res['detections'], (w, h), ann_index)
+        ann_index += len(entry['annotations'])
+        file_root[f'page_{page_num}'] = entry
+        for key in counts:
+            counts[key] += res['count_by_class'][key]
+
+    record = {
+        'file': name,
+        'annotations': {name: file_root},
+        'counts_total': counts,
+        'page_count': len(pages),
+        'skipped_pages': sum(1 for res in results if res.get('blank'))
+    }
+    if error:
+        record['error'] = error
+    return record
+
+
+def _flatten_record(record: dict) -> list[dict]:
+    """Запись документа -> строки таблицы (одна на аннотацию, страницы без аннотаций — пустой строкой)."""
+    rows = []
+    name = record['file']
+    for page_key, page in record['annotations'][name].items():
+        base = {
+            'file': name,
+            'page': int(page_key.split('_', 1)[1]),
+            'page_width': page['page_size']['width'],
+            'page_height': page['page_size']['height'],
+        }
+        if not page['annotations']:
+            rows.append({**base, 'annotation_id': None, 'category': None,
+                         'x': None, 'y': None, 'width': None, 'height': None, 'area': None})
+        for item in page['annotations']:
+            (ann_id, ann), = item.items()
+            rows.append({**base, 'annotation_id': ann_id, 'category': ann['category'],
+                         **ann['bbox'], 'area': ann['area']})
+    if 'error' in record:
+        rows.append({'file': name, 'error': record['error']})
+    return rows
+
+
+def _write_parquet(jsonl_path: Path, output: Path, row_group: int = PARQUET_ROW_GROUP):
+    """JSONL -> Parquet по row group: память не растёт с числом документов (ночные выгрузки)."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as err:
+        raise SystemExit(f'Parquet output requires pyarrow: {err}')
+
+    schema = pa.schema([(name, getattr(pa, kind)()) for name, kind in PARQUET_COLUMNS])
+    tmp_path = output.with_name(output.name + '.tmp')
+    rows = []
+    with open(jsonl_path, 'r', encoding='utf-8') as handle, pq.ParquetWriter(tmp_path, schema) as writer:
+        for line in handle:
+            if line.strip():
+                rows.extend(_flatten_record(json.loads(line)))
+            if len(rows) >= row_group:
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                rows = []
+        if rows:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+    os.replace(tmp_path, output)
+
+
+def _load_checkpoint(path: Path) -> set[str]:
+    if not path.exists():
+        return set()
+    with open(path, 'r', encoding='utf-8') as handle:
+        return {line.rstrip('\n') for line in handle if line.strip()}
+
+
+def _recover_records(path: Path) -> set[str]:
+    """Файлы, чьи записи уже в JSONL (источник истины при продолжении).
+
+    Запись и строка checkpoint пишутся не атомарно: после падения между ними
+    документ есть в JSONL, но не в checkpoint, и без этой проверки он попал бы
+    в выход дважды. Недописанная последняя строка обрезается.
+    """
+    if not path.exists():
+        return set()
+    names = set()
+    good_size = 0
+    with open(path, 'rb') as handle:
+        for line in handle:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                names.add(json.loads(line)['file'])
+            except (ValueError, KeyError):
+                break
+            good_size += len(line)
+    if good_size < path.stat().st_size:
+        with open(path, 'r+b') as handle:
+            handle.truncate(good_size)
+    return names
+
+
+def build_detector(model_path=None, conf_threshold=None) -> DocumentDetector:
+    """Детектор с теми же настройками кэша, QR и ориентации страниц, что и у сервера."""
+    # torch/ultralytics импортируются только здесь: run_batch работает и с готовым детектором
+    try:
+        from .detector import DocumentDetector
+    except ImportError:
+        from detector import DocumentDetector
+    page_cache = PageCache(
+        max_entries=Config.PAGE_CACHE_SIZE,
+        similarity=Config.PAGE_CACHE_SIMILARITY
+    ) if Config.PAGE_CACHE_SIZE > 0 else None
+    return DocumentDetector(
+        model_path=str(model_path or Config.MODEL_PATH),
+        conf_threshold=Config.CONFIDENCE_THRESHOLD if conf_threshold is None else conf_threshold,
+        page_cache=page_cache,
+        qr_decode=Config.QR_DECODE,
+        blank_threshold=Config.BLANK_PAGE_THRESHOLD,
+        orienter=PageOrienter(
+            max_skew=Config.ORIENTATION_MAX_SKEW,
+            cache_size=Config.ORIENTATION_CACHE_SIZE
+        ) if Config.ORIENTATION else None
+    )
+
+
+def run_batch(inputs: list[str], output: str, checkpoint: str | None = None, batch_size: int = 8,
+              workers: int = 4, classes=None, page_ranges=None, detector: DocumentDetector | None = None,
+              roi=None) -> int:
+    """Обрабатывает все документы входов; возвращает число обработанных в этом запуске.
+
+    classes / page_ranges / roi — те же опции, что у /detect.
+    """
+    output = Path(output)
+    columnar = output.suffix.lower() == '.parquet'
+    # Parquet пишется в конце; до этого записи копятся в дозаписываемом JSONL
+    records_path = output.with_suffix(output.suffix + '.jsonl') if columnar else output
+    checkpoint = Path(checkpoint) if checkpoint else output.with_suffix(output.suffix + '.checkpoint')
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    done = _load_checkpoint(checkpoint)
+    recovered = _recover_records(records_path) - done
+    if recovered:
+        # Записаны, но не отмечены — дописываем в checkpoint, а не обрабатываем снова
+        with open(checkpoint, 'a', encoding='utf-8') as ckpt:
+            ckpt.writelines(name + '\n' for name in sorted(recovered))
+        done |= recovered
+    if done:
+        print(f"Resuming: {len(done)} files already processed")
+
+    if detector is None:
+        detector = build_detector()
+
+    sources = ((name, load) for name, load in iter_sources(inputs) if name not in done)
+    processed = 0
+    started = time.time()
+
+    with open(records_path, 'a', encoding='utf-8') as out, open(checkpoint, 'a', encoding='utf-8') as ckpt:
+        pending = []  # [(name, pages, error)] — документы, чьи страницы ждут батча
+        buffered = 0
+
+        def flush():
+            nonlocal processed, buffered
+            flat = [image for _, pages, _ in pending for _, image in pages]
+            results = []
+            for i in range(0, len(flat), batch_size):
+                results.extend(detector.detect_batch(flat[i:i + batch_size], classes=classes, roi=roi))
+
+            offset = 0
+            for name, pages, error in pending:
+                record = _document_record(name, pages, results[offset:offset + len(pages)], error)
+                offset += len(pages)
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                out.flush()
+                # В checkpoint — только после того, как запись документа уже на диске
+                ckpt.write(name + '\n')
+                ckpt.flush()
+                processed += 1
+            pending.clear()
+            buffered = 0
+            elapsed = time.time() - started
+            print(f"  [{processed}] files processed, {processed / max(elapsed, 1e-6):.2f} files/s")
+
+        for name, pages, error in _prefetch(sources, page_ranges, workers):
+            pending.append((name, pages, error))
+            buffered += len(pages)
+            if buffered >= batch_size:
+                flush()
+        if pending:
+            flush()
+
+    if columnar:
+        _write_parquet(records_path, output)
+    print(f"Done: {processed} files -> {output}")
+    return processed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Offline batch detection of signatures, stamps and QR codes (no HTTP).'
+    )
+    parser.add_argument('inputs', nargs='+', help='directories, glob patterns, files or ZIP/TAR archives')
+    parser.add_argument('-o', '--output', required=True, help='output file: .jsonl or .parquet')
+    parser.add_argument('--checkpoint', help='progress file (default: <output>.checkpoint)')
+    parser.add_argument('--batch-size', type=int, default=8, help='pages per model call (default: 8)')
+    parser.add_argument('--workers', type=int, default=min(8, os.cpu_count() or 1),
+                        help='parallel decoding threads')
+    parser.add_argument('--classes', help='e.g. signature,stamp (default: all)')
+    parser.add_argument('--pages', help='page ranges, e.g. 1-3,-1 (default: all)')
+    parser.add_argument('--roi', help='page region x1,y1,x2,y2 in 0..1, e.g. 0,0.66,1,1 (default: whole page)')
+    parser.add_argument('--model', default=str(Config.MODEL_PATH), help='path to YOLO weights')
+    parser.add_argument('--conf', type=float, default=Config.CONFIDENCE_THRESHOLD, help='confidence threshold')
+    args = parser.parse_args(argv)
+
+    try:
+        classes = parse_classes(args.classes, Config.CLASS_NAMES)
+        page_ranges = parse_page_ranges(args.pages)
+        roi = parse_roi(args.roi)
+    except ValueError as e:
+        parser.error(str(e))
+
+    configure_torch()
+    detector = build_detector(args.model, args.conf)
+
+    run_batch(
+        args.inputs, args.output,
+        checkpoint=args.checkpoint,
+        batch_size=max(1, args.batch_size),
+        workers=max(1, args.workers),
+        classes=classes,
+        page_ranges=page_ranges,
+        detector=detector,
+        roi=roi
+    )
+
+
+if __name__ == '__main__':
+    main()
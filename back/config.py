@@ -6,13 +6,51 @@ class Config:
    
     BASE_DIR = Path(__file__).parent.parent
     MODEL_PATH = BASE_DIR / 'models' / 'yolov8m_best.pt'
+    # Модель грузится в фоне: сколько секунд запрос ждёт готовности до ответа 503
+    MODEL_WAIT_TIMEOUT = float(os.getenv('MODEL_WAIT_TIMEOUT', '30'))
+    MODEL_RETRY_AFTER = int(os.getenv('MODEL_RETRY_AFTER', '5'))
+    # Загрузка весов (back/download_model.py): докачка по кускам, проверка SHA-256, общий кэш версий
+    MODEL_URL = os.getenv('MODEL_URL')
+    MODEL_SHA256 = os.getenv('MODEL_SHA256', '').strip().lower()
+    MODEL_CACHE_DIR = Path(os.getenv('MODEL_CACHE_DIR', str(BASE_DIR / 'models' / 'cache')))
+    MODEL_DOWNLOAD_WORKERS = int(os.getenv('MODEL_DOWNLOAD_WORKERS', '4'))
+    MODEL_DOWNLOAD_CHUNK_MB = int(os.getenv('MODEL_DOWNLOAD_CHUNK_MB', '8'))
+    MODEL_DOWNLOAD_TIMEOUT = float(os.getenv('MODEL_DOWNLOAD_TIMEOUT', '30'))
+    # Реестр версий: имя стартовой версии, куда ставятся версии по url, токен для /models/*
+    MODEL_VERSION = os.getenv('MODEL_VERSION', MODEL_PATH.stem)
+    MODEL_VERSIONS_DIR = BASE_DIR / 'models' / 'versions'
+    MODEL_ADMIN_TOKEN = os.getenv('MODEL_ADMIN_TOKEN', '')
+    MODEL_SHADOW_RATE = float(os.getenv('MODEL_SHADOW_RATE', '0.1'))
     OUTPUT_DIR = BASE_DIR / 'outputs'
     
    
     CONFIDENCE_THRESHOLD = 0.25  
+    # Нижний порог сырых предсказаний: conf от него и выше меняется без повторного инференса (/rethreshold)
+    RAW_CONF_FLOOR = float(os.getenv('RAW_CONF_FLOOR', '0.05'))
     IOU_THRESHOLD = 0.5
     IMAGE_SIZE = 640
     
+    # Растеризация PDF — одна политика для pdf2image и PyMuPDF.
+    # PDF_RENDER_DPI > 0 — фиксированный DPI; 0 — адаптивно: длинная сторона
+    # страницы = IMAGE_SIZE * PDF_COARSE_SCALE (запас x2 под ROI и мелкие подписи).
+    PDF_RENDER_DPI = int(os.getenv('PDF_RENDER_DPI', '0'))
+    PDF_COARSE_SCALE = float(os.getenv('PDF_COARSE_SCALE', '2.0'))
+    # Кропы детекций перерисовываются из PDF в этом DPI (нужен PyMuPDF)
+    PDF_CROP_DPI = int(os.getenv('PDF_CROP_DPI', '300'))
+    # Параллельная растеризация: документы от PDF_PARALLEL_MIN_PAGES страниц
+    # рендерятся в общем пуле из PDF_RENDER_WORKERS процессов (PyMuPDF) / потоках (pdf2image).
+    # Короткие документы быстрее рендерить последовательно (~15 мс на страницу)
+    PDF_RENDER_WORKERS = int(os.getenv('PDF_RENDER_WORKERS', str(min(4, os.cpu_count() or 1))))
+    PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', '24'))
+
+    # Потоки по компонентам (0 — авто по числу доступных ядер, см. back/cpu.py)
+    TORCH_THREADS = int(os.getenv('TORCH_THREADS', '0'))
+    TORCH_INTEROP_THREADS = int(os.getenv('TORCH_INTEROP_THREADS', '0'))
+    OPENCV_THREADS = int(os.getenv('OPENCV_THREADS', '0'))
+    # Привязка к ядрам (Linux): '0-3' — процесс инференса, '4-7' — воркеры растеризации PDF
+    INFERENCE_CPUS = os.getenv('INFERENCE_CPUS', '').strip()
+    RENDER_CPUS = os.getenv('RENDER_CPUS', '').strip()
+    
 
     HOST = '0.0.0.0'
     # Render предоставляет переменную окружения PORT; используем её если есть
@@ -22,10 +60,19 @@ class Config:
     
     PERPLEXITY_API_KEY = os.getenv('PERPLEXITY_API_KEY', '').strip()
     PERPLEXITY_MODEL = os.getenv('PERPLEXITY_MODEL', 'llama-3.1-70b-instruct')
+    # Переопределяется для локального стаба при офлайн-проверке
+    PERPLEXITY_URL = os.getenv('PERPLEXITY_URL', 'https://api.perplexity.ai/chat/completions').strip()
 
    
     GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', '').strip()
     GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash')
+
+    # Клиент LLM: таймаут запроса, задержка запасного провайдера (0 — оба сразу), размер кэша ответов
+    LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '30'))
+    LLM_HEDGE_DELAY = float(os.getenv('LLM_HEDGE_DELAY', '2.0'))
+    LLM_CACHE_SIZE = int(os.getenv('LLM_CACHE_SIZE', '256'))
+    # Длинные документы: фрагменты до LLM_CHUNK_CHARS символов конспектируются параллельно и сводятся
+    LLM_CHUNK_CHARS = int(os.getenv('LLM_CHUNK_CHARS', '12000'))
     
 
     CLASS_NAMES = ['signature', 'stamp', 'qr_code']
@@ -36,7 +83,47 @@ class Config:
     }
     
 
-    MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+    # Кэш страниц: повторяющиеся страницы не гоняем через модель
+    PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', '512'))  # 0 — кэш отключён
+    # 1.0 — только точные повторы (SHA-1 пикселей); меньше — ещё и похожие по dHash с проверкой миниатюры
+    PAGE_CACHE_SIMILARITY = float(os.getenv('PAGE_CACHE_SIMILARITY', '1.0'))
+    # Поворот (0/90/180/270) и выравнивание перекоса страниц перед инференсом; результат — в кэше по хэшу страницы
+    ORIENTATION = os.getenv('ORIENTATION', '1').strip().lower() not in ('0', 'false', 'no')
+    ORIENTATION_MAX_SKEW = float(os.getenv('ORIENTATION_MAX_SKEW', '5'))  # градусы
+    ORIENTATION_CACHE_SIZE = int(os.getenv('ORIENTATION_CACHE_SIZE', '2048'))
+    # Пустые страницы (разделители, обороты) не идут в модель: доля чернил в самой густой клетке ниже порога
+    BLANK_PAGE_THRESHOLD = float(os.getenv('BLANK_PAGE_THRESHOLD', '0.01'))  # 0 — не проверять
+    # Индекс кропов подписей/печатей (SQLite): совпадения с ранее обработанными документами — в duplicates
+    CROP_INDEX = os.getenv('CROP_INDEX', '1').strip().lower() not in ('0', 'false', 'no')
+    CROP_INDEX_PATH = os.getenv('CROP_INDEX_PATH', str(OUTPUT_DIR / 'crop_index.sqlite'))
+    CROP_MATCH_DISTANCE = int(os.getenv('CROP_MATCH_DISTANCE', '24'))  # бит из 256, максимум 31
+    CROP_INDEX_MAX_CROPS = int(os.getenv('CROP_INDEX_MAX_CROPS', '0'))  # 0 — без ограничения; >0 — старые удаляются
+
+    # Декодирование QR через OpenCV (payload в детекциях и быстрый путь classes=qr_code)
+    QR_DECODE = os.getenv('QR_DECODE', '1').strip().lower() not in ('0', 'false', 'no')
+    
+
+    # Кропы строятся лениво через /crops/<result_id>; crops=1 в запросе (или INLINE_CROPS=1) — сразу в ответе /detect
+    INLINE_CROPS = os.getenv('INLINE_CROPS', '0').strip().lower() in ('1', 'true', 'yes')
+    # Превью для фронта: большая сторона, качество, формат (webp | jpeg — прогрессивный), кэш закодированных
+    PREVIEW_MAX_DIM = int(os.getenv('PREVIEW_MAX_DIM', '1280'))
+    PREVIEW_QUALITY = int(os.getenv('PREVIEW_QUALITY', '75'))
+    PREVIEW_FORMAT = os.getenv('PREVIEW_FORMAT', 'webp').strip().lower()
+    PREVIEW_CACHE_MB = int(os.getenv('PREVIEW_CACHE_MB', '64'))
+    # Сжатие ответов (JSON/текст) по Accept-Encoding: brotli, если установлен, иначе gzip
+    COMPRESS_RESPONSES = os.getenv('COMPRESS_RESPONSES', '1').strip().lower() not in ('0', 'false', 'no')
+    COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+    GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+    BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '5'))
+    # Кэширование скачиваемых результатов браузером (секунды); повторные запросы — 304 по ETag
+    DOWNLOAD_MAX_AGE = int(os.getenv('DOWNLOAD_MAX_AGE', '3600'))
+    # Память под недавние результаты (страницы + детекции) для ленивых кропов
+    RESULT_STORE_MB = int(os.getenv('RESULT_STORE_MB', '512'))
+    
+
+    # Лимит на один файл (проверяется при записи загрузки на диск) и на весь запрос
+    MAX_FILE_SIZE = int(os.getenv('MAX_FILE_SIZE_MB', '10')) * 1024 * 1024  # 10MB
+    MAX_REQUEST_SIZE = int(os.getenv('MAX_REQUEST_SIZE_MB', '100')) * 1024 * 1024
     ALLOWED_EXTENSIONS = {
         'jpg', 'jpeg', 'png', 'bmp', 'webp', 'tif', 'tiff', 'heic', 'heif', 'pdf'
     }
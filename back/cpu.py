@@ -0,0 +1,203 @@
+"""Потоки и привязка к ядрам для torch, OpenCV и воркеров растеризации.
+
+torch (YOLO, EasyOCR) и OpenCV по умолчанию каждый берут все ядра и вместе
+переподписывают CPU. Здесь пулы задаются по компонентам из Config; воркеры
+можно закрепить за наборами ядер (INFERENCE_CPUS / RENDER_CPUS).
+
+Подбор настроек под машину:
+    python back/cpu.py --benchmark --image sample.png
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import time
+from typing import Optional
+
+import cv2
+import numpy as np
+
+try:
+    from .config import Config
+except ImportError:
+    from config import Config
+
+
+_applied = {}
+
+
+def parse_cpu_list(value: Optional[str]) -> list[int]:
+    """'0-3,6' -> [0, 1, 2, 3, 6]; пустая строка — []."""
+    cpus = []
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return sorted(set(cpus))
+
+
+def available_cpus() -> int:
+    """Число ядер, доступных процессу (с учётом affinity/cgroup, если ОС это умеет)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def pin_current_process(cpus: list[int]) -> bool:
+    """Закрепляет процесс за ядрами; False — ОС не поддерживает (Windows/macOS) или набор пуст."""
+    if not cpus or not hasattr(os, 'sched_setaffinity'):
+        return False
+    try:
+        os.sched_setaffinity(0, cpus)
+        return True
+    except OSError:
+        return False
+
+
+def thread_plan(cores: Optional[int] = None) -> dict:
+    """Потоки по компонентам: значения из Config, 0 — авто.
+
+    Авто: OpenCV — четверть ядер (CLAHE, декодирование, QR — короткие операции
+    между инференсами), torch — все ядра инференса, inter-op — 1 (у YOLO
+    нет параллельных веток графа).
+    """
+    cores = cores or available_cpus()
+    return {
+        'torch_threads': Config.TORCH_THREADS or cores,
+        'torch_interop_threads': Config.TORCH_INTEROP_THREADS or 1,
+        'opencv_threads': Config.OPENCV_THREADS or max(1, cores // 4),
+    }
+
+
+def set_torch_threads(threads: int, interop_threads: Optional[int] = None):
+    import torch
+    torch.set_num_threads(max(1, int(threads)))
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(max(1, int(interop_threads)))
+        except RuntimeError:
+            # inter-op пул задаётся один раз до первой параллельной операции
+            pass
+
+
+def configure_process():
+    """Применяет Config к процессу сервиса/CLI: affinity, переменные OpenMP/MKL и потоки OpenCV.
+
+    Вызывается один раз при старте; torch здесь не импортируется — его потоки
+    задаёт configure_torch() перед загрузкой модели.
+    """
+    if _applied:
+        return dict(_applied)
+    inference_cpus = parse_cpu_list(Config.INFERENCE_CPUS)
+    pinned = pin_current_process(inference_cpus)
+    plan = thread_plan(len(inference_cpus) if pinned else None)
+
+    # OpenMP/MKL читают переменные при инициализации — до первого импорта torch
+    os.environ.setdefault('OMP_NUM_THREADS', str(plan['torch_threads']))
+    os.environ.setdefault('MKL_NUM_THREADS', str(plan['torch_threads']))
+    cv2.setNumThreads(plan['opencv_threads'])
+
+    _applied.update(plan, inference_cpus=inference_cpus if pinned else None,
+                    render_cpus=parse_cpu_list(Config.RENDER_CPUS) or None)
+    return dict(_applied)
+
+
+def configure_torch():
+    """Потоки torch по плану configure_process(); вызывается перед загрузкой модели."""
+    plan = configure_process()
+    set_torch_threads(plan['torch_threads'], plan['torch_interop_threads'])
+
+
+def configure_render_worker():
+    """Воркер растеризации PDF: один поток OpenCV (параллелизм — на уровне процессов) и RENDER_CPUS."""
+    cv2.setNumThreads(1)
+    pin_current_process(parse_cpu_list(Config.RENDER_CPUS))
+
+
+def settings() -> dict:
+    """Применённые настройки (для /metrics)."""
+    return dict(_applied)
+
+
+def benchmark(image_path: Optional[str] = None, model_path: Optional[str] = None,
+              repeats: int = 5, torch_options=None, opencv_options=None) -> list[dict]:
+    """Перебирает потоки torch x OpenCV на detect() и возвращает замеры, лучший — первым.
+
+    Кэш страниц отключён, первый прогон каждой конфигурации — прогрев.
+    """
+    try:
+        from .detector import DocumentDetector
+    except ImportError:
+        from detector import DocumentDetector
+
+    cores = available_cpus()
+    if image_path:
+        image = cv2.imread(image_path)
+        if image is None:
+            raise SystemExit(f'Cannot read image: {image_path}')
+    else:
+        # Синтетическая страница A4 с «текстом», если образца нет
+        image = np.full((1280, 905, 3), 255, dtype=np.uint8)
+        for y in range(80, 1200, 40):
+            cv2.putText(image, 'Lorem ipsum dolor sit amet 2024', (60, y), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2)
+
+    torch_options = torch_options or sorted({1, 2, max(1, cores // 2), cores})
+    opencv_options = opencv_options or sorted({1, max(1, cores // 4), cores})
+
+    set_torch_threads(cores, 1)
+    detector = DocumentDetector(
+        model_path=str(model_path or Config.MODEL_PATH),
+        conf_threshold=Config.CONFIDENCE_THRESHOLD,
+        page_cache=None,
+        qr_decode=Config.QR_DECODE
+    )
+
+    results = []
+    for torch_threads in torch_options:
+        for opencv_threads in opencv_options:
+            set_torch_threads(torch_threads)
+            cv2.setNumThreads(opencv_threads)
+            detector.detect(image)
+            started = time.perf_counter()
+            for _ in range(repeats):
+                detector.detect(image)
+            elapsed = (time.perf_counter() - started) / repeats
+            results.append({
+                'torch_threads': torch_threads,
+                'opencv_threads': opencv_threads,
+                'ms_per_page': round(elapsed * 1000, 1),
+                'pages_per_s': round(1.0 / elapsed, 2) if elapsed else 0.0,
+            })
+            print(f"  torch={torch_threads:<3} opencv={opencv_threads:<3} {results[-1]['ms_per_page']:>8} ms/page")
+    results.sort(key=lambda r: r['ms_per_page'])
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CPU thread settings: show the plan or benchmark the host.')
+    parser.add_argument('--benchmark', action='store_true', help='sweep torch/OpenCV threads on detect()')
+    parser.add_argument('--image', help='sample page image (default: synthetic page)')
+    parser.add_argument('--model', help='path to YOLO weights (default: Config.MODEL_PATH)')
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    print(f"Available cores: {available_cpus()}")
+    if not args.benchmark:
+        print(f"Thread plan: {thread_plan()}")
+        return
+
+    results = benchmark(args.image, args.model, repeats=max(1, args.repeats))
+    best = results[0]
+    print(f"\nBest: {best['ms_per_page']} ms/page ({best['pages_per_s']} pages/s)")
+    print(f"TORCH_THREADS={best['torch_threads']}")
+    print(f"OPENCV_THREADS={best['opencv_threads']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+"""Индекс кропов подписей и печатей: поиск визуально одинаковых в ранее обработанных документах.
+
+Вставленная копией подпись или печать — частый признак подделки. У каждого
+кропа считается 256-битный перцептивный хэш (DCT), индекс лежит в SQLite на
+диске и ищет соседей по расстоянию Хэмминга методом multi-index hashing:
+хэш режется на 16 кусков по 16 бит, и каждый кусок — ключ отдельной таблицы.
+Если хэши отличаются не больше чем на 16 * (s + 1) - 1 бит, хотя бы один кусок
+совпадает с точностью до s бит — поэтому достаточно перебрать кусок и его
+соседей на расстоянии s (s <= 1) и точно сравнить только найденных
+кандидатов. На каждый ключ приходится ~N / 65536 записей, так что поиск
+остаётся быстрым и на миллионах кропов.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import cv2
+import numpy as np
+
+try:
+    from .metrics import metrics
+    from .page_cache import hamming_distances
+except ImportError:
+    from metrics import metrics
+    from page_cache import hamming_distances
+
+
+HASH_BITS = 256
+SEGMENTS = 16
+SEGMENT_BITS = HASH_BITS // SEGMENTS
+# Пропорции кропа не должны отличаться сильнее (подпись той же формы)
+ASPECT_TOLERANCE = 0.15
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS crops (
+    id INTEGER PRIMARY KEY,
+    hash BLOB NOT NULL,
+    class TEXT NOT NULL,
+    aspect REAL NOT NULL,
+    result_id TEXT,
+    document TEXT,
+    page INTEGER,
+    bbox TEXT,
+    model_version TEXT,
+    created_at TEXT,
+    content TEXT
+);
+CREATE TABLE IF NOT EXISTS crop_keys (
+    key INTEGER NOT NULL,
+    crop_id INTEGER NOT NULL,
+    PRIMARY KEY (key, crop_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS crop_keys_crop ON crop_keys (crop_id);
+"""
+
+
+def crop_hash(crop: np.ndarray) -> tuple[np.ndarray, float]:
+    """Перцептивный хэш кропа (32 байта) и его пропорции (ширина / высота).
+
+    Кроп сначала обрезается по «чернилам», чтобы отступ и дрожание бокса
+    детектора не меняли хэш; затем pHash: знаки низких частот DCT 32x32
+    относительно медианы — устойчив к масштабу, JPEG-сжатию и яркости.
+    """
+    gray = crop if crop.ndim == 2 else cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    x, y, w, h = cv2.boundingRect(ink)
+    if w > 1 and h > 1:
+        gray = gray[y:y + h, x:x + w]
+    h, w = gray.shape
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:16, :16].ravel()
+    # Постоянная составляющая (яркость) в сравнении с медианой не участвует
+    bits = low > np.median(low[1:])
+    return np.packbits(bits), w / max(h, 1)
+
+
+def _segments(digest: np.ndarray) -> list[int]:
+    """16 кусков по 16 бит."""
+    return digest.view('>u2').astype(np.int64).tolist()
+
+
+def _neighbors(value: int, radius: int) -> list[int]:
+    """Кусок и все значения на расстоянии Хэмминга <= radius (radius 0 или 1)."""
+    if radius <= 0:
+        return [value]
+    return [value] + [value ^ (1 << bit) for bit in range(SEGMENT_BITS)]
+
+
+def _key(class_id: int, segment: int, value: int) -> int:
+    return ((class_id * SEGMENTS + segment) << SEGMENT_BITS) | value
+
+
+class CropIndex:
+    """Индекс кропов в SQLite (WAL): вставки по мере работы /detect, поиск ближайших ранее виденных.
+
+    У кропа хранится content — SHA-1 страницы, с которой он вырезан: совпадения
+    со страницами того же содержимого (повторная загрузка того же файла) не
+    считаются дубликатами, и повторно такие страницы не индексируются.
+    max_crops > 0 — держать не больше стольких кропов, самые старые удаляются.
+    Соединение — своё у каждого потока, запись сериализуется блокировкой.
+    """
+
+    CLASSES = ('signature', 'stamp', 'qr_code')
+
+    def __init__(self, path, max_distance: int = 24, max_crops: int = 0):
+        self.path = str(path)
+        # Больше 31 бита методу с перебором соседей на 1 бит не гарантировать
+        self.max_distance = min(int(max_distance), SEGMENTS * 2 - 1)
+        self.max_crops = max(0, int(max_crops))
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        with self._write_lock:
+            connection = self._connection()
+            connection.executescript(_SCHEMA)
+            # Индексы, созданные до появления content, дополняются колонкой
+            columns = {row[1] for row in connection.execute('PRAGMA table_info(crops)')}
+            if 'content' not in columns:
+                connection.execute('ALTER TABLE crops ADD COLUMN content TEXT')
+            connection.execute('CREATE INDEX IF NOT EXISTS crops_content ON crops (content)')
+            connection.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _class_id(self, name: str) -> int:
+        return self.CLASSES.index(name) if name in self.CLASSES else len(self.CLASSES)
+
+    def add(self, digest: np.ndarray, aspect: float, class_name: str, result_id: Optional[str] = None,
+            document: Optional[str] = None, page: Optional[int] = None, bbox=None,
+            model_version: Optional[str] = None, content: Optional[str] = None) -> int:
+        """Добавляет кроп; возвращает его id."""
+        return self.add_many([(digest, aspect, class_name, {
+            'result_id': result_id, 'document': document, 'page': page, 'bbox': bbox,
+            'model_version': model_version, 'content': content
+        })])[0]
+
+    def add_many(self, items: list) -> list[int]:
+        """items — [(digest, aspect, class_name, meta)]; одна транзакция на документ.
+
+        Сверх max_crops удаляются самые старые кропы (id растут со временем вставки).
+        """
+        created_at = datetime.now().isoformat(timespec='seconds')
+        ids = []
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                for digest, aspect, class_name, meta in items:
+                    cursor = connection.execute(
+                        'INSERT INTO crops (hash, class, aspect, result_id, document, page, bbox, model_version, '
+                        'created_at, content) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (digest.tobytes(), class_name, float(aspect), meta.get('result_id'), meta.get('document'),
+                         meta.get('page'), json.dumps(meta.get('bbox')), meta.get('model_version'), created_at,
+                         meta.get('content'))
+                    )
+                    crop_id = cursor.lastrowid
+                    class_id = self._class_id(class_name)
+                    connection.executemany(
+                        'INSERT OR IGNORE INTO crop_keys (key, crop_id) VALUES (?, ?)',
+                        [(_key(class_id, segment, value), crop_id)
+                         for segment, value in enumerate(_segments(digest))]
+                    )
+                    ids.append(crop_id)
+                if self.max_crops and ids:
+                    self._evict(connection, ids[-1] - self.max_crops)
+        metrics.incr('crop_index_inserts', len(ids))
+        return ids
+
+    @staticmethod
+    def _evict(connection: sqlite3.Connection, last_id: int):
+        """Удаляет кропы с id <= last_id вместе с их ключами (внутри транзакции вставки)."""
+        if last_id <= 0:
+            return
+        removed = connection.execute('DELETE FROM crops WHERE id <= ?', (last_id,)).rowcount
+        if removed:
+            connection.execute('DELETE FROM crop_keys WHERE crop_id <= ?', (last_id,))
+            metrics.incr('crop_index_evicted', removed)
+
+    def indexed_contents(self, contents) -> set:
+        """Какие из content (SHA-1 страниц) уже есть в индексе."""
+        contents = [content for content in set(contents) if content]
+        if not contents:
+            return set()
+        placeholders = ','.join('?' * len(contents))
+        rows = self._connection().execute(
+            f'SELECT DISTINCT content FROM crops WHERE content IN ({placeholders})', contents
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def query(self, digest: np.ndarray, aspect: Optional[float] = None, class_name: Optional[str] = None,
+              limit: int = 5, max_distance: Optional[int] = None, exclude_result: Optional[str] = None,
+              exclude_contents=None) -> list[dict]:
+        """Ближайшие кропы того же класса (class_name=None — любого) на расстоянии <= max_distance.
+
+        exclude_result / exclude_contents — не возвращать кропы этого результата
+        и кропы со страниц с таким же содержимым (SHA-1 страницы).
+
+        Returns:
+            [{'id', 'class', 'distance', 'similarity', 'result_id', 'document', 'page', 'bbox', ...}]
+            по возрастанию расстояния
+        """
+        started = time.perf_counter()
+        max_distance = self.max_distance if max_distance is None else min(int(max_distance), SEGMENTS * 2 - 1)
+        radius = max_distance // SEGMENTS
+        classes = [class_name] if class_name else list(self.CLASSES)
+        keys = [
+            _key(self._class_id(name), segment, neighbor)
+            for name in classes
+            for segment, value in enumerate(_segments(digest))
+            for neighbor in _neighbors(value, radius)
+        ]
+        placeholders = ','.join('?' * len(keys))
+        rows = self._connection().execute(
+            'SELECT c.id, c.hash, c.class, c.aspect, c.result_id, c.document, c.page, c.bbox, c.model_version, '
+            f'c.created_at, c.content FROM crops c WHERE c.id IN (SELECT crop_id FROM crop_keys WHERE key IN ({placeholders}))',
+            keys
+        ).fetchall()
+        if exclude_result is not None:
+            rows = [row for row in rows if row[4] != exclude_result]
+        if exclude_contents:
+            rows = [row for row in rows if row[10] is None or row[10] not in exclude_contents]
+        if aspect is not None:
+            rows = [row for row in rows if abs(row[3] - aspect) <= ASPECT_TOLERANCE * max(aspect, row[3])]
+        matches = []
+        if rows:
+            hashes = np.stack([np.frombuffer(row[1], dtype=np.uint8) for row in rows])
+            distances = hamming_distances(hashes, digest)
+            for row, distance in zip(rows, distances.tolist()):
+                if distance > max_distance:
+                    continue
+                matches.append({
+                    'id': row[0],
+                    'class': row[2],
+                    'distance': distance,
+                    'similarity': round(1.0 - distance / HASH_BITS, 4),
+                    'result_id': row[4],
+                    'document': row[5],
+                    'page': row[6],
+                    'bbox': json.loads(row[7]) if row[7] else None,
+                    'model_version': row[8],
+                    'indexed_at': row[9],
+                })
+            matches.sort(key=lambda match: (match['distance'], match['id']))
+        metrics.incr('crop_index_queries')
+        metrics.set('crop_index_last_query_ms', round((time.perf_counter() - started) * 1000, 2))
+        return matches[:max(1, int(limit))]
+
+    def index_document(self, result_id: str, document: str, cut: list, model_version: Optional[str] = None,
+                       limit: int = 5, store: bool = True) -> list[dict]:
+        """Ищет совпадения кропов документа среди ранее виденных, затем добавляет их в индекс.
+
+        cut — [(метаданные кропа, BGR-кроп)] из cut_page_crops; в метаданных может
+        быть 'content' — SHA-1 страницы кропа. Поиск до вставки: совпадения — только
+        с прошлыми документами и не со страницами того же содержимого; страницы,
+        уже бывшие в индексе, повторно не добавляются. store=False — только поиск.
+
+        Returns:
+            [{'id', 'page', 'class', 'bbox', 'matches': [...]}] — только кропы с совпадениями
+        """
+        items, duplicates = [], []
+        contents = {crop_data.get('content') for crop_data, _ in cut} - {None}
+        indexed = self.indexed_contents(contents) if store else set()
+        for crop_data, crop_image in cut:
+            if crop_image is None or not crop_image.size:
+                continue
+            digest, aspect = crop_hash(crop_image)
+            matches = self.query(digest, aspect, crop_data['class'], limit=limit, exclude_contents=contents)
+            if matches:
+                duplicates.append({
+                    'id': crop_data['id'],
+                    'page': crop_data.get('page'),
+                    'class': crop_data['class'],
+                    'bbox': crop_data['bbox'],
+                    'matches': matches,
+                })
+            if not store or crop_data.get('content') in indexed:
+                continue
+            items.append((digest, aspect, crop_data['class'], {
+                'result_id': result_id, 'document': document, 'page': crop_data.get('page'),
+                'bbox': crop_data['bbox'], 'model_version': model_version, 'content': crop_data.get('content')
+            }))
+        if items:
+            self.add_many(items)
+        if duplicates:
+            metrics.incr('crop_duplicates_found', len(duplicates))
+        return duplicates
+
+    def stats(self) -> dict:
+        count = self._connection().execute('SELECT COUNT(*) FROM crops').fetchone()[0]
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return {
+            'crops': count,
+            'size_mb': round(size / (1024 * 1024), 2),
+            'max_distance': self.max_distance,
+            'max_crops': self.max_crops,
+            'last_query_ms': metrics.get('crop_index_last_query_ms', None),
+        }
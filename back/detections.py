@@ -0,0 +1,220 @@
+import numpy as np
+
+
+class DetectionSet:
+    """Детекции как структура массивов NumPy (вместо списка словарей на каждый бокс).
+
+    boxes — N x 4 (x1, y1, x2, y2), cls / conf / page / source — по N значений.
+    page = 0 — номер страницы не задан (одиночное изображение).
+    extras — необязательные поля по детекциям (например payload у QR): имя -> массив N.
+    В JSON-словари превращается только на краю API (to_dicts).
+    """
+
+    __slots__ = ('boxes', 'cls', 'conf', 'page', 'source', 'extras', 'names')
+
+    SOURCES = ('original', 'inverted', 'qr_decoder')
+
+    def __init__(self, boxes, cls, conf, page=None, source=None, extras=None, names=()):
+        n = len(cls)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(n, 4)
+        self.cls = np.asarray(cls, dtype=np.int16)
+        self.conf = np.asarray(conf, dtype=np.float32)
+        self.page = np.zeros(n, dtype=np.int32) if page is None else np.asarray(page, dtype=np.int32)
+        self.source = np.zeros(n, dtype=np.uint8) if source is None else np.asarray(source, dtype=np.uint8)
+        self.extras = extras or {}
+        self.names = tuple(names)
+
+    @classmethod
+    def empty(cls, names=()):
+        return cls(np.empty((0, 4)), [], [], names=names)
+
+    @classmethod
+    def from_arrays(cls, boxes, classes, confs, source='original', names=()):
+        n = len(classes)
+        return cls(
+            boxes, classes, confs,
+            source=np.full(n, cls.SOURCES.index(source), dtype=np.uint8),
+            names=names
+        )
+
+    @classmethod
+    def from_dicts(cls, detections, names=()):
+        """Обратная конвертация из формата API (списка словарей)."""
+        if not detections:
+            return cls.empty(names)
+        extras = {}
+        for key in ('payload', 'qr_verified'):
+            if any(key in det for det in detections):
+                extras[key] = np.array([det.get(key) for det in detections], dtype=object)
+        return cls(
+            [det['bbox'] for det in detections],
+            [det['class'] for det in detections],
+            [det['confidence'] for det in detections],
+            page=[det.get('page', 0) for det in detections],
+            source=[cls.SOURCES.index(det.get('source', 'original')) for det in detections],
+            extras=extras,
+            names=names
+        )
+
+    @classmethod
+    def concat(cls, sets, names=()):
+        sets = [s for s in sets if s is not None]
+        names = names or next((s.names for s in sets if s.names), ())
+        sets = [s for s in sets if len(s)]
+        if not sets:
+            return cls.empty(names)
+        if len(sets) == 1:
+            return sets[0]
+        keys = set().union(*(s.extras.keys() for s in sets))
+        extras = {
+            key: np.concatenate([
+                s.extras.get(key, np.full(len(s), None, dtype=object)) for s in sets
+            ])
+            for key in keys
+        }
+        return cls(
+            np.concatenate([s.boxes for s in sets]),
+            np.concatenate([s.cls for s in sets]),
+            np.concatenate([s.conf for s in sets]),
+            page=np.concatenate([s.page for s in sets]),
+            source=np.concatenate([s.source for s in sets]),
+            extras=extras,
+            names=names
+        )
+
+    def __len__(self):
+        return len(self.cls)
+
+    def __getitem__(self, index):
+        """Подмножество по булевой маске или массиву индексов."""
+        return DetectionSet(
+            self.boxes[index], self.cls[index], self.conf[index],
+            page=self.page[index], source=self.source[index],
+            extras={key: values[index] for key, values in self.extras.items()},
+            names=self.names
+        )
+
+    def filter_classes(self, class_names):
+        """Оставляет только указанные классы (по именам)."""
+        if not class_names:
+            return self
+        ids = [i for i, name in enumerate(self.names) if name in class_names]
+        return self[np.isin(self.cls, ids)]
+
+    def with_page(self, page):
+        out = self[slice(None)]
+        out.page = np.full(len(self), page, dtype=np.int32)
+        return out
+
+    def with_extra(self, key, values):
+        out = self[slice(None)]
+        out.extras = {**out.extras, key: np.asarray(values, dtype=object)}
+        return out
+
+    def transformed(self, sx=1.0, sy=1.0, dx=0.0, dy=0.0):
+        """Масштаб и сдвиг координат всех боксов."""
+        out = self[slice(None)]
+        out.boxes = self.boxes * np.array([sx, sy, sx, sy], dtype=np.float32) \
+            + np.array([dx, dy, dx, dy], dtype=np.float32)
+        return out
+
+    def warped(self, matrix, shape=None):
+        """Боксы через аффинное преобразование 2x3: описанный прямоугольник образов углов.
+
+        shape (h, w) — обрезать боксы по странице.
+        """
+        out = self[slice(None)]
+        if not len(self):
+            return out
+        x1, y1, x2, y2 = self.boxes.T
+        corners = np.stack([
+            np.stack([x1, y1], axis=1), np.stack([x2, y1], axis=1),
+            np.stack([x1, y2], axis=1), np.stack([x2, y2], axis=1)
+        ], axis=1)  # N x 4 x 2
+        matrix = np.asarray(matrix, dtype=np.float32)
+        mapped = corners @ matrix[:, :2].T + matrix[:, 2]
+        boxes = np.concatenate([mapped.min(axis=1), mapped.max(axis=1)], axis=1)
+        if shape is not None:
+            h, w = shape[:2]
+            boxes = np.clip(boxes, 0, np.array([w, h, w, h], dtype=np.float32))
+        out.boxes = boxes.astype(np.float32)
+        return out
+
+    def class_names(self):
+        return [self.names[c] if c < len(self.names) else str(c) for c in self.cls.tolist()]
+
+    def count_by_class(self, keys=('signature', 'stamp', 'qr_code')):
+        counts = np.bincount(self.cls.astype(np.int64), minlength=len(self.names)) if len(self) else ()
+        result = {key: 0 for key in keys}
+        for idx, count in enumerate(counts):
+            name = self.names[idx] if idx < len(self.names) else str(idx)
+            if name in result:
+                result[name] += int(count)
+        return result
+
+    def avg_confidence(self):
+        """Средняя уверенность в процентах."""
+        return round(float(self.conf.mean()) * 100, 1) if len(self) else 0
+
+    def merge(self, other, iou_threshold=0.5):
+        """Объединяет с детекциями другого прогона, убирая дубликаты.
+
+        Дубликат — тот же класс и IoU > порога; остаётся бокс с большей уверенностью.
+        Матрица IoU считается векторно, порядок разрешения — как у последовательного слияния.
+        """
+        if not len(other):
+            return self
+        if not len(self):
+            return other
+        combined = DetectionSet.concat([self, other], names=self.names)
+        n_self = len(self)
+        ious = iou_matrix(combined.boxes, other.boxes)
+
+        merged = list(range(n_self))
+        for k in range(len(other)):
+            candidates = np.asarray(merged)
+            same = (ious[candidates, k] > iou_threshold) & (combined.cls[candidates] == other.cls[k])
+            hits = np.flatnonzero(same)
+            if hits.size:
+                i = int(hits[0])
+                if other.conf[k] > combined.conf[candidates[i]]:
+                    merged[i] = n_self + k
+            else:
+                merged.append(n_self + k)
+        return combined[np.asarray(merged)]
+
+    def to_dicts(self):
+        """Формат API: список словарей class / class_name / bbox / confidence / source [/ page]."""
+        names = self.class_names()
+        extras = {key: values.tolist() for key, values in self.extras.items()}
+        out = []
+        for i, (box, cls, conf, page, source) in enumerate(zip(
+                self.boxes.tolist(), self.cls.tolist(), self.conf.tolist(),
+                self.page.tolist(), self.source.tolist())):
+            det = {
+                'class': cls,
+                'class_name': names[i],
+                'bbox': box,
+                'confidence': conf,
+                'source': self.SOURCES[source]
+            }
+            for key, values in extras.items():
+                if values[i] is not None:
+                    det[key] = values[i]
+            if page:
+                det['page'] = page
+            out.append(det)
+        return out
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """IoU каждого бокса из boxes_a (N x 4) с каждым из boxes_b (M x 4) -> N x M."""
+    a = boxes_a[:, None, :]
+    b = boxes_b[None, :, :]
+    inter_w = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    inter_h = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = inter_w * inter_h
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    union = area_a + area_b - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
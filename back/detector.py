@@ -2,9 +2,21 @@ import cv2
 import numpy as np
 import torch
 from ultralytics import YOLO
+from functools import lru_cache
 from pathlib import Path
 import time
 
+try:
+    from .blank_pages import is_blank
+    from .detections import DetectionSet
+    from .metrics import metrics
+    from .qr import annotate_qr_detections, decode_qr_codes
+except ImportError:
+    from blank_pages import is_blank
+    from detections import DetectionSet
+    from metrics import metrics
+    from qr import annotate_qr_detections, decode_qr_codes
+
 _original_load = torch.load
 
 def patched_load(*args, **kwargs):
@@ -16,16 +28,31 @@ torch.load = patched_load
 
 
 class DocumentDetector:
-    def __init__(self, model_path, conf_threshold=0.5):
+    def __init__(self, model_path, conf_threshold=0.5, page_cache=None, qr_decode=True, version=None,
+                 raw_floor=0.05, merge_iou=0.5, orienter=None, blank_threshold=0.0):
         """
         Инициализация детектора одной моделью
         
         Args:
             model_path: путь к модели
             conf_threshold: порог уверенности
+            page_cache: PageCache для повторяющихся страниц (None — без кэша)
+            qr_decode: декодировать QR-коды через OpenCV
+            version: версия модели — часть ключа кэша страниц (общий кэш для нескольких версий)
+            raw_floor: нижний порог сырых предсказаний (conf ниже него refine() уже не покажет)
+            merge_iou: порог IoU слияния прогонов по умолчанию
+            orienter: PageOrienter — поворот и выравнивание страницы перед инференсом (None — без него)
+            blank_threshold: порог пустой страницы (см. blank_pages.is_blank); пустые не идут в модель, 0 — без проверки
         """
         self.model = YOLO(model_path)
+        self.version = version or Path(model_path).stem
         self.conf_threshold = conf_threshold
+        self.raw_floor = min(float(raw_floor), float(conf_threshold))
+        self.merge_iou = merge_iou
+        self.page_cache = page_cache
+        self.orienter = orienter
+        self.blank_threshold = blank_threshold
+        self.qr_decode = qr_decode
         
         model_class_names = self.model.names
         print(f"Model classes: {model_class_names}")
@@ -53,6 +80,7 @@ class DocumentDetector:
             raw_names = list(model_class_names)
 
         self.class_names = [_canonicalize(n) for n in raw_names]
+        self.qr_class = self.class_names.index('qr_code') if 'qr_code' in self.class_names else 2
         
         print(f"Model loaded: {model_path}")
         print(f"Classes: {self.class_names}")
@@ -77,172 +105,299 @@ class DocumentDetector:
         """Returns inverted image (BGR)."""
         return cv2.bitwise_not(image)
     
-    def detect(self, image):
-        """Runs detection on original and inverted images and merges results."""
+    def detect(self, image, classes=None, roi=None, conf=None, iou=None):
+        """Runs detection on original and inverted images and merges results.
+
+        Args:
+            image: страница (BGR)
+            classes: имена нужных классов; ['qr_code'] — быстрый путь без YOLO
+            roi: (x1, y1, x2, y2) в долях страницы (уже повёрнутой ровно) — инференс только по этой области
+            conf: порог уверенности (None — conf_threshold)
+            iou: порог IoU слияния прогонов (None — merge_iou)
+
+        Returns:
+            dict со статистикой; 'detections' — DetectionSet (в JSON — через to_dicts()),
+            'raw' — сырые предсказания страницы для refine() без повторного инференса,
+            'orientation' — если страница была повёрнута/выровнена, 'blank' — пустая страница
+            (модель не вызывалась). Координаты — всегда в исходной странице.
+        """
+        if self._is_blank(image):
+            return self._blank_result(time.time())
+        page = image
+        image, orientation, offset = self._prepare(page, roi)
+
+        if classes and set(classes) == {'qr_code'} and self.qr_decode:
+            result = self._shift_result(self.detect_qr(image), offset)
+            result['detections'] = self._to_page(result['detections'], orientation, page)
+            result['raw'] = result['detections']
+            return self._with_orientation(result, orientation)
+
         start_time = time.time()
-        
-        detections_original = self._detect_on_image(image, "original")
-        
-        inverted = self._create_inverted_image(image)
-        detections_inverted = self._detect_on_image(inverted, "inverted")
-        
-        all_detections = self._merge_detections(detections_original, detections_inverted)
-        
-        processing_time = (time.time() - start_time) * 1000
-        stats = self._calculate_stats(all_detections)
+        raw, cache_hit = self._raw_page(image)
+        raw = self._page_raw(raw, page, orientation, offset)
+        detections = self.refine(raw, page, classes=classes, conf=conf, iou=iou)
+        result = self._build_result(detections, start_time, cache_hit)
+        result['raw'] = raw
+        return self._with_orientation(result, orientation)
+    
+    def detect_batch(self, images, classes=None, roi=None, conf=None, iou=None):
+        """Батч-детекция для офлайн-обработки: страницы и их инверсии идут в модель одним predict.
+
+        Опции и обработка страниц (пустые, ориентация, ROI, кэш, слияние) — как в detect();
+        processing_time_ms — доля страницы во времени батча.
+
+        Returns:
+            список результатов в формате detect(), по одному на изображение
+        """
+        if not images:
+            return []
+        if classes and set(classes) == {'qr_code'} and self.qr_decode:
+            # Модель не вызывается — батчить нечего, путь тот же, что у detect()
+            return [self.detect(image, classes=classes, roi=roi) for image in images]
+        start_time = time.time()
+        pages = images
+        blank = [self._is_blank(image) for image in pages]
+        prepared = [(None, None, (0, 0)) if skip else self._prepare(page, roi) for page, skip in zip(pages, blank)]
+        images = [image for image, _, _ in prepared]
+        
+        found, tokens = [None] * len(images), [None] * len(images)
+        for i, skip in enumerate(blank):
+            if skip:
+                found[i] = DetectionSet.empty(self.class_names)
+            elif self.page_cache is not None:
+                found[i], tokens[i] = self.page_cache.lookup(images[i], self._raw_variant)
+        cache_hits = [raw is not None and not skip for raw, skip in zip(found, blank)]
+        
+        todo = [i for i, raw in enumerate(found) if raw is None]
+        if todo:
+            batch = [self._enhance_image(images[i]) for i in todo]
+            batch += [self._enhance_image(self._create_inverted_image(images[i])) for i in todo]
+            results = self.model.predict(
+                source=batch,
+                conf=self.raw_floor,
+                verbose=False,
+                agnostic_nms=True
+            )
+            for k, i in enumerate(todo):
+                found[i] = DetectionSet.concat([
+                    self._to_detection_set(results[k], "original"),
+                    self._to_detection_set(results[len(todo) + k], "inverted")
+                ], names=self.class_names)
+                if tokens[i] is not None:
+                    self.page_cache.store(tokens[i], found[i])
+        
+        out = []
+        for page, (_, orientation, offset), raw, cache_hit, skip in zip(pages, prepared, found, cache_hits, blank):
+            if skip:
+                out.append(self._blank_result(start_time, pages=len(images)))
+                continue
+            raw = self._page_raw(raw, page, orientation, offset)
+            result = self._build_result(self.refine(raw, page, classes=classes, conf=conf, iou=iou), start_time,
+                                        cache_hit, pages=len(images))
+            result['raw'] = raw
+            out.append(self._with_orientation(result, orientation))
+        return out
+    
+    def refine(self, raw, image=None, classes=None, conf=None, iou=None):
+        """Порог уверенности, фильтр классов и слияние прогонов по сырым предсказаниям — без инференса.
+
+        raw — предсказания обоих прогонов выше raw_floor (результат detect()['raw']),
+        поэтому смена conf / iou / classes стоит миллисекунды. image нужен для
+        декодирования QR (None — без него). Модель делает NMS без фильтра классов,
+        так что с classes бокс может быть подавлен боксом другого класса — как и
+        при agnostic_nms на всех классах.
+        """
+        conf = self.conf_threshold if conf is None else conf
+        iou = self.merge_iou if iou is None else iou
+        keep = raw.conf >= conf
+        class_ids = self._class_ids(classes)
+        if class_ids is not None:
+            keep &= np.isin(raw.cls, class_ids)
+        subset = raw[keep]
+        original = subset[subset.source == DetectionSet.SOURCES.index('original')]
+        inverted = subset[subset.source == DetectionSet.SOURCES.index('inverted')]
+        decoded = subset[subset.source == DetectionSet.SOURCES.index('qr_decoder')]
+
+        merged = original.merge(inverted, iou_threshold=iou)
+        if self.qr_decode and image is not None:
+            merged = annotate_qr_detections(image, merged, self.qr_class)
+        return DetectionSet.concat([merged, decoded], names=self.class_names)
+    
+    def warmup(self, size=640):
+        """Прогон пустой страницы мимо кэша: инициализация весов и ядер до первого запроса."""
+        blank = np.full((size, size, 3), 255, dtype=np.uint8)
+        self._detect_on_image(blank)
+        self._detect_on_image(self._create_inverted_image(blank), "inverted")
+    
+    @property
+    def _raw_variant(self):
+        # В кэше страниц — сырые предсказания: общие для любых conf / iou / classes
+        return (self.version, 'raw', self.raw_floor)
+    
+    def _raw_page(self, image):
+        """Сырые предсказания обоих прогонов: из кэша страниц или инференсом. Возвращает (raw, cache_hit)."""
+        raw, cache_token = None, None
+        if self.page_cache is not None:
+            raw, cache_token = self.page_cache.lookup(image, self._raw_variant)
+        if raw is not None:
+            return raw, True
+        raw = DetectionSet.concat([
+            self._detect_on_image(image, "original"),
+            self._detect_on_image(self._create_inverted_image(image), "inverted")
+        ], names=self.class_names)
+        if cache_token is not None:
+            self.page_cache.store(cache_token, raw)
+        return raw, False
+    
+    def _is_blank(self, image):
+        if not self.blank_threshold or not is_blank(image, self.blank_threshold):
+            return False
+        metrics.incr('blank_pages_skipped')
+        return True
+    
+    def _blank_result(self, start_time, pages=1):
+        """Результат пустой страницы: ни ориентации, ни CLAHE, ни прогонов модели."""
+        empty = DetectionSet.empty(self.class_names)
+        result = self._build_result(empty, start_time, False, pages=pages)
+        result['raw'] = empty
+        result['blank'] = True
+        return result
+    
+    def _prepare(self, page, roi=None):
+        """Изображение для инференса: поворот/выравнивание, затем ROI. Возвращает (изображение, orientation, (dx, dy))."""
+        image, orientation = self._correct(page)
+        offset = (0, 0)
+        if roi is not None:
+            image, offset = self._crop_roi(image, roi)
+        return image, orientation, offset
+
+    def _page_raw(self, raw, page, orientation, offset):
+        """Предсказания по изображению из _prepare() -> координаты исходной страницы."""
+        if offset != (0, 0):
+            raw = raw.transformed(dx=offset[0], dy=offset[1])
+        return self._to_page(raw, orientation, page)
+
+    def _correct(self, image):
+        """Страница, повёрнутая и выровненная для инференса, и Orientation (None — без ориентации)."""
+        if self.orienter is None:
+            return image, None
+        return self.orienter.correct(image)
+    
+    @staticmethod
+    def _to_page(detections, orientation, page):
+        """Боксы с исправленной страницы — обратно в координаты исходной."""
+        if orientation is None:
+            return detections
+        return orientation.to_original(detections, page.shape)
+    
+    @staticmethod
+    def _with_orientation(result, orientation):
+        if orientation is not None and not orientation.identity:
+            result['orientation'] = orientation.to_dict()
+        return result
+    
+    def _class_ids(self, classes):
+        """Имена классов -> индексы модели (None — все классы)."""
+        if not classes:
+            return None
+        return sorted(i for i, name in enumerate(self.class_names) if name in classes)
+    
+    @staticmethod
+    def _crop_roi(image, roi):
+        """Вырезает нормализованную область страницы; возвращает (кроп, (dx, dy))."""
+        h, w = image.shape[:2]
+        x1, y1 = int(roi[0] * w), int(roi[1] * h)
+        x2, y2 = max(x1 + 1, int(round(roi[2] * w))), max(y1 + 1, int(round(roi[3] * h)))
+        return image[y1:y2, x1:x2], (x1, y1)
+    
+    @staticmethod
+    def _shift_result(result, offset):
+        """Переводит координаты детекций из кропа ROI обратно в координаты страницы."""
+        dx, dy = offset
+        if dx or dy:
+            result['detections'] = result['detections'].transformed(dx=dx, dy=dy)
+        return result
+    
+    def detect_qr(self, image):
+        """Только QR-коды: OpenCV detectAndDecodeMulti по всей странице, модель не вызывается."""
+        start_time = time.time()
+        found = decode_qr_codes(image)
+        detections = DetectionSet.from_arrays(
+            [qr['bbox'] for qr in found] or np.empty((0, 4)),
+            [self.qr_class] * len(found),
+            [1.0] * len(found),
+            source='qr_decoder',
+            names=self.class_names
+        )
+        if found:
+            payloads = [qr['payload'] for qr in found]
+            detections = detections.with_extra('payload', payloads)
+            detections = detections.with_extra('qr_verified', [p is not None for p in payloads])
+        return self._build_result(detections, start_time, False)
+    
+    def _build_result(self, detections, start_time, cache_hit, pages=1):
+        processing_time = (time.time() - start_time) * 1000 / pages
         
         return {
             'success': True,
-            'detections': all_detections,
-            'count': len(all_detections),
-            'count_by_class': {
-                'signature': stats['signature'],
-                'stamp': stats['stamp'],
-                'qr_code': stats['qr_code']
-            },
+            'detections': detections,
+            'count': len(detections),
+            'count_by_class': detections.count_by_class(),
             'processing_time_ms': round(processing_time, 2),
-            'avg_confidence': stats['avg_confidence']
+            'avg_confidence': detections.avg_confidence(),
+            'cache_hit': cache_hit
         }
     
     def _detect_on_image(self, image, source_type="original"):
-        """Runs single-model detection on an image."""
+        """Runs single-model detection on an image (все классы, порог raw_floor)."""
         
         processed_image = self._enhance_image(image)
         
-        # Запуск детекции
+        # Низкий порог и все классы: окончательный отбор — в refine()
         results = self.model.predict(
             source=processed_image,
-            conf=self.conf_threshold,
+            conf=self.raw_floor,
             verbose=False,
             agnostic_nms=True
         )
         
-        detections = []
         result = results[0] if isinstance(results, (list, tuple)) else results
-        
-        if hasattr(result, 'boxes') and result.boxes is not None and len(result.boxes) > 0:
-            boxes = result.boxes.xyxy.cpu().numpy()
-            confs = result.boxes.conf.cpu().numpy()
-            classes = result.boxes.cls.cpu().numpy()
-            
-            for box, conf, cls in zip(boxes, confs, classes):
-                detections.append({
-                    'class': int(cls),
-                    'class_name': self.class_names[int(cls)],
-                    'bbox': box.tolist(),
-                    'confidence': float(conf),
-                    'source': source_type
-                })
-        
-        return detections
+        return self._to_detection_set(result, source_type)
     
-    def _merge_detections(self, detections1, detections2, iou_threshold=0.5):
-        """
-        Объединяет детекции с двух источников, убирая дубликаты
-        Оставляет детекцию с большей уверенностью
-        """
-        if not detections2:
-            return detections1
-        if not detections1:
-            return detections2
-        
-        merged = list(detections1)
-        
-        for det2 in detections2:
-            is_duplicate = False
-            
-            for i, det1 in enumerate(merged):
-                # Проверяем IoU (Intersection over Union)
-                iou = self._calculate_iou(det1['bbox'], det2['bbox'])
-                
-                if iou > iou_threshold and det1['class'] == det2['class']:
-                    is_duplicate = True
-                    # Оставляем детекцию с большей уверенностью
-                    if det2['confidence'] > det1['confidence']:
-                        merged[i] = det2
-                    break
-            
-            if not is_duplicate:
-                merged.append(det2)
-        
-        return merged
-    
-    def _calculate_iou(self, box1, box2):
-        """
-        Вычисляет IoU (Intersection over Union) между двумя боксами
-        """
-        x1_1, y1_1, x2_1, y2_1 = box1
-        x1_2, y1_2, x2_2, y2_2 = box2
-        
-        # Координаты пересечения
-        x1_i = max(x1_1, x1_2)
-        y1_i = max(y1_1, y1_2)
-        x2_i = min(x2_1, x2_2)
-        y2_i = min(y2_1, y2_2)
-        
-        # Площадь пересечения
-        if x2_i < x1_i or y2_i < y1_i:
-            intersection = 0
-        else:
-            intersection = (x2_i - x1_i) * (y2_i - y1_i)
-        
-        # Площади боксов
-        area1 = (x2_1 - x1_1) * (y2_1 - y1_1)
-        area2 = (x2_2 - x1_2) * (y2_2 - y1_2)
-        
-        # IoU
-        union = area1 + area2 - intersection
-        
-        if union == 0:
-            return 0
-        
-        return intersection / union
-    
-    def _calculate_stats(self, detections):
-        """Подсчёт статистики"""
-        stats = {
-            'signature': 0,
-            'stamp': 0,
-            'qr_code': 0,
-            'avg_confidence': 0
-        }
-        
-        if not detections:
-            return stats
-        
-        for det in detections:
-            class_name = det['class_name']
-            # На случай, если входящее имя неканоничное (доп. защита)
-            key = class_name
-            if key not in stats:
-                tmp = class_name.strip().lower().replace('-', '_').replace(' ', '_')
-                if tmp in ('qr', 'qrcode'):
-                    key = 'qr_code'
-                elif tmp in ('seal', 'stamp_seal'):
-                    key = 'stamp'
-                elif tmp in ('sign', 'autograph'):
-                    key = 'signature'
-            if key in stats:
-                stats[key] += 1
-        
-        # Средняя уверенность в процентах
-        avg_conf = sum(d['confidence'] for d in detections) / len(detections)
-        stats['avg_confidence'] = round(avg_conf * 100, 1)
+    def _to_detection_set(self, result, source_type):
+        """Результат Ultralytics -> DetectionSet."""
+        if hasattr(result, 'boxes') and result.boxes is not None and len(result.boxes) > 0:
+            return DetectionSet.from_arrays(
+                result.boxes.xyxy.cpu().numpy(),
+                result.boxes.cls.cpu().numpy(),
+                result.boxes.conf.cpu().numpy(),
+                source=source_type,
+                names=self.class_names
+            )
         
-        return stats
+        return DetectionSet.empty(self.class_names)
     
-    def draw_detections(self, image, detections):
+    def draw_detections(self, image, detections, out=None):
         """
         Рисование bounding boxes на изображении
         
         Args:
             image: numpy array
-            detections: список детекций
+            detections: DetectionSet
+            out: буфер той же формы для отрисовки (out is image — рисуем на месте)
         
         Returns:
             изображение с boxes
         """
-        img = image.copy()
+        if out is None:
+            img = image.copy()
+        else:
+            if out is not image:
+                np.copyto(out, image)
+            img = out
+        
+        if not len(detections):
+            return img
         
         colors = {
             0: (0, 0, 255),    # Red
@@ -250,25 +405,24 @@ class DocumentDetector:
             2: (0, 255, 0)     # Green
         }
         
-        for det in detections:
-            x1, y1, x2, y2 = map(int, det['bbox'])
-            cls = det['class']
-            conf = det['confidence']
-            class_name = det['class_name']
+        # Координаты всех боксов приводим к int одной операцией
+        boxes = detections.boxes.astype(np.int32).tolist()
+        
+        for (x1, y1, x2, y2), cls, class_name, conf in zip(
+                boxes, detections.cls.tolist(), detections.class_names(), detections.conf.tolist()):
+            color = colors[cls]
             
             # Рисуем box
-            cv2.rectangle(img, (x1, y1), (x2, y2), colors[cls], 2)
+            cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
             
             # Текст
             label = f"{class_name} {conf:.2f}"
-            (text_w, text_h), _ = cv2.getTextSize(
-                label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 2
-            )
+            text_w, text_h = _label_size(label)
             
             # Фон для текста
             cv2.rectangle(
                 img, (x1, y1 - text_h - 10), 
-                (x1 + text_w, y1), colors[cls], -1
+                (x1 + text_w, y1), color, -1
             )
             
             # Текст
@@ -278,3 +432,10 @@ class DocumentDetector:
             )
         
         return img
+
+
+@lru_cache(maxsize=1024)
+def _label_size(label):
+    """Размер подписи бокса (подписей немного: класс x уверенность с 2 знаками)."""
+    (text_w, text_h), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 2)
+    return text_w, text_h
@@ -1,25 +1,304 @@
+"""Загрузка весов модели: параллельные Range-запросы с докачкой, SHA-256 и атомарная установка.
+
+Скачанные файлы лежат в контент-адресуемом кэше `MODEL_CACHE_DIR/sha256/<digest>`,
+так что несколько версий модели (и несколько путей установки) делят одни байты.
+Прерванная загрузка продолжается с недокачанных кусков; файл по MODEL_PATH
+появляется только целиком и после проверки хэша.
+
+    python back/download_model.py --url https://.../yolov8m_best.pt --sha256 <hex>
+"""
+import argparse
+import hashlib
+import json
 import os
-import requests
-
-MODEL_DIR = os.path.join(os.path.dirname(__file__), "..", "models")
-MODEL_PATH = os.path.join(MODEL_DIR, "yolov8m_best.pt")
-MODEL_URL = os.environ.get("MODEL_URL")
-
-def download_model(url, dst):
-    os.makedirs(os.path.dirname(dst), exist_ok=True)
-    if os.path.exists(dst):
-        print("Model already exists")
-        return
-    print("Downloading model:", url)
-    r = requests.get(url, stream=True)
-    r.raise_for_status()
-    with open(dst, "wb") as f:
-        for chunk in r.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
-    print("Model downloaded:", dst)
-
-if MODEL_URL:
-    download_model(MODEL_URL, MODEL_PATH)
-else:
-    print("MODEL_URL not set, skipping model download")
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+try:
+    from .config import Config
+except ImportError:
+    from config import Config
+
+
+MODEL_PATH = Config.MODEL_PATH
+MODEL_URL = Config.MODEL_URL
+
+_HASH_BLOCK = 4 * 1024 * 1024
+_CHUNK_RETRIES = 3
+
+
+class ChecksumMismatch(ValueError):
+    """Скачанный файл не совпал с ожидаемым SHA-256."""
+
+
+class RangeNotSupported(IOError):
+    """Сервер ответил на Range-запрос всем файлом (200) — куски качать нельзя."""
+
+
+def sha256_file(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(_HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+_session_instance = None
+_session_lock = threading.Lock()
+
+
+def _session():
+    """Общая сессия для кусков; requests импортируется только при реальной загрузке."""
+    global _session_instance
+    with _session_lock:
+        if _session_instance is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=max(4, Config.MODEL_DOWNLOAD_WORKERS))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session_instance = session
+        return _session_instance
+
+
+class _PartialDownload:
+    """Файл `.part` фиксированного размера и JSON-состояние с готовыми кусками (для докачки)."""
+
+    def __init__(self, part_path: Path, size: int, validator: str, chunk_size: int):
+        self.path = part_path
+        self.state_path = part_path.with_name(part_path.name + '.json')
+        self.size = size
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+
+        state = self._read_state()
+        if state.get('size') == size and state.get('validator') == validator \
+                and state.get('chunk_size') == chunk_size and self.path.exists():
+            self.done = set(state.get('done', []))
+        else:
+            # Файл на сервере сменился (или состояния нет) — начинаем заново
+            self.done = set()
+            with open(self.path, 'wb') as handle:
+                handle.truncate(size)
+        self.validator = validator
+        self._save()
+
+    def _read_state(self) -> dict:
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        state = {'size': self.size, 'validator': self.validator,
+                 'chunk_size': self.chunk_size, 'done': sorted(self.done)}
+        tmp = self.state_path.with_name(self.state_path.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as handle:
+            json.dump(state, handle)
+        os.replace(tmp, self.state_path)
+
+    @property
+    def chunk_count(self) -> int:
+        return (self.size + self.chunk_size - 1) // self.chunk_size
+
+    def pending(self) -> list[int]:
+        return [i for i in range(self.chunk_count) if i not in self.done]
+
+    def mark_done(self, index: int):
+        with self._lock:
+            self.done.add(index)
+            self._save()
+
+    def discard(self):
+        for path in (self.path, self.state_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _probe(url: str, timeout: float) -> tuple[Optional[int], bool, str]:
+    """(размер, поддержка Range, валидатор ETag/Last-Modified) по HEAD-запросу.
+
+    Сервер, не принимающий HEAD (405 и т.п.), — (None, False, ''): качаем одним потоком.
+    """
+    try:
+        response = _session().head(url, allow_redirects=True, timeout=timeout)
+        response.raise_for_status()
+    except Exception as e:
+        print(f"HEAD {url} failed ({e}), falling back to a single stream")
+        return None, False, ''
+    size = response.headers.get('Content-Length')
+    ranges = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    validator = response.headers.get('ETag') or response.headers.get('Last-Modified') or ''
+    return (int(size) if size and size.isdigit() else None), ranges, validator
+
+
+def _fetch_chunk(url: str, partial: _PartialDownload, index: int, timeout: float):
+    """Кусок с повторами: обрыв одного соединения не роняет всю загрузку."""
+    for attempt in range(_CHUNK_RETRIES):
+        try:
+            return _fetch_range(url, partial, index, timeout)
+        except RangeNotSupported:
+            raise  # повтор не поможет
+        except Exception:
+            if attempt == _CHUNK_RETRIES - 1:
+                raise
+
+
+def _fetch_range(url: str, partial: _PartialDownload, index: int, timeout: float):
+    start = index * partial.chunk_size
+    end = min(partial.size, start + partial.chunk_size) - 1
+    response = _session().get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True, timeout=timeout)
+    response.raise_for_status()
+    if response.status_code != 206:
+        response.close()  # тело — весь файл, не читаем его
+        raise RangeNotSupported(f'Server ignored Range request for bytes {start}-{end}')
+    written = 0
+    with open(partial.path, 'r+b') as handle:
+        handle.seek(start)
+        for block in response.iter_content(chunk_size=1024 * 1024):
+            handle.write(block)
+            written += len(block)
+    if written != end - start + 1:
+        raise IOError(f'Short read for bytes {start}-{end}: {written}')
+    partial.mark_done(index)
+
+
+def _fetch_stream(url: str, part_path: Path, timeout: float):
+    """Один поток без Range (сервер не умеет) — докачка невозможна, файл пишется заново."""
+    response = _session().get(url, stream=True, timeout=timeout)
+    response.raise_for_status()
+    with open(part_path, 'wb') as handle:
+        for block in response.iter_content(chunk_size=1024 * 1024):
+            handle.write(block)
+
+
+def _fetch_chunks(url: str, partial: _PartialDownload, pending: list[int], workers: int, timeout: float):
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending) or 1)),
+                            thread_name_prefix='model-download') as pool:
+        futures = [pool.submit(_fetch_chunk, url, partial, i, timeout) for i in pending]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def fetch(url: str, sha256: Optional[str] = None, cache_dir=None, workers: Optional[int] = None,
+          chunk_size: Optional[int] = None, timeout: Optional[float] = None) -> Path:
+    """Скачивает url в кэш и возвращает путь `cache_dir/sha256/<digest>`.
+
+    Если sha256 известен и файл уже в кэше — сеть не трогается.
+
+    Raises:
+        ChecksumMismatch: хэш скачанного файла не совпал с sha256 (кусок удаляется)
+    """
+    cache_dir = Path(cache_dir or Config.MODEL_CACHE_DIR)
+    workers = workers or Config.MODEL_DOWNLOAD_WORKERS
+    chunk_size = chunk_size or Config.MODEL_DOWNLOAD_CHUNK_MB * 1024 * 1024
+    timeout = timeout or Config.MODEL_DOWNLOAD_TIMEOUT
+    sha256 = sha256.lower() if sha256 else None
+
+    blobs = cache_dir / 'sha256'
+    if sha256 and (blobs / sha256).exists():
+        return blobs / sha256
+
+    partial_dir = cache_dir / 'partial'
+    blobs.mkdir(parents=True, exist_ok=True)
+    partial_dir.mkdir(parents=True, exist_ok=True)
+    part_path = partial_dir / (hashlib.sha256(url.encode('utf-8')).hexdigest()[:32] + '.part')
+
+    size, ranges, validator = _probe(url, timeout)
+    partial = None
+    if size and ranges:
+        partial = _PartialDownload(part_path, size, validator, chunk_size)
+        pending = partial.pending()
+        print(f"Downloading model: {url} ({size / 1e6:.1f} MB, {len(pending)}/{partial.chunk_count} chunks left)")
+        try:
+            _fetch_chunks(url, partial, pending, workers, timeout)
+        except RangeNotSupported:
+            # HEAD обещал Accept-Ranges, а GET отдаёт файл целиком (CDN, прокси)
+            partial.discard()
+            partial = None
+    if partial is None:
+        print(f"Downloading model: {url} (no Range support, single stream)")
+        _fetch_stream(url, part_path, timeout)
+
+    digest = sha256_file(part_path)
+    if sha256 and digest != sha256:
+        if partial is not None:
+            partial.discard()
+        else:
+            os.remove(part_path)
+        raise ChecksumMismatch(f'SHA-256 mismatch for {url}: expected {sha256}, got {digest}')
+
+    os.replace(part_path, blobs / digest)
+    if partial is not None:
+        partial.discard()
+    return blobs / digest
+
+
+def install(blob: Path, dst) -> Path:
+    """Атомарно ставит файл из кэша по пути dst (жёсткая ссылка, иначе копия)."""
+    dst = Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(dst.name + '.tmp')
+    if tmp.exists():
+        os.remove(tmp)
+    try:
+        os.link(blob, tmp)
+    except OSError:
+        # Другая файловая система или ОС без жёстких ссылок
+        shutil.copyfile(blob, tmp)
+    os.replace(tmp, dst)
+    return dst
+
+
+def download_model(url, dst, sha256: Optional[str] = None, **kwargs) -> Path:
+    """Ставит модель по пути dst; уже установленная проверяется по sha256 (если задан)."""
+    dst = Path(dst)
+    if dst.exists():
+        if not sha256:
+            print("Model already exists")
+            return dst
+        if sha256_file(dst) == sha256.lower():
+            print("Model already exists (SHA-256 verified)")
+            return dst
+        print("Installed model does not match MODEL_SHA256, reinstalling")
+    blob = fetch(url, sha256=sha256, **kwargs)
+    install(blob, dst)
+    print("Model installed:", dst)
+    return dst
+
+
+def ensure_model():
+    """Скачивает модель по MODEL_URL, если её ещё нет (вызывается загрузчиком модели, не при импорте)."""
+    if MODEL_URL:
+        download_model(MODEL_URL, MODEL_PATH, sha256=Config.MODEL_SHA256 or None)
+    else:
+        print("MODEL_URL not set, skipping model download")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download, verify and install YOLO weights.')
+    parser.add_argument('--url', default=MODEL_URL, help='weights URL (default: MODEL_URL)')
+    parser.add_argument('--sha256', default=Config.MODEL_SHA256 or None, help='expected SHA-256 (default: MODEL_SHA256)')
+    parser.add_argument('--dst', default=str(MODEL_PATH), help='install path (default: Config.MODEL_PATH)')
+    parser.add_argument('--workers', type=int, default=Config.MODEL_DOWNLOAD_WORKERS, help='parallel ranged requests')
+    args = parser.parse_args(argv)
+
+    if not args.url:
+        parser.error('MODEL_URL not set and --url not given')
+    download_model(args.url, args.dst, sha256=args.sha256, workers=max(1, args.workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,179 @@
-import os
-import requests
-from typing import Optional, Dict
+import hashlib
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import lru_cache
+from typing import Callable, Optional, Dict, Union
 
-def summarize_with_gemini(
-    api_key: str,
-    text: str,
-    *,
-    model: str = 'gemini-2.5-flash',
-    counts: Optional[Dict[str, int]] = None,
-    language: str = 'ru'
-) -> str:
-  
-    if not api_key:
-        return ''
-    try:
-        import google.generativeai as genai
-    except Exception:
-        return ''
+try:
+    from .lru import BoundedLRU
+    from .metrics import metrics
+except ImportError:
+    from lru import BoundedLRU
+    from metrics import metrics
 
-    counts = counts or {'signature': 0, 'stamp': 0, 'qr_code': 0}
-    text_trimmed = (text[:12000] + '\n...') if text and len(text) > 12000 else (text or '')
-
-    system_rules = (
-        "Ты помощник, который кратко суммаризует ДАННЫЙ текст документа без выдумок. "
-        "Всегда отвечай на русском. Структура ответа: \n"
-        "1) Одно-два предложения: о чём документ (тип, цель, ключевые стороны/даты, если явно указаны).\n"
-        "2) 3-6 буллетов с ключевыми пунктами (обязательства/сроки/суммы/объект работ — только если явно присутствуют).\n"
-        "3) Итог: статус подписания/печати/QR — используй предоставленную статистику детекций, не делай выводов без фактов.\n"
-        "Правила: не выдумывай факты, не делай юридических интерпретаций, если чего-то нет в тексте — напиши 'не указано'."
+
+PERPLEXITY_URL = 'https://api.perplexity.ai/chat/completions'
+
+# Размер фрагмента текста на один запрос к LLM (символов)
+CHUNK_CHARS = 12000
+
+SYSTEM_RULES = (
+    "Ты помощник, который кратко суммаризует ДАННЫЙ текст документа без выдумок. "
+    "Всегда отвечай на русском. Структура ответа: \n"
+    "1) Одно-два предложения: о чём документ (тип, цель, ключевые стороны/даты, если явно указаны).\n"
+    "2) 3-6 буллетов с ключевыми пунктами (обязательства/сроки/суммы/объект работ — только если явно присутствуют).\n"
+    "3) Итог: статус подписания/печати/QR — используй предоставленную статистику детекций, не делай выводов без фактов.\n"
+    "Правила: не выдумывай факты, не делай юридических интерпретаций, если чего-то нет в тексте — напиши 'не указано'."
+)
+
+CHUNK_RULES = (
+    "Ты помощник, который конспектирует ФРАГМЕНТ длинного документа без выдумок. "
+    "Всегда отвечай на русском. Перечисли 3-8 буллетов с фактами из фрагмента: стороны, даты, суммы, сроки, "
+    "обязательства, объект работ — только то, что явно присутствует. Без вступлений и выводов."
+)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Общая HTTP-сессия: keep-alive и пул соединений вместо нового TLS-рукопожатия на запрос.
+
+    requests импортируется при первом обращении к LLM, а не при старте сервиса.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+@lru_cache(maxsize=4)
+def _gemini_model(api_key: str, model: str):
+    """GenerativeModel создаётся один раз на (ключ, модель), а не на каждый запрос."""
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model)
+
+
+def _counts_line(counts: Dict[str, int]) -> str:
+    return (
+        f"Статистика детекций: подписи={counts.get('signature',0)}, печати={counts.get('stamp',0)}, "
+        f"QR={counts.get('qr_code',0)}.\n"
     )
 
-    user_prompt = (
-        f"Статистика детекций: подписи={counts.get('signature',0)}, печати={counts.get('stamp',0)}, QR={counts.get('qr_code',0)}.\n"
-        "Ниже сырой текст документа для суммаризации (используй только его):\n\n" + text_trimmed
+
+def _user_prompt(text: str, counts: Dict[str, int]) -> str:
+    return _counts_line(counts) + "Ниже сырой текст документа для суммаризации (используй только его):\n\n" + (text or '')
+
+
+def _reduce_prompt(partials: list[str], counts: Dict[str, int]) -> str:
+    notes = '\n\n'.join(f"Часть {i + 1}:\n{p}" for i, p in enumerate(partials))
+    return (
+        _counts_line(counts)
+        + "Ниже конспекты частей одного документа по порядку. Составь по ним единое саммари (используй только их):\n\n"
+        + notes
     )
 
+
+def _split_long(text: str, max_chars: int) -> list[str]:
+    """Страница длиннее лимита режется по разделам (пустым строкам), затем по строкам, затем жёстко."""
+    pieces, current = [], ''
+    for block in re.split(r'\n\s*\n', text):
+        parts = [block] if len(block) <= max_chars else (
+            [block[i:i + max_chars] for i in range(0, len(block), max_chars)]
+        )
+        for part in parts:
+            if current and len(current) + len(part) + 2 > max_chars:
+                pieces.append(current)
+                current = ''
+            current = f'{current}\n\n{part}' if current else part
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_chunks(pages: Union[str, list[str]], max_chars: int = CHUNK_CHARS) -> list[str]:
+    """Делит текст на фрагменты до max_chars, не разрывая страницы без необходимости.
+
+    pages — текст по страницам (или одной строкой). Соседние страницы склеиваются,
+    пока помещаются; длинная страница режется по разделам.
+    """
+    if isinstance(pages, str):
+        pages = [pages]
+    chunks, current = [], ''
+    for page in pages:
+        page = (page or '').strip()
+        if not page:
+            continue
+        for piece in ([page] if len(page) <= max_chars else _split_long(page, max_chars)):
+            if current and len(current) + len(piece) + 2 > max_chars:
+                chunks.append(current)
+                current = ''
+            current = f'{current}\n\n{piece}' if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _text_key(text: str) -> str:
+    return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
+
+def map_reduce_summary(complete: Callable[[str, str], str], pages: Union[str, list[str]],
+                       counts: Optional[Dict[str, int]] = None, *, max_chars: int = CHUNK_CHARS,
+                       map_fn=map, chunk_cache=None) -> str:
+    """Саммари документа любой длины через complete(system, user) -> str.
+
+    Короткий текст — один запрос. Длинный: фрагменты конспектируются независимо
+    (map_fn — например, map пула потоков), конспекты сводятся в итоговое саммари;
+    если конспекты сами не помещаются в лимит, сведение повторяется по уровням.
+    chunk_cache (get/put) хранит конспекты фрагментов по хэшу их текста — после
+    правки документа заново уходят в LLM только изменившиеся фрагменты.
+    """
+    counts = counts or {'signature': 0, 'stamp': 0, 'qr_code': 0}
+    chunks = split_chunks(pages, max_chars)
+    if len(chunks) <= 1:
+        return complete(SYSTEM_RULES, _user_prompt(chunks[0] if chunks else '', counts))
+
+    def summarize_chunk(chunk):
+        key = 'chunk|' + _text_key(chunk)
+        cached = chunk_cache.get(key) if chunk_cache is not None else None
+        if cached:
+            metrics.incr('llm_chunk_cache_hits')
+            return cached
+        metrics.incr('llm_chunk_cache_misses')
+        result = complete(CHUNK_RULES, chunk)
+        if result and chunk_cache is not None:
+            chunk_cache.put(key, result)
+        return result
+
+    partials = [p for p in map_fn(summarize_chunk, chunks) if p]
+    while partials and len(_reduce_prompt(partials, counts)) > max_chars and len(partials) > 1:
+        groups = split_chunks(partials, max_chars)
+        if len(groups) >= len(partials):
+            break
+        partials = [p for p in map_fn(summarize_chunk, groups) if p]
+    if not partials:
+        return ''
+    return complete(SYSTEM_RULES, _reduce_prompt(partials, counts))
+
+
+def gemini_complete(api_key: str, system: str, user: str, *, model: str = 'gemini-2.5-flash') -> str:
+    """Один запрос к Gemini; '' — при любой ошибке."""
+    if not api_key:
+        return ''
     try:
-        genai.configure(api_key=api_key)
-        model_client = genai.GenerativeModel(model)
-        resp = model_client.generate_content([
-            system_rules,
-            user_prompt
-        ])
+        model_client = _gemini_model(api_key, model)
+        resp = model_client.generate_content([system, user])
         if hasattr(resp, 'text'):
             return (resp.text or '').strip()
         # SDK shapes can differ; fallback
@@ -56,39 +188,14 @@ def summarize_with_gemini(
         return ''
 
 
-def summarize_with_perplexity(
-    api_key: str,
-    text: str,
-    *,
-    model: str = 'llama-3.1-70b-instruct',
-    counts: Optional[Dict[str, int]] = None,
-    language: str = 'ru'
-) -> str:
+def perplexity_complete(api_key: str, system: str, user: str, *, model: str = 'llama-3.1-70b-instruct',
+                        url: str = PERPLEXITY_URL, timeout: float = 60) -> str:
+    """Один запрос к Perplexity (OpenAI-совместимый chat/completions); '' — при любой ошибке."""
     if not api_key:
         return ''
-
-    counts = counts or {'signature': 0, 'stamp': 0, 'qr_code': 0}
-
-    # Ограничим размер текста для запроса (примерно до 12k символов)
-    text_trimmed = (text[:12000] + '\n...') if text and len(text) > 12000 else (text or '')
-
-    system_rules = (
-        "Ты помощник, который кратко суммаризует ДАННЫЙ текст документа без выдумок. "
-        "Всегда отвечай на русском. Структура ответа: \n"
-        "1) Одно-два предложения: о чём документ (тип, цель, ключевые стороны/даты, если явно указаны).\n"
-        "2) 3-6 буллетов с ключевыми пунктами (обязательства/сроки/суммы/объект работ — только если явно присутствуют).\n"
-        "3) Итог: статус подписания/печати/QR — используй предоставленную статистику детекций, не делай выводов без фактов.\n"
-        "Правила: не выдумывай факты, не делай юридических интерпретаций, если чего-то нет в тексте — напиши 'не указано'."
-    )
-
-    user_content = (
-        f"Статистика детекций: подписи={counts.get('signature',0)}, печати={counts.get('stamp',0)}, QR={counts.get('qr_code',0)}.\n"
-        "Ниже сырой текст документа для суммаризации (используй только его):\n\n" + text_trimmed
-    )
-
     try:
-        resp = requests.post(
-            'https://api.perplexity.ai/chat/completions',
+        resp = get_session().post(
+            url,
             headers={
                 'Authorization': f'Bearer {api_key}',
                 'Content-Type': 'application/json'
@@ -97,11 +204,11 @@ def summarize_with_perplexity(
                 'model': model,
                 'temperature': 0.2,
                 'messages': [
-                    {'role': 'system', 'content': system_rules},
-                    {'role': 'user', 'content': user_content}
+                    {'role': 'system', 'content': system},
+                    {'role': 'user', 'content': user}
                 ]
             },
-            timeout=60
+            timeout=timeout
         )
         resp.raise_for_status()
         data = resp.json()
@@ -109,3 +216,168 @@ def summarize_with_perplexity(
         return content or ''
     except Exception:
         return ''
+
+
+def summarize_with_gemini(
+    api_key: str,
+    text: Union[str, list[str]],
+    *,
+    model: str = 'gemini-2.5-flash',
+    counts: Optional[Dict[str, int]] = None,
+    language: str = 'ru'
+) -> str:
+    """text — строка или список текстов страниц; длинные документы — map-reduce по фрагментам."""
+    if not api_key:
+        return ''
+    return map_reduce_summary(
+        lambda system, user: gemini_complete(api_key, system, user, model=model),
+        text, counts
+    )
+
+
+def summarize_with_perplexity(
+    api_key: str,
+    text: Union[str, list[str]],
+    *,
+    model: str = 'llama-3.1-70b-instruct',
+    counts: Optional[Dict[str, int]] = None,
+    language: str = 'ru',
+    url: str = PERPLEXITY_URL,
+    timeout: float = 60
+) -> str:
+    """text — строка или список текстов страниц; длинные документы — map-reduce по фрагментам."""
+    if not api_key:
+        return ''
+    return map_reduce_summary(
+        lambda system, user: perplexity_complete(api_key, system, user, model=model, url=url, timeout=timeout),
+        text, counts
+    )
+
+
+class SummaryClient:
+    """Саммаризация через LLM-провайдеров с кэшем, склейкой одинаковых запросов и хеджированием.
+
+    - ответы кэшируются по (sha256 текста, счётчики детекций, язык), конспекты фрагментов — по sha256 фрагмента;
+    - одинаковый текст, уже ушедший в LLM, не отправляется повторно — ждём тот же результат;
+    - основной провайдер запускается сразу, запасной — через hedge_delay секунд
+      (0 — оба параллельно), побеждает первый непустой ответ;
+    - длинные документы конспектируются по фрагментам параллельно и сводятся в одно саммари.
+
+    providers — [(имя, complete(system, user) -> str)] по порядку предпочтения вместо
+    Perplexity/Gemini из ключей (другие OpenAI-совместимые эндпоинты, локальная заглушка).
+    """
+
+    def __init__(self, perplexity_key: str = '', perplexity_model: str = 'llama-3.1-70b-instruct',
+                 perplexity_url: str = PERPLEXITY_URL, gemini_key: str = '',
+                 gemini_model: str = 'gemini-2.5-flash', timeout: float = 30,
+                 hedge_delay: float = 2.0, cache_size: int = 256,
+                 chunk_chars: int = CHUNK_CHARS, chunk_workers: int = 4,
+                 providers: Optional[list] = None):
+        self.perplexity_key = perplexity_key
+        self.perplexity_model = perplexity_model
+        self.perplexity_url = perplexity_url
+        self.gemini_key = gemini_key
+        self.gemini_model = gemini_model
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.chunk_chars = chunk_chars
+        self._custom_providers = list(providers) if providers else None
+        self._cache = BoundedLRU(cache_size)
+        self._chunk_cache = BoundedLRU(cache_size * 8)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        # Раздельные пулы: задачи фрагментов сами ждут запросов к провайдерам
+        self._pool = ThreadPoolExecutor(max_workers=2 * chunk_workers + 2, thread_name_prefix='llm')
+        self._chunk_pool = ThreadPoolExecutor(max_workers=chunk_workers, thread_name_prefix='llm-chunk')
+
+    @property
+    def available(self) -> bool:
+        return bool(self._custom_providers or self.perplexity_key or self.gemini_key)
+
+    def _providers(self):
+        if self._custom_providers:
+            return self._custom_providers
+        providers = []
+        if self.perplexity_key:
+            providers.append(('perplexity', lambda system, user: perplexity_complete(
+                self.perplexity_key, system, user, model=self.perplexity_model,
+                url=self.perplexity_url, timeout=self.timeout
+            )))
+        if self.gemini_key:
+            providers.append(('gemini', lambda system, user: gemini_complete(
+                self.gemini_key, system, user, model=self.gemini_model
+            )))
+        return providers
+
+    @staticmethod
+    def cache_key(text: str, counts: Optional[Dict[str, int]], language: str) -> str:
+        counts = counts or {}
+        counts_part = ','.join(f'{name}={counts[name]}' for name in sorted(counts))
+        return f'{_text_key(text)}|{counts_part}|{language}'
+
+    def summarize(self, text: Union[str, list[str]], counts: Optional[Dict[str, int]] = None,
+                  language: str = 'ru') -> str:
+        """Саммари текста (строка или тексты страниц); '' — если ни один провайдер не ответил."""
+        if not self.available:
+            return ''
+        key = self.cache_key(text if isinstance(text, str) else '\f'.join(text), counts, language)
+
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                metrics.incr('llm_cache_hits')
+                return cached
+            pending = self._inflight.get(key)
+            owner = pending is None
+            if owner:
+                pending = Future()
+                self._inflight[key] = pending
+        if not owner:
+            metrics.incr('llm_coalesced')
+            return pending.result()
+
+        metrics.incr('llm_cache_misses')
+        summary = ''
+        try:
+            summary = map_reduce_summary(
+                self._hedged, text, counts,
+                max_chars=self.chunk_chars,
+                map_fn=self._chunk_pool.map,
+                chunk_cache=self._chunk_cache
+            )
+        finally:
+            with self._lock:
+                # Пустой ответ (провайдеры недоступны) не кэшируем — следующий запрос попробует снова
+                if summary:
+                    self._cache.put(key, summary)
+                self._inflight.pop(key, None)
+            pending.set_result(summary)
+        return summary
+
+    def _hedged(self, system: str, user: str) -> str:
+        providers = self._providers()
+        if len(providers) == 1:
+            return providers[0][1](system, user)
+
+        started = time.monotonic()
+        futures = {self._pool.submit(providers[0][1], system, user): providers[0][0]}
+        backups = list(providers[1:])
+        deadline = started + self.timeout
+        while futures:
+            wait_for = deadline - time.monotonic()
+            if backups:
+                wait_for = min(wait_for, started + self.hedge_delay - time.monotonic())
+            done, _ = wait(futures, timeout=max(0.0, wait_for), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures.pop(future)
+                result = future.result()
+                if result:
+                    metrics.incr(f'llm_wins_{name}')
+                    return result
+            # Основной не успел или вернул пусто — подключаем запасного
+            if backups and (not done or not futures):
+                name, call = backups.pop(0)
+                futures[self._pool.submit(call, system, user)] = name
+            if time.monotonic() > deadline:
+                break
+        return ''
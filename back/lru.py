@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+
+class BoundedLRU:
+    """Потокобезопасный LRU-словарь с ограничением по числу записей или по суммарному размеру.
+
+    put(key, value, size) — size в единицах лимита (байты для кэшей по памяти);
+    по умолчанию 1, то есть лимит — число записей. Запись больше всего лимита не
+    сохраняется. Общий для кэшей страниц, ориентации, результатов, превью и LLM.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = max(0, int(limit))
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return default
+            self._entries.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, size: int = 1) -> bool:
+        """Кладёт запись (вытесняя самые давние); False — запись больше лимита и не сохранена."""
+        if size > self.limit:
+            with self._lock:
+                self._pop(key)
+            return False
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, size)
+            self._total += size
+            while self._total > self.limit:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self._total -= dropped
+        return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._pop(key)
+        return default if item is None else item[0]
+
+    def values(self) -> list:
+        """Снимок значений (от давних к свежим) — для перебора без удержания блокировки."""
+        with self._lock:
+            return [value for value, _ in self._entries.values()]
+
+    def _pop(self, key):
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self._total -= item[1]
+        return item
+
+    @property
+    def total(self) -> int:
+        return self._total
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
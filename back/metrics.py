@@ -0,0 +1,36 @@
+import threading
+
+
+class Metrics:
+    """Простые потокобезопасные счётчики процесса (отдаются через /metrics)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """Значение-замер (время старта и т.п.), а не счётчик."""
+        with self._lock:
+            self._counters[name] = value
+
+    def get(self, name, default=0):
+        with self._lock:
+            return self._counters.get(name, default)
+
+    def ratio(self, hits_name, misses_name):
+        """Доля попаданий hits / (hits + misses), 0 если событий не было."""
+        with self._lock:
+            hits = self._counters.get(hits_name, 0)
+            total = hits + self._counters.get(misses_name, 0)
+        return round(hits / total, 4) if total else 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+metrics = Metrics()
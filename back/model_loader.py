@@ -0,0 +1,76 @@
+import threading
+import time
+from typing import Any, Callable, Optional
+
+try:
+    from .metrics import metrics
+except ImportError:
+    from metrics import metrics
+
+
+class ModelNotReady(RuntimeError):
+    """Модель ещё загружается или не загрузилась (ответ 503)."""
+
+
+class ModelLoader:
+    """Загрузка модели в фоновом потоке.
+
+    Сервис начинает отвечать на /health сразу после импорта; запросы, которым нужна
+    модель, ждут готовности через get(). Время загрузки пишется в метрики
+    (`<name>_load_ms`), ошибка загрузки — в status() для /ready.
+    """
+
+    def __init__(self, factory: Callable[[], Any], name: str = 'model'):
+        self._factory = factory
+        self.name = name
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._thread = None
+        self._value = None
+        self.state = 'idle'  # idle -> loading -> ready | failed
+        self.error = None
+
+    def start(self) -> 'ModelLoader':
+        """Запускает загрузку (повторный вызов ничего не делает)."""
+        with self._lock:
+            if self._thread is None:
+                self.state = 'loading'
+                self._thread = threading.Thread(target=self._load, name=f'{self.name}-loader', daemon=True)
+                self._thread.start()
+        return self
+
+    def _load(self):
+        started = time.perf_counter()
+        try:
+            self._value = self._factory()
+            self.state = 'ready'
+        except Exception as e:
+            self.error = f'{type(e).__name__}: {e}'
+            self.state = 'failed'
+            print(f"Failed to load {self.name}: {self.error}")
+        finally:
+            metrics.set(f'{self.name}_load_ms', round((time.perf_counter() - started) * 1000, 1))
+            self._done.set()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == 'ready'
+
+    def get(self, timeout: Optional[float] = None):
+        """Загруженное значение; ждёт до timeout секунд, иначе ModelNotReady."""
+        self.start()
+        self._done.wait(timeout)
+        if self.state == 'ready':
+            return self._value
+        if self.state == 'failed':
+            raise ModelNotReady(f'Model failed to load: {self.error}')
+        raise ModelNotReady('Model is still loading, retry later')
+
+    def status(self) -> dict:
+        data = {'state': self.state}
+        if self.error:
+            data['error'] = self.error
+        load_ms = metrics.get(f'{self.name}_load_ms', None)
+        if load_ms is not None:
+            data['load_time_ms'] = load_ms
+        return data
@@ -0,0 +1,240 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+try:
+    from .detections import iou_matrix
+    from .metrics import metrics
+except ImportError:
+    from detections import iou_matrix
+    from metrics import metrics
+
+
+class UnknownModel(KeyError):
+    """Запрошенная версия модели не загружена (ответ 404)."""
+
+    def __str__(self):
+        return self.args[0] if self.args else 'Unknown model version'
+
+
+class ModelRegistry:
+    """Загруженные версии модели: активная, закреплённые запросом (model=...) и теневая.
+
+    Новая версия грузится и прогревается в фоне, затем активируется подменой
+    ссылки под блокировкой — запросы в полёте дорабатывают на своей версии,
+    следующие идут на новую. Теневая версия прогоняется на доле трафика
+    (shadow_rate) в отдельном потоке, её расхождения с активной — в status().
+    """
+
+    def __init__(self, factory: Callable[[str, str], Any], shadow_log_size: int = 100):
+        self._factory = factory  # (version, model_path) -> детектор
+        self._lock = threading.Lock()
+        self._models = {}        # version -> детектор
+        self._info = {}          # version -> {'state', 'path', 'loaded_at', 'load_time_ms', 'error'}
+        self.active_version = None
+        self.shadow_version = None
+        self.shadow_rate = 0.0
+        self._shadow_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shadow')
+        # Не больше одного теневого прогона в очереди: при нагрузке лишние пропускаются
+        self._shadow_slot = threading.BoundedSemaphore(1)
+        self._shadow_log = deque(maxlen=shadow_log_size)
+
+    def load(self, version: str, model_path: str, activate: bool = False):
+        """Загружает и прогревает версию (синхронно); activate — сразу сделать активной."""
+        info = {'state': 'loading', 'path': str(model_path)}
+        with self._lock:
+            self._info[version] = info
+        return self._load(version, model_path, info, activate)
+
+    def _load(self, version: str, model_path: str, info: dict, activate: bool):
+        """info — запись _info этой загрузки: если её заменили или выгрузили (unload), результат отбрасывается."""
+        with self._lock:
+            info['path'] = str(model_path)
+        started = time.perf_counter()
+        try:
+            detector = self._factory(version, str(model_path))
+            if hasattr(detector, 'warmup'):
+                detector.warmup()
+        except Exception as e:
+            with self._lock:
+                info.update(state='failed', error=f'{type(e).__name__}: {e}')
+            raise
+        load_ms = round((time.perf_counter() - started) * 1000, 1)
+        with self._lock:
+            if self._info.get(version) is not info:
+                metrics.incr('model_loads_cancelled')
+                return None
+            self._models[version] = detector
+            self._info[version] = {
+                'state': 'ready',
+                'path': str(model_path),
+                'loaded_at': datetime.now().isoformat(),
+                'load_time_ms': load_ms,
+            }
+            if activate or self.active_version is None:
+                self.active_version = version
+        metrics.incr('model_loads')
+        return detector
+
+    def load_async(self, version: str, model_path: Optional[str] = None, resolve: Optional[Callable[[], str]] = None,
+                   activate: bool = False) -> threading.Thread:
+        """Загрузка в фоновом потоке; resolve() — получить путь к весам (скачивание) перед загрузкой."""
+        with self._lock:
+            if self._info.get(version, {}).get('state') == 'loading':
+                raise ValueError(f'Model version {version} is already loading')
+            info = {'state': 'loading', 'path': str(model_path or '')}
+            self._info[version] = info
+
+        def run():
+            try:
+                path = resolve() if resolve is not None else model_path
+                with self._lock:
+                    if self._info.get(version) is not info:
+                        return  # выгружена, пока скачивалась
+                self._load(version, path, info, activate)
+            except Exception as e:
+                # Запись могли уже выгрузить (unload) — обновляется только своя
+                with self._lock:
+                    info.update(state='failed', error=f'{type(e).__name__}: {e}')
+                print(f"Failed to load model {version}: {e}")
+
+        thread = threading.Thread(target=run, name=f'model-load-{version}', daemon=True)
+        thread.start()
+        return thread
+
+    def get(self, version: Optional[str] = None):
+        """Детектор версии (None — активной)."""
+        with self._lock:
+            version = version or self.active_version
+            detector = self._models.get(version)
+        if detector is None:
+            raise UnknownModel(f'Model version is not loaded: {version}')
+        return detector
+
+    def activate(self, version: str):
+        with self._lock:
+            if version not in self._models:
+                raise UnknownModel(f'Model version is not loaded: {version}')
+            self.active_version = version
+            if self.shadow_version == version:
+                self.shadow_version = None
+                self.shadow_rate = 0.0
+                self._shadow_log.clear()
+        metrics.incr('model_swaps')
+
+    def unload(self, version: str):
+        """Выгружает версию; активную выгрузить нельзя (ValueError).
+
+        Версия, которая ещё грузится, отменяется: загрузка завершится без регистрации.
+        """
+        with self._lock:
+            if version == self.active_version:
+                raise ValueError('Cannot unload the active model version')
+            if version not in self._info:
+                raise UnknownModel(f'Model version is not loaded: {version}')
+            self._models.pop(version, None)
+            self._info.pop(version, None)
+            if self.shadow_version == version:
+                self.shadow_version = None
+
+    def set_shadow(self, version: Optional[str], rate: float = 0.1):
+        """Теневая версия на доле запросов rate (0..1); version=None — выключить."""
+        with self._lock:
+            if version is not None and version not in self._models:
+                raise UnknownModel(f'Model version is not loaded: {version}')
+            if version is not None and version == self.active_version:
+                raise ValueError('Shadow version must differ from the active one')
+            self.shadow_version = version
+            self.shadow_rate = min(1.0, max(0.0, float(rate))) if version else 0.0
+            self._shadow_log.clear()
+
+    def maybe_shadow(self, version: str, pages: list, results: list, classes=None, roi=None):
+        """С вероятностью shadow_rate прогоняет теневую версию на тех же страницах (в фоне).
+
+        version — версия, которая обработала запрос: сравнение только с активной.
+        pages — (номер, изображение) по страницам; читаются в фоне по одной, а не копятся заранее.
+        """
+        with self._lock:
+            shadow_version, rate = self.shadow_version, self.shadow_rate
+            shadow = self._models.get(shadow_version) if shadow_version else None
+            primary_version = self.active_version
+        if shadow is None or version != primary_version or random.random() >= rate:
+            return None
+        if not self._shadow_slot.acquire(blocking=False):
+            metrics.incr('shadow_skipped')
+            return None
+        primary = [res['detections'] for res in results]
+        return self._shadow_pool.submit(self._compare, shadow_version, shadow, pages, primary, classes, roi)
+
+    def _compare(self, shadow_version, shadow, pages, primary, classes, roi):
+        started = time.perf_counter()
+        try:
+            candidate = [shadow.detect(image, classes=classes, roi=roi)['detections'] for _, image in pages]
+        except Exception as e:
+            metrics.incr('shadow_errors')
+            self._shadow_log.append({'version': shadow_version, 'error': str(e)})
+            return None
+        finally:
+            self._shadow_slot.release()
+        matched = sum(_matched(a, b) for a, b in zip(primary, candidate))
+        total_primary = sum(len(d) for d in primary)
+        total_shadow = sum(len(d) for d in candidate)
+        record = {
+            'version': shadow_version,
+            'pages': len(candidate),
+            'primary_count': total_primary,
+            'shadow_count': total_shadow,
+            'matched': matched,
+            # Доля совпавших боксов (IoU >= 0.5, тот же класс) от объединения двух ответов
+            'agreement': round(matched / (total_primary + total_shadow - matched), 4)
+            if total_primary + total_shadow else 1.0,
+            'shadow_time_ms': round((time.perf_counter() - started) * 1000, 1),
+        }
+        self._shadow_log.append(record)
+        metrics.incr('shadow_runs')
+        return record
+
+    def status(self) -> dict:
+        with self._lock:
+            models = {version: dict(info, active=version == self.active_version)
+                      for version, info in self._info.items()}
+            shadow_log = list(self._shadow_log)
+            data = {
+                'active': self.active_version,
+                'models': models,
+                'shadow': {'version': self.shadow_version, 'rate': self.shadow_rate},
+            }
+        runs = [r for r in shadow_log if 'agreement' in r]
+        if runs:
+            data['shadow'].update(
+                runs=len(runs),
+                mean_agreement=round(float(np.mean([r['agreement'] for r in runs])), 4),
+                count_delta=sum(r['shadow_count'] - r['primary_count'] for r in runs),
+                recent=shadow_log[-10:],
+            )
+        return data
+
+
+def _matched(primary, candidate, iou_threshold: float = 0.5) -> int:
+    """Число пар боксов одного класса с IoU >= порога (жадно, без повторов)."""
+    if not len(primary) or not len(candidate):
+        return 0
+    ious = iou_matrix(primary.boxes, candidate.boxes)
+    # Сравнение по именам: у версий может различаться порядок классов
+    names_a = np.array(primary.class_names(), dtype=object)
+    names_b = np.array(candidate.class_names(), dtype=object)
+    ious[names_a[:, None] != names_b[None, :]] = 0.0
+    matched = 0
+    while True:
+        i, j = np.unravel_index(int(np.argmax(ious)), ious.shape)
+        if ious[i, j] < iou_threshold:
+            return matched
+        matched += 1
+        ious[i, :] = 0.0
+        ious[:, j] = 0.0
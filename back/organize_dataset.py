@@ -1,8 +1,278 @@
+"""Подготовка датасета YOLO: разбиение на train/val/test, проверка разметки, манифест.
 
+Примеры:
+    python back/organize_dataset.py "C:/Users/FARAB/Desktop/final dataset" -o dataset
+    python back/organize_dataset.py raw/ -o dataset --seed 7 --mode copy --skip-invalid
+
+Исходная папка обходится один раз (подпапки тоже), разметка ищется рядом с
+изображением или в соседней labels/. Разбиение стратифицировано по классам
+и воспроизводимо (--seed). Файлы по возможности не копируются, а связываются
+(hardlink, на Linux — reflink), иначе копируются в пуле потоков. Манифест
+(<output>/manifest.json) помнит размер и mtime каждого файла и его split:
+повторный запуск обрабатывает только новые и изменённые файлы, а уже
+распределённые изображения остаются в своих split.
+"""
+from __future__ import annotations
+
+import argparse
+import json
 import os
-import shutil
 import random
+import shutil
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+try:
+    from .config import Config
+except ImportError:
+    from config import Config
+
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+SPLITS = ('train', 'val', 'test')
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+# Страта для изображений без объектов (фоновые примеры)
+BACKGROUND = -1
+# Допуск на округление координат при проверке выхода бокса за кадр
+BBOX_EPS = 1e-3
+# Сколько ошибок разметки печатать (все — в манифесте)
+MAX_PRINTED_ERRORS = 20
+
+# ioctl FICLONE (Linux): копия файла, разделяющая блоки с исходным (btrfs, xfs)
+_FICLONE = 0x40049409
+
+
+class Sample:
+    """Изображение датасета и (если есть) его разметка."""
+
+    __slots__ = ('key', 'image', 'label', 'stat', 'label_stat', 'classes', 'errors', 'split', 'name')
+
+    def __init__(self, key: str, image: Path, label: Optional[Path], stat, label_stat):
+        self.key = key  # путь относительно исходной папки, с '/'
+        self.image = image
+        self.label = label
+        self.stat = stat
+        self.label_stat = label_stat
+        self.classes = []  # классы объектов из разметки
+        self.errors = []
+        self.split = None
+        self.name = image.name  # имя в выходной папке (уникальное)
+
+    def fingerprint(self) -> list:
+        """(size, mtime_ns) изображения и разметки — по нему манифест понимает, что файл не менялся."""
+        label = [self.label_stat.st_size, self.label_stat.st_mtime_ns] if self.label_stat else None
+        return [self.stat.st_size, self.stat.st_mtime_ns, label]
+
+
+def scan(source: Path, exclude: Optional[Path] = None) -> list[Sample]:
+    """Один проход по дереву (os.scandir): изображения и .txt-разметка вместе.
+
+    Разметка — файл с тем же именем рядом с изображением или в соседней папке
+    labels/ (раскладка images/ + labels/). exclude — выходная папка, если она
+    лежит внутри исходной.
+    """
+    images = []
+    labels = {}
+    stack = [source]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            print(f"  ⚠️ Пропущена папка {directory}: {e}")
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                path = Path(entry.path)
+                if exclude is None or path.resolve() != exclude:
+                    stack.append(path)
+                continue
+            stem, ext = os.path.splitext(entry.name)
+            ext = ext.lower()
+            if ext in IMAGE_EXTENSIONS:
+                images.append(entry)
+            elif ext == '.txt':
+                labels[(os.path.dirname(entry.path), stem)] = entry
+
+    samples = []
+    for entry in images:
+        directory = os.path.dirname(entry.path)
+        stem = os.path.splitext(entry.name)[0]
+        label = labels.get((directory, stem))
+        if label is None and os.path.basename(directory) == 'images':
+            label = labels.get((os.path.join(os.path.dirname(directory), 'labels'), stem))
+        key = Path(entry.path).relative_to(source).as_posix()
+        samples.append(Sample(
+            key, Path(entry.path),
+            Path(label.path) if label is not None else None,
+            entry.stat(), label.stat() if label is not None else None
+        ))
+    samples.sort(key=lambda sample: sample.key)
+    _assign_names(samples)
+    return samples
+
+
+def _assign_names(samples: list[Sample]):
+    """Одинаковые имена из разных подпапок получают префикс пути (a/b/x.jpg -> a_b_x.jpg)."""
+    counts = Counter(sample.image.name for sample in samples)
+    for sample in samples:
+        if counts[sample.image.name] > 1:
+            sample.name = sample.key.replace('/', '_')
+
+
+def parse_labels(text: str, num_classes: int) -> tuple[np.ndarray, list[str]]:
+    """Разметка YOLO (class cx cy w h, координаты 0..1) -> (классы, ошибки).
+
+    Файл разбирается одним np.array по всем числам; проверки (номер класса,
+    координаты в кадре, положительный размер) — векторно по всем строкам.
+    """
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return np.empty(0, dtype=np.int64), []
+    widths = np.fromiter((len(line.split()) for line in lines), dtype=np.int64, count=len(lines))
+    errors = [f'line {i + 1}: expected 5 values, got {widths[i]}' for i in np.flatnonzero(widths != 5)]
+    rows = [line for line, n in zip(lines, widths) if n == 5]
+    if not rows:
+        return np.empty(0, dtype=np.int64), errors
+    try:
+        values = np.array(' '.join(rows).split(), dtype=np.float64).reshape(-1, 5)
+    except ValueError:
+        return np.empty(0, dtype=np.int64), errors + ['non-numeric values']
+    line_numbers = np.flatnonzero(widths == 5) + 1
+
+    cls, cx, cy, w, h = values.T
+    checks = (
+        ((cls != np.round(cls)) | (cls < 0) | (cls >= num_classes), 'class out of range'),
+        (~np.isfinite(values).all(axis=1), 'non-finite value'),
+        ((w <= 0) | (h <= 0), 'non-positive box size'),
+        ((cx - w / 2 < -BBOX_EPS) | (cy - h / 2 < -BBOX_EPS)
+         | (cx + w / 2 > 1 + BBOX_EPS) | (cy + h / 2 > 1 + BBOX_EPS), 'box outside image'),
+    )
+    bad = np.zeros(len(values), dtype=bool)
+    for mask, message in checks:
+        bad |= mask
+        errors.extend(f'line {int(n)}: {message}' for n in line_numbers[mask])
+    return cls[~bad].astype(np.int64), errors
+
+
+def _validate(sample: Sample, num_classes: int) -> Sample:
+    if sample.label is not None:
+        try:
+            text = sample.label.read_text(encoding='utf-8')
+        except (OSError, UnicodeDecodeError) as e:
+            sample.errors = [f'unreadable label: {e}']
+            return sample
+        classes, sample.errors = parse_labels(text, num_classes)
+        sample.classes = classes.tolist()
+    return sample
+
+
+def _load_manifest(path: Path) -> dict:
+    if not path.exists():
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as handle:
+            manifest = json.load(handle)
+    except (OSError, ValueError):
+        return {}
+    return manifest if manifest.get('version') == MANIFEST_VERSION else {}
+
+
+def _stratum(sample: Sample, frequency: Counter) -> int:
+    """Самый редкий класс изображения: редкие классы расходятся по split пропорционально."""
+    if not sample.classes:
+        return BACKGROUND
+    return min(set(sample.classes), key=lambda cls: (frequency[cls], cls))
+
+
+def split_samples(samples: list[Sample], ratios: tuple[float, float, float], seed: int):
+    """Стратифицированное воспроизводимое разбиение; sample.split уже задан — остаётся на месте.
+
+    Внутри каждой страты новые изображения перемешиваются (random.Random(seed))
+    и добирают те split, которым до целевой доли не хватает больше всего.
+    Равный недобор в страте решается по недобору во всём датасете, а при
+    полном равенстве — случайно (тем же rng): остатки от округления не копятся
+    в одном split от страты к страте.
+    """
+    frequency = Counter(cls for sample in samples for cls in sample.classes)
+    strata = {}
+    for sample in samples:
+        strata.setdefault(_stratum(sample, frequency), []).append(sample)
+
+    rng = random.Random(seed)
+    overall = Counter(sample.split for sample in samples if sample.split is not None)
+    for stratum in sorted(strata):
+        members = strata[stratum]
+        pending = [sample for sample in members if sample.split is None]
+        if not pending:
+            continue
+        rng.shuffle(pending)
+        counts = Counter(sample.split for sample in members if sample.split is not None)
+        total = len(members)
+        for sample in pending:
+            tie_break = {split: rng.random() for split in SPLITS}
+            # Недобор в страте, затем во всём датасете (округление — от ошибок float в долях)
+            sample.split = max(SPLITS, key=lambda split: (
+                round(ratios[SPLITS.index(split)] * total - counts[split], 9),
+                round(ratios[SPLITS.index(split)] * len(samples) - overall[split], 9),
+                tie_break[split]
+            ))
+            counts[sample.split] += 1
+            overall[sample.split] += 1
+
+
+def _reflink(src: Path, dst: Path) -> bool:
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    try:
+        with open(src, 'rb') as source, open(dst, 'wb') as target:
+            fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+    except OSError:
+        dst.unlink(missing_ok=True)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def place_file(src: Path, dst: Path, mode: str = 'link') -> str:
+    """Кладёт файл в датасет: 'link' — hardlink, затем reflink, затем копия; 'copy' — всегда копия.
+
+    Returns:
+        'link' | 'reflink' | 'copy' — чем в итоге сделано
+    """
+    dst.unlink(missing_ok=True)
+    if mode == 'link':
+        try:
+            os.link(src, dst)
+            return 'link'
+        except OSError:
+            pass  # другой диск или ФС без hardlink
+        if _reflink(src, dst):
+            return 'reflink'
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def _destinations(output: Path, sample: Sample, split: str) -> list[tuple[Optional[Path], Path]]:
+    """[(источник, путь в датасете)] для изображения и разметки (источник None — разметки нет)."""
+    stem = os.path.splitext(sample.name)[0]
+    return [
+        (sample.image, output / 'images' / split / sample.name),
+        (sample.label, output / 'labels' / split / f'{stem}.txt'),
+    ]
+
+
+def _remove(output: Path, name: str, split: str):
+    stem = os.path.splitext(name)[0]
+    (output / 'images' / split / name).unlink(missing_ok=True)
+    (output / 'labels' / split / f'{stem}.txt').unlink(missing_ok=True)
 
 
 def organize_dataset(
@@ -10,119 +280,174 @@ def organize_dataset(
     output_dir='dataset',
     train_ratio=0.7,
     val_ratio=0.15,
-    test_ratio=0.15
-):
-  
-    
+    test_ratio=0.15,
+    seed: int = 42,
+    workers: int = 8,
+    mode: str = 'link',
+    num_classes: Optional[int] = None,
+    skip_invalid: bool = False
+) -> Optional[dict]:
+    """Раскладывает source_dir в output_dir/{images,labels}/{train,val,test}.
+
+    skip_invalid — изображения с ошибками в разметке не попадают в датасет
+    (иначе попадают, ошибки — в отчёте и манифесте).
+
+    Returns:
+        манифест ({'files': {путь: {'split', 'classes', 'errors', ...}}, ...}) или None, если изображений нет
+    """
+    source = Path(source_dir)
+    output = Path(output_dir)
+    num_classes = len(Config.CLASS_NAMES) if num_classes is None else num_classes
+    total_ratio = train_ratio + val_ratio + test_ratio
+    if total_ratio <= 0:
+        raise ValueError('split ratios must sum to a positive number')
+    ratios = (train_ratio / total_ratio, val_ratio / total_ratio, test_ratio / total_ratio)
+
     print("🔄 Начинаем разделение датасета...\n")
-    print(f"📁 Исходная папка: {source_dir}\n")
-    
- 
-    if not os.path.exists(source_dir):
-        print(f"❌ ОШИБКА: Папка не найдена: {source_dir}")
-        return
-    
-   
-    for split in ['train', 'val', 'test']:
-        os.makedirs(f'{output_dir}/images/{split}', exist_ok=True)
-        os.makedirs(f'{output_dir}/labels/{split}', exist_ok=True)
-    
-    # Получить все изображения (разные расширения)
-    source_path = Path(source_dir)
-    
-    # Попробовать найти файлы
-    image_files = []
-    extensions = ['*.jpg', '*.JPG', '*.jpeg', '*.JPEG', '*.png', '*.PNG']
-    
+    print(f"📁 Исходная папка: {source}\n")
+    if not source.is_dir():
+        print(f"❌ ОШИБКА: Папка не найдена: {source}")
+        return None
+
+    for split in SPLITS:
+        os.makedirs(output / 'images' / split, exist_ok=True)
+        os.makedirs(output / 'labels' / split, exist_ok=True)
+
     print("🔍 Ищем изображения...")
-    for ext in extensions:
-        found = list(source_path.glob(ext))
-        if found:
-            print(f"  Найдено {len(found)} файлов {ext}")
-            image_files.extend(found)
-    
-    # Если не нашли напрямую, попробовать подпапки
-    if not image_files:
-        print("  ⚠️ Файлы не найдены в корне. Ищем в подпапках...")
-        for ext in extensions:
-            found = list(source_path.rglob(ext))  # recursive!
-            if found:
-                print(f"  Найдено {len(found)} файлов {ext} в подпапках")
-                image_files.extend(found)
-    
-    if not image_files:
-        print(f"\n❌ ОШИБКА: Изображения не найдены в {source_dir}")
-        print("\n📋 Содержимое папки:")
-        for item in source_path.iterdir():
-            print(f"  - {item.name}")
-        return
-    
-    print(f"\n✅ Всего найдено изображений: {len(image_files)}\n")
-    
-    # Перемешать
-    random.shuffle(image_files)
-    
-    # Вычислить размеры splits
-    total = len(image_files)
-    train_count = int(total * train_ratio)
-    val_count = int(total * val_ratio)
-    
-    print(f"📋 Распределение:")
-    print(f"  Train: {train_count} ({train_ratio*100:.0f}%)")
-    print(f"  Val:   {val_count} ({val_ratio*100:.0f}%)")
-    print(f"  Test:  {total - train_count - val_count} ({test_ratio*100:.0f}%)\n")
-    
-    # Распределить по папкам
-    copied_count = {'train': 0, 'val': 0, 'test': 0}
-    
-    for idx, image_file in enumerate(image_files):
-        # Определить split
-        if idx < train_count:
-            split = 'train'
-        elif idx < train_count + val_count:
-            split = 'val'
+    samples = scan(source, exclude=output.resolve())
+    if not samples:
+        print(f"\n❌ ОШИБКА: Изображения не найдены в {source}")
+        return None
+    print(f"✅ Найдено изображений: {len(samples)}, с разметкой: {sum(s.label is not None for s in samples)}\n")
+
+    # Манифест прошлого запуска: неизменённые файлы не проверяются и не перекладываются заново
+    manifest_path = output / MANIFEST_NAME
+    previous = _load_manifest(manifest_path)
+    same_split = previous.get('seed') == seed and previous.get('ratios') == [round(r, 6) for r in ratios]
+    known = previous.get('files', {}) if same_split else {}
+    # Другое число классов — прежняя проверка разметки не годится (split сохраняется)
+    revalidate = previous.get('num_classes') != num_classes
+    changed = []
+    for sample in samples:
+        entry = known.get(sample.key)
+        if entry is not None and not revalidate and entry['fingerprint'] == sample.fingerprint() \
+                and entry['name'] == sample.name:
+            sample.classes, sample.errors, sample.split = entry['classes'], entry['errors'], entry['split']
+        else:
+            changed.append(sample)
+            if entry is not None and entry['name'] == sample.name:
+                sample.split = entry['split']  # изменённый файл остаётся в своём split
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(lambda sample: _validate(sample, num_classes), changed))
+    print(f"📝 Проверено разметок: {len(changed)} (без изменений: {len(samples) - len(changed)})")
+
+    invalid = [sample for sample in samples if sample.errors]
+    if invalid:
+        print(f"  ⚠️ Ошибки в разметке: {len(invalid)} файлов")
+        for sample in invalid[:MAX_PRINTED_ERRORS]:
+            print(f"    {sample.key}: {'; '.join(sample.errors[:3])}")
+    included = []
+    for sample in samples:
+        if skip_invalid and sample.errors:
+            sample.split = None
         else:
-            split = 'test'
-        
-        # Копировать jpg
-        dst_image = f'{output_dir}/images/{split}/{image_file.name}'
-        shutil.copy2(image_file, dst_image)
-        
-        # Копировать txt разметку
-        txt_file = image_file.with_suffix('.txt')
-        if txt_file.exists():
-            dst_label = f'{output_dir}/labels/{split}/{txt_file.name}'
-            shutil.copy2(txt_file, dst_label)
-            copied_count[split] += 1
-        
-        # Прогресс каждые 100 файлов
-        if (idx + 1) % 100 == 0:
-            print(f"  [{idx + 1}/{total}] Обработано...")
-    
-    # Итоги
-    print(f"\n" + "="*50)
+            included.append(sample)
+
+    split_samples(included, ratios, seed)
+
+    # Удалённые из источника, исключённые и переехавшие в другой split
+    current = {sample.key: sample for sample in included}
+    for key, entry in previous.get('files', {}).items():
+        sample = current.get(key)
+        if sample is None or sample.split != entry['split'] or sample.name != entry['name']:
+            _remove(output, entry['name'], entry['split'])
+
+    changed_keys = {sample.key for sample in changed}
+    targets = [
+        (src, dst)
+        for sample in included
+        if sample.key in changed_keys or sample.split != known.get(sample.key, {}).get('split')
+        for src, dst in _destinations(output, sample, sample.split)
+    ]
+    # Разметку, удалённую из источника, убираем и из датасета — иначе изображение учится на старых боксах
+    for _, dst in (target for target in targets if target[0] is None):
+        dst.unlink(missing_ok=True)
+    to_place = [target for target in targets if target[0] is not None]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        methods = Counter(pool.map(lambda item: place_file(*item, mode=mode), to_place))
+    if to_place:
+        print(f"📦 Разложено файлов: {len(to_place)} ({', '.join(f'{m}: {n}' for m, n in methods.items())})")
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'seed': seed,
+        'ratios': [round(r, 6) for r in ratios],
+        'num_classes': num_classes,
+        'files': {
+            sample.key: {
+                'name': sample.name,
+                'split': sample.split,
+                'fingerprint': sample.fingerprint(),
+                'classes': sample.classes,
+                'errors': sample.errors,
+            }
+            for sample in included
+        },
+    }
+    tmp_path = manifest_path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as handle:
+        json.dump(manifest, handle, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+    print("\n" + "=" * 50)
     print("✅ РАЗДЕЛЕНИЕ ЗАВЕРШЕНО!")
-    print("="*50)
-    
-    # Проверка
-    for split in ['train', 'val', 'test']:
-        img_count = len(list(Path(f'{output_dir}/images/{split}').glob('*')))
-        lbl_count = len(list(Path(f'{output_dir}/labels/{split}').glob('*.txt')))
+    print("=" * 50)
+    names = Config.CLASS_NAMES
+    for split in SPLITS:
+        members = [sample for sample in included if sample.split == split]
+        classes = Counter(cls for sample in members for cls in sample.classes)
+        unlabeled = sum(sample.label is None for sample in members)
         print(f"\n{split.upper()}:")
-        print(f"  Изображений: {img_count}")
-        print(f"  Разметок: {lbl_count}")
-        if img_count != lbl_count:
-            print(f"  ⚠️ ВНИМАНИЕ: Количество не совпадает! Возможно не все фото имеют разметку.")
-    
-    print(f"\n📁 Датасет готов: {output_dir}/")
+        print(f"  Изображений: {len(members)}")
+        print(f"  Разметок: {len(members) - unlabeled}")
+        print("  Объектов: " + ', '.join(
+            f"{names[cls] if cls < len(names) else cls}: {count}" for cls, count in sorted(classes.items())
+        ))
+        if unlabeled:
+            print(f"  ⚠️ ВНИМАНИЕ: {unlabeled} фото без разметки (фоновые примеры).")
+
+    print(f"\n📁 Датасет готов: {output}/")
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Split a YOLO dataset into train/val/test and validate labels.')
+    parser.add_argument('source', help='folder with images and YOLO .txt labels (searched recursively)')
+    parser.add_argument('-o', '--output', default='dataset', help='dataset folder (default: dataset)')
+    parser.add_argument('--train', type=float, default=0.7, help='train ratio (default: 0.7)')
+    parser.add_argument('--val', type=float, default=0.15, help='val ratio (default: 0.15)')
+    parser.add_argument('--test', type=float, default=0.15, help='test ratio (default: 0.15)')
+    parser.add_argument('--seed', type=int, default=42, help='split seed (default: 42)')
+    parser.add_argument('--workers', type=int, default=min(8, os.cpu_count() or 1),
+                        help='parallel label checks and copies')
+    parser.add_argument('--mode', choices=('link', 'copy'), default='link',
+                        help='link: hardlink/reflink when possible, copy otherwise (default); copy: always copy')
+    parser.add_argument('--num-classes', type=int, default=len(Config.CLASS_NAMES),
+                        help=f'number of classes (default: {len(Config.CLASS_NAMES)})')
+    parser.add_argument('--skip-invalid', action='store_true', help='leave images with invalid labels out')
+    args = parser.parse_args(argv)
+
+    try:
+        organize_dataset(
+            args.source, args.output,
+            train_ratio=args.train, val_ratio=args.val, test_ratio=args.test,
+            seed=args.seed, workers=args.workers, mode=args.mode,
+            num_classes=args.num_classes, skip_invalid=args.skip_invalid
+        )
+    except ValueError as e:
+        parser.error(str(e))
 
 
 if __name__ == '__main__':
-    # Используем raw string для Windows путей
-    organize_dataset(
-        source_dir=r'C:\Users\FARAB\Desktop\final dataset', 
-        output_dir='dataset',
-        train_ratio=0.7,
-        val_ratio=0.15,
-        test_ratio=0.15
-    )
+    main()
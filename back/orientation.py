@@ -0,0 +1,226 @@
+"""Ориентация и перекос страницы: поворот на 0/90/180/270 и доворот до горизонтальных строк.
+
+Анализ — по проекционным профилям уменьшенной бинаризованной страницы:
+строки текста дают резкий профиль по строкам, поэтому угол с самым резким
+профилем — угол перекоса, а более резкий профиль по столбцам — повёрнутая на
+90° страница. Вверх ногами отличается по краям строк: левый край текста
+ровный, правый — рваный. Решение принимается только с запасом — при сомнении
+страница не поворачивается.
+
+Поворот PDF-страницы (/Rotate) учитывают уже растеризаторы (PyMuPDF, poppler),
+здесь — содержимое, повёрнутое внутри скана.
+"""
+import cv2
+import numpy as np
+
+try:
+    from .lru import BoundedLRU
+    from .metrics import metrics
+    from .page_cache import page_digest
+except ImportError:
+    from lru import BoundedLRU
+    from metrics import metrics
+    from page_cache import page_digest
+
+
+# Перекос меньше этого (градусы) не исправляем: пересэмплирование размывает страницу зря
+MIN_SKEW = 0.3
+# Во сколько раз профиль по столбцам должен быть резче, чтобы считать страницу повёрнутой на 90°
+QUARTER_MARGIN = 1.5
+# Во сколько раз правый край строк должен быть ровнее левого для поворота на 180°
+FLIP_MARGIN = 2.0
+MIN_LINES = 6
+MIN_INK = 0.005
+# Больше точек чернил для профилей не нужно — берём каждую k-ю
+MAX_POINTS = 20000
+
+_ROTATE_CODES = {
+    90: cv2.ROTATE_90_CLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_COUNTERCLOCKWISE,
+}
+
+
+class Orientation:
+    """Исправление страницы: rotation — поворот по часовой (0/90/180/270), skew — доворот (градусы, против часовой)."""
+
+    __slots__ = ('rotation', 'skew')
+
+    def __init__(self, rotation: int = 0, skew: float = 0.0):
+        self.rotation = int(rotation) % 360
+        self.skew = float(skew) if abs(skew) >= MIN_SKEW else 0.0
+
+    @property
+    def identity(self) -> bool:
+        return self.rotation == 0 and self.skew == 0.0
+
+    def matrix(self, shape) -> tuple[np.ndarray, tuple[int, int]]:
+        """Аффинная матрица 3x3 (координаты исходной страницы -> исправленной) и (ширина, высота) результата."""
+        h, w = shape[:2]
+        quarter = {
+            0: [[1, 0, 0], [0, 1, 0]],
+            90: [[0, -1, h], [1, 0, 0]],
+            180: [[-1, 0, w], [0, -1, h]],
+            270: [[0, 1, 0], [-1, 0, w]],
+        }[self.rotation]
+        matrix = np.vstack([np.array(quarter, dtype=np.float64), [0, 0, 1]])
+        size = (h, w) if self.rotation in (90, 270) else (w, h)
+        if self.skew:
+            deskew, size = self._deskew(size)
+            matrix = np.vstack([deskew, [0, 0, 1]]) @ matrix
+        return matrix, size
+
+    def _deskew(self, size) -> tuple[np.ndarray, tuple[int, int]]:
+        """Поворот на skew вокруг центра с расширением холста, чтобы углы страницы не обрезались."""
+        w, h = size
+        deskew = cv2.getRotationMatrix2D((w / 2, h / 2), self.skew, 1.0)
+        cos, sin = abs(deskew[0, 0]), abs(deskew[0, 1])
+        out_size = (int(np.ceil(w * cos + h * sin)), int(np.ceil(w * sin + h * cos)))
+        deskew[0, 2] += out_size[0] / 2 - w / 2
+        deskew[1, 2] += out_size[1] / 2 - h / 2
+        return deskew, out_size
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        """Исправленная копия страницы (или та же страница, если исправлять нечего)."""
+        if self.identity:
+            return image
+        out = cv2.rotate(image, _ROTATE_CODES[self.rotation]) if self.rotation else image
+        if self.skew:
+            deskew, size = self._deskew((out.shape[1], out.shape[0]))
+            out = cv2.warpAffine(out, deskew, size, flags=cv2.INTER_LINEAR,
+                                 borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
+        return out
+
+    def to_original(self, detections, shape):
+        """DetectionSet из координат исправленной страницы в координаты исходной (shape)."""
+        if self.identity:
+            return detections
+        inverse = np.linalg.inv(self.matrix(shape)[0])[:2]
+        return detections.warped(inverse, shape)
+
+    def to_dict(self) -> dict:
+        return {'rotation': self.rotation, 'skew': round(self.skew, 2)}
+
+
+def _ink(image: np.ndarray, max_dim: int) -> np.ndarray:
+    """Уменьшенная бинарная маска «чернил» (1 — текст/линии)."""
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape
+    scale = min(1.0, max_dim / max(h, w))
+    if scale < 1.0:
+        gray = cv2.resize(gray, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    return ink
+
+
+def _rotated(ink: np.ndarray, angle: float) -> np.ndarray:
+    if not angle:
+        return ink
+    h, w = ink.shape
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    return cv2.warpAffine(ink, matrix, (w, h), flags=cv2.INTER_NEAREST, borderValue=0)
+
+
+def _sharpness(ys: np.ndarray, xs: np.ndarray, angle: float) -> float:
+    """Резкость профиля по строкам после поворота на angle: строки текста и промежутки дают большие перепады.
+
+    Поворачиваются координаты пикселей чернил, а не изображение — профиль
+    считается одним bincount.
+    """
+    theta = np.deg2rad(angle)
+    rows = ys * np.cos(theta) - xs * np.sin(theta)  # знак как у cv2.getRotationMatrix2D
+    profile = np.bincount((rows - rows.min()).astype(np.int32)).astype(np.float64)
+    mean = profile.mean()
+    if mean <= 0:
+        return 0.0
+    return float(np.mean(np.diff(profile) ** 2) / (mean * mean))
+
+
+def _search_skew(ys: np.ndarray, xs: np.ndarray, max_skew: float) -> tuple[float, float]:
+    """(угол, резкость): грубый перебор с шагом 1°, затем уточнение с шагом 0.1°."""
+    best = max(((float(angle), _sharpness(ys, xs, angle))
+                for angle in np.arange(-max_skew, max_skew + 1e-6, 1.0)), key=lambda item: item[1])
+    fine = np.arange(best[0] - 0.5, best[0] + 0.51, 0.1)
+    return max(((float(angle), _sharpness(ys, xs, angle)) for angle in fine), key=lambda item: item[1])
+
+
+def _upside_down(ink: np.ndarray) -> bool:
+    """Вверх ногами: правые края строк ровнее левых (для текста слева направо обычно наоборот)."""
+    profile = ink.sum(axis=1)
+    rows = profile > max(1, 0.05 * profile.max())
+    # Границы строк — переходы в маске строк
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], rows.astype(np.int8), [0]])))
+    starts, ends = edges[::2], edges[1::2]
+    lefts, rights = [], []
+    for start, end in zip(starts, ends):
+        if end - start < 2:
+            continue
+        cols = np.flatnonzero(ink[start:end].any(axis=0))
+        lefts.append(cols[0])
+        rights.append(cols[-1])
+    if len(lefts) < MIN_LINES:
+        return False
+    lefts, rights = np.array(lefts), np.array(rights)
+    left_spread = np.median(np.abs(lefts - np.median(lefts)))
+    right_spread = np.median(np.abs(rights - np.median(rights)))
+    min_gap = 0.02 * ink.shape[1]
+    return right_spread * FLIP_MARGIN < left_spread and left_spread - right_spread > min_gap
+
+
+def estimate_orientation(image: np.ndarray, max_dim: int = 800, max_skew: float = 5.0) -> Orientation:
+    """Поворот и перекос страницы по проекционным профилям (несколько миллисекунд на странице)."""
+    ink = _ink(image, max_dim)
+    if ink.mean() < MIN_INK:
+        return Orientation()  # пустая страница — анализировать нечего
+
+    ys, xs = np.nonzero(ink)
+    if len(ys) > MAX_POINTS:
+        step = len(ys) // MAX_POINTS + 1
+        ys, xs = ys[::step], xs[::step]
+    ys, xs = ys.astype(np.float64), xs.astype(np.float64)
+    angle, score = _search_skew(ys, xs, max_skew)
+    # Те же точки после cv2.ROTATE_90_CLOCKWISE: x' = h - 1 - y, y' = x
+    quarter_angle, quarter_score = _search_skew(xs, ink.shape[0] - 1 - ys, max_skew)
+    rotation = 0
+    if quarter_score > score * QUARTER_MARGIN:
+        rotation, angle, ink = 90, quarter_angle, cv2.rotate(ink, cv2.ROTATE_90_CLOCKWISE)
+
+    if _upside_down(_rotated(ink, angle)):
+        rotation += 180
+    return Orientation(rotation, angle)
+
+
+class PageOrienter:
+    """Оценка ориентации с кэшем по SHA-1 страницы: повторяющиеся документы не анализируются заново.
+
+    Ключ — точное содержимое, как у PageCache: у разных страниц с одинаковым
+    dHash свой поворот. В отличие от PageCache ключ не зависит от версии модели и порогов.
+    """
+
+    def __init__(self, max_dim: int = 800, max_skew: float = 5.0, cache_size: int = 2048):
+        self.max_dim = max_dim
+        self.max_skew = max_skew
+        self.cache_size = max(0, int(cache_size))
+        self._cache = BoundedLRU(self.cache_size)
+
+    def orient(self, image: np.ndarray) -> Orientation:
+        key = None
+        if self.cache_size:
+            key = page_digest(image)
+            cached = self._cache.get(key)
+            if cached is not None:
+                metrics.incr('orientation_cache_hits')
+                return cached
+            metrics.incr('orientation_cache_misses')
+
+        orientation = estimate_orientation(image, self.max_dim, self.max_skew)
+        if not orientation.identity:
+            metrics.incr('orientation_corrected')
+        if key is not None:
+            self._cache.put(key, orientation)
+        return orientation
+
+    def correct(self, image: np.ndarray) -> tuple[np.ndarray, Orientation]:
+        """(исправленная страница, Orientation) — Orientation.to_original() вернёт боксы на исходную."""
+        orientation = self.orient(image)
+        return orientation.apply(image), orientation
@@ -0,0 +1,149 @@
+import hashlib
+
+import cv2
+import numpy as np
+
+try:
+    from .lru import BoundedLRU
+    from .metrics import metrics
+except ImportError:
+    from lru import BoundedLRU
+    from metrics import metrics
+
+
+# Число единичных бит для каждого байта — для быстрого расстояния Хэмминга
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+# Миниатюра для проверки похожих страниц: печать или подпись меняет её клетки на десятки уровней,
+# повторное JPEG-сжатие — на единицы
+THUMB_SIZE = 64
+THUMB_TOLERANCE = 8
+
+
+def page_digest(image: np.ndarray) -> bytes:
+    """SHA-1 декодированных пикселей и формы страницы — ключ точного повтора."""
+    digest = hashlib.sha1(repr(image.shape).encode())
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.digest()
+
+
+def page_thumbnail(image: np.ndarray) -> np.ndarray:
+    """Серая миниатюра THUMB_SIZE x THUMB_SIZE (uint8)."""
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (THUMB_SIZE, THUMB_SIZE), interpolation=cv2.INTER_AREA)
+
+
+def page_hash(image: np.ndarray, hash_size: int = 16) -> np.ndarray:
+    """Перцептивный dHash уменьшенной страницы.
+
+    Возвращает упакованные биты (uint8, hash_size*hash_size/8 байт).
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    diff = small[:, 1:] > small[:, :-1]
+    return np.packbits(diff.ravel())
+
+
+def hamming_distances(hashes: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Расстояния Хэмминга от query до каждой строки матрицы hashes (N x bytes)."""
+    return _POPCOUNT[np.bitwise_xor(hashes, query)].sum(axis=1, dtype=np.int32)
+
+
+class PageCache:
+    """LRU-кэш детекций страниц.
+
+    По умолчанию (similarity=1.0) повтор — только точно та же страница: ключ —
+    SHA-1 пикселей. Похожие страницы искать нельзя по одному перцептивному
+    хэшу: страница с печатью и без неё отличаются на несколько бит dHash, а
+    разница между ними — ровно то, что ищет модель. Поэтому при similarity < 1
+    кандидат по dHash (не больше (1 - similarity) доли бит, те же пропорции)
+    принимается, только если его миниатюра ни в одной клетке не отличается
+    больше чем на THUMB_TOLERANCE — повторное сжатие проходит, новая печать нет.
+    """
+
+    def __init__(self, max_entries=512, similarity=1.0, hash_size=16):
+        self.max_entries = max(1, int(max_entries))
+        self.hash_size = hash_size
+        bits = hash_size * hash_size
+        self.max_distance = int(round((1.0 - float(similarity)) * bits))
+        self._entries = BoundedLRU(self.max_entries)
+
+    def lookup(self, image, variant=()):
+        """Ищет похожую страницу.
+
+        Returns:
+            (detections | None, token) — token передаётся в store() при промахе
+        """
+        h, w = image.shape[:2]
+        variant = tuple(variant)
+        fuzzy = self.max_distance > 0
+        digest = page_hash(image, self.hash_size) if fuzzy else None
+        thumb = page_thumbnail(image) if fuzzy else None
+        token = (page_digest(image), (h, w), variant, digest, thumb)
+
+        entry = self._entries.get(_entry_key(token[0], variant))
+        if entry is None and fuzzy and len(self._entries):
+            entry = self._nearest(digest, thumb, (h, w), variant)
+            if entry is not None:
+                self._entries.get(entry['key'])  # отметить как недавно использованную
+
+        if entry is None:
+            metrics.incr('page_cache_misses')
+            return None, token
+
+        metrics.incr('page_cache_hits')
+        return self._rescale(entry, h, w), token
+
+    def store(self, token, detections):
+        content, shape, variant, digest, thumb = token
+        key = _entry_key(content, variant)
+        entry = {
+            'key': key,
+            'hash': digest,
+            'thumb': thumb,
+            'shape': shape,
+            'variant': variant,
+            'detections': detections,
+        }
+        self._entries.put(key, entry)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': metrics.get('page_cache_hits'),
+            'misses': metrics.get('page_cache_misses'),
+            'hit_rate': metrics.ratio('page_cache_hits', 'page_cache_misses'),
+        }
+
+    def _nearest(self, digest, thumb, shape, variant):
+        candidates = [
+            e for e in self._entries.values()
+            if e['variant'] == variant and e['hash'] is not None and _same_aspect(e['shape'], shape)
+        ]
+        if not candidates:
+            return None
+        dists = hamming_distances(np.stack([e['hash'] for e in candidates]), digest)
+        for best in np.argsort(dists, kind='stable').tolist():
+            if dists[best] > self.max_distance:
+                break
+            diff = np.abs(candidates[best]['thumb'].astype(np.int16) - thumb).max()
+            if diff <= THUMB_TOLERANCE:
+                return candidates[best]
+            metrics.incr('page_cache_rejected')
+        return None
+
+    @staticmethod
+    def _rescale(entry, h, w):
+        """DetectionSet из кэша в координатах текущей страницы (новый объект)."""
+        src_h, src_w = entry['shape']
+        return entry['detections'].transformed(sx=w / src_w, sy=h / src_h)
+
+
+def _entry_key(digest, variant):
+    return digest + repr(variant).encode()
+
+
+def _same_aspect(shape_a, shape_b, tolerance=0.01):
+    ha, wa = shape_a
+    hb, wb = shape_b
+    return abs(ha / wa - hb / wb) <= tolerance * (ha / wa)
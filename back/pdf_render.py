@@ -0,0 +1,355 @@
+from __future__ import annotations
+
+import math
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Iterator, Optional
+
+import cv2
+import numpy as np
+
+try:
+    from .config import Config
+    from .cpu import configure_render_worker
+except ImportError:
+    from config import Config
+    from cpu import configure_render_worker
+
+
+# Бэкенды PDF импортируются при первом PDF, а не при импорте модуля (быстрый старт сервиса)
+@lru_cache(maxsize=None)
+def _fitz():
+    """Модуль PyMuPDF или None, если не установлен."""
+    try:
+        import fitz
+        return fitz
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=None)
+def _pdf2image():
+    """Модуль pdf2image или None, если не установлен."""
+    try:
+        import pdf2image
+        return pdf2image
+    except Exception:
+        return None
+
+
+def coarse_long_side() -> int:
+    """Длинная сторона страницы (px) для грубого прохода детекции."""
+    return max(1, int(round(Config.IMAGE_SIZE * Config.PDF_COARSE_SCALE)))
+
+
+def render_policy() -> tuple[int, int]:
+    """(фиксированный DPI или 0, длинная сторона для адаптивного режима)."""
+    return Config.PDF_RENDER_DPI, coarse_long_side()
+
+
+def page_zoom(width_pt: float, height_pt: float, policy: Optional[tuple[int, int]] = None) -> float:
+    """Масштаб (пикселей на пункт PDF) по политике разрешения.
+
+    DPI > 0 — фиксированный, иначе длинная сторона страницы = long_side.
+    """
+    dpi, long_side = policy or render_policy()
+    if dpi > 0:
+        return dpi / 72.0
+    return long_side / max(width_pt, height_pt, 1.0)
+
+
+def _pixmap_to_bgr(pix) -> np.ndarray:
+    arr = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    if pix.n == 1:
+        return cv2.cvtColor(arr, cv2.COLOR_GRAY2BGR)
+    return cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
+
+
+def _pil_to_bgr(pil_img) -> np.ndarray:
+    return cv2.cvtColor(np.asarray(pil_img.convert('RGB')), cv2.COLOR_RGB2BGR)
+
+
+def _contiguous_runs(indices: list[int]) -> list[tuple[int, int]]:
+    """[0, 1, 2, 5] -> [(0, 2), (5, 5)]"""
+    runs = []
+    for idx in indices:
+        if runs and idx == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], idx)
+        else:
+            runs.append((idx, idx))
+    return runs
+
+
+def _render_fitz_page(page, policy: Optional[tuple[int, int]] = None) -> np.ndarray:
+    zoom = page_zoom(page.rect.width, page.rect.height, policy)
+    pix = page.get_pixmap(matrix=_fitz().Matrix(zoom, zoom), alpha=False)
+    return _pixmap_to_bgr(pix)
+
+
+def _open_fitz(source):
+    """Документ по пути (читается с диска по мере надобности) или из байтов."""
+    fitz = _fitz()
+    if isinstance(source, str):
+        return fitz.open(source, filetype='pdf')
+    return fitz.open(stream=source, filetype='pdf')
+
+
+def _render_pages_task(source, indices: list[int], policy: tuple[int, int]) -> list[np.ndarray]:
+    """Задача воркера: открывает документ сам (пул общий для всех документов) и рендерит пачку страниц."""
+    doc = _open_fitz(source)
+    try:
+        return [_render_fitz_page(doc.load_page(i), policy) for i in indices]
+    finally:
+        doc.close()
+
+
+# Один пул растеризации на процесс: запуск spawn-воркеров (~1 с, с повторным импортом
+# __main__) оплачивается один раз, а не на каждый документ; число процессов не растёт
+# с числом потоков, которые одновременно растеризуют PDF (batch_cli, gunicorn --threads).
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def render_pool() -> ProcessPoolExecutor:
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn — чтобы не форкать процесс с уже запущенными потоками torch
+            _render_pool = ProcessPoolExecutor(
+                max_workers=max(1, Config.PDF_RENDER_WORKERS),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=configure_render_worker
+            )
+        return _render_pool
+
+
+def _reset_render_pool(pool: ProcessPoolExecutor):
+    """Сломанный пул (воркер убит) выбрасывается — следующий документ создаст новый."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+class PdfSource:
+    """PDF в памяти или на диске: растеризация страниц и отдельных областей.
+
+    Оба бэкенда (pdf2image и PyMuPDF) рендерят по одной политике разрешения,
+    поэтому размеры страниц не зависят от того, какой из них установлен.
+    Документ по пути (загрузка во временном файле) не копируется ни в память,
+    ни в процессы-воркеры — им передаётся только путь.
+    """
+
+    def __init__(self, raw_bytes: Optional[bytes] = None, path: Optional[str] = None):
+        self._raw_bytes = raw_bytes
+        self.path = path
+        self._upload = None
+        self._doc = None
+        self._page_count = None
+
+    @classmethod
+    def from_upload(cls, upload) -> 'PdfSource':
+        """PDF из SpooledUpload; загрузка закрывается вместе с источником."""
+        source = cls(path=upload.path)
+        source._upload = upload
+        return source
+
+    @property
+    def raw_bytes(self) -> bytes:
+        """Байты документа (для PDF по пути — читаются один раз)."""
+        if self._raw_bytes is None:
+            if self._upload is not None:
+                self._raw_bytes = self._upload.read_bytes()
+            else:
+                with open(self.path, 'rb') as handle:
+                    self._raw_bytes = handle.read()
+        return self._raw_bytes
+
+    @property
+    def _fitz_source(self):
+        return self.path if self.path else self._raw_bytes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._doc is not None:
+            self._doc.close()
+            self._doc = None
+        if self._upload is not None:
+            self._upload.close()
+            self._upload = None
+
+    def _document(self):
+        if self._doc is None:
+            self._doc = _open_fitz(self._fitz_source)
+        return self._doc
+
+    @property
+    def page_count(self) -> int:
+        if self._page_count is None:
+            if _fitz() is not None:
+                self._page_count = self._document().page_count
+            else:
+                pdf2image = _pdf2image()
+                info = (pdf2image.pdfinfo_from_path(self.path) if self.path
+                        else pdf2image.pdfinfo_from_bytes(self._raw_bytes))
+                self._page_count = int(info['Pages'])
+        return self._page_count
+
+    def render_pages(self, pages: Optional[list[int]] = None) -> list[np.ndarray]:
+        """Растеризует страницы (0-based индексы, None — все) в BGR-массивы."""
+        return [image for _, image in self.iter_pages(pages)]
+
+    def iter_pages(self, pages: Optional[list[int]] = None,
+                   workers: Optional[int] = None) -> Iterator[tuple[int, np.ndarray]]:
+        """Отдаёт (index, image) в порядке страниц по мере готовности.
+
+        Длинные документы рендерятся параллельно (Config.PDF_RENDER_WORKERS), так что
+        детекция первой страницы идёт, пока остальные ещё растеризуются.
+        workers — предел параллельности для этого документа (1 — последовательно,
+        когда параллелизм уже есть снаружи, например в batch_cli).
+        """
+        attempts: list[str] = []
+        backends = []
+        if _pdf2image() is not None:
+            backends.append(('pdf2image', self._iter_pdf2image))
+        if _fitz() is not None:
+            backends.append(('PyMuPDF', self._iter_fitz))
+
+        for name, backend in backends:
+            try:
+                stream = backend(pages, workers)
+                first = next(stream)
+            except StopIteration:
+                attempts.append(f'{name} returned no pages')
+                continue
+            except Exception as err:
+                attempts.append(f'{name}: {err}')
+                continue
+            yield first
+            yield from stream
+            return
+
+        details = '; '.join(attempts) if attempts else 'no PDF backends available'
+        raise ValueError(
+            'Cannot convert PDF to image. Install pdf2image + Poppler or PyMuPDF. '
+            f'Details: {details}'
+        )
+
+    @staticmethod
+    def _max_workers(limit: Optional[int] = None) -> int:
+        return Config.PDF_RENDER_WORKERS if limit is None else min(limit, Config.PDF_RENDER_WORKERS)
+
+    def _workers_for(self, page_total: int, limit: Optional[int] = None) -> int:
+        if page_total < Config.PDF_PARALLEL_MIN_PAGES:
+            return 1
+        return max(1, min(self._max_workers(limit), page_total))
+
+    def extract_text_pages(self) -> list[str]:
+        """Текстовый слой по страницам (PyMuPDF); [] — если недоступен."""
+        if _fitz() is None:
+            return []
+        try:
+            doc = self._document()
+            return [(doc.load_page(i).get_text('text') or '').strip() for i in range(doc.page_count)]
+        except Exception:
+            return []
+
+    def extract_text(self) -> str:
+        """Текстовый слой всех страниц одной строкой."""
+        return '\n'.join(tp for tp in self.extract_text_pages() if tp)
+
+    def render_region(self, page_index: int, bbox, page_shape, dpi: Optional[int] = None) -> Optional[np.ndarray]:
+        """Перерисовывает область страницы в высоком разрешении (для кропов).
+
+        bbox — в пикселях грубого рендера размера page_shape. Возвращает None, если
+        высокое разрешение недоступно (нет PyMuPDF) или не даёт выигрыша.
+        """
+        fitz = _fitz()
+        if fitz is None:
+            return None
+        dpi = dpi or Config.PDF_CROP_DPI
+        page = self._document().load_page(page_index)
+        rect = page.rect
+        px_per_pt = page_shape[1] / rect.width
+        zoom = dpi / 72.0
+        if zoom <= px_per_pt * 1.05:
+            return None
+        x1, y1, x2, y2 = (float(v) / px_per_pt for v in bbox)
+        clip = fitz.Rect(rect.x0 + x1, rect.y0 + y1, rect.x0 + x2, rect.y0 + y2) & rect
+        if clip.is_empty:
+            return None
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+        return _pixmap_to_bgr(pix)
+
+    def _iter_fitz(self, pages: Optional[list[int]],
+                   limit: Optional[int] = None) -> Iterator[tuple[int, np.ndarray]]:
+        doc = self._document()
+        indices = list(range(doc.page_count)) if pages is None else list(pages)
+        workers = self._workers_for(len(indices), limit)
+        if workers == 1:
+            for i in indices:
+                yield i, _render_fitz_page(doc.load_page(i))
+            return
+
+        # Процессы, а не потоки: PyMuPDF держит GIL при растеризации. Страницы идут
+        # пачками: документ открывается в воркере один раз на пачку.
+        pool = render_pool()
+        chunk = max(1, math.ceil(len(indices) / (workers * 4)))
+        chunks = [indices[k:k + chunk] for k in range(0, len(indices), chunk)]
+        policy = render_policy()
+        futures = [pool.submit(_render_pages_task, self._fitz_source, part, policy) for part in chunks]
+        try:
+            for part, future in zip(chunks, futures):
+                yield from zip(part, future.result())
+        except BrokenProcessPool:
+            _reset_render_pool(pool)
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def _iter_pdf2image(self, pages: Optional[list[int]],
+                        limit: Optional[int] = None) -> Iterator[tuple[int, np.ndarray]]:
+        # Фиксированный DPI или -scale-to по длинной стороне (pdftoppm считает его постранично)
+        dpi, long_side = render_policy()
+        kwargs = {'dpi': dpi} if dpi > 0 else {'size': long_side}
+        if pages is None and self._max_workers(limit) <= 1:
+            for i, page in enumerate(self._convert(**kwargs)):
+                yield i, _pil_to_bgr(page)
+            return
+
+        indices = list(range(self.page_count)) if pages is None else list(pages)
+        workers = self._workers_for(len(indices), limit)
+        if workers == 1:
+            for first, last in _contiguous_runs(indices):
+                rendered = self._convert(first_page=first + 1, last_page=last + 1, **kwargs)
+                yield from zip(range(first, last + 1), map(_pil_to_bgr, rendered))
+            return
+
+        # Каждая страница — отдельный pdftoppm; потоки ждут подпроцессы без GIL.
+        # (thread_count в pdf2image отдаёт страницы только все разом.)
+        def render_one(i):
+            page = self._convert(first_page=i + 1, last_page=i + 1, **kwargs)[0]
+            return _pil_to_bgr(page)
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            yield from zip(indices, executor.map(render_one, indices))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _convert(self, **kwargs):
+        # convert_from_bytes пишет весь PDF во временный файл на каждый вызов — по пути не нужно
+        pdf2image = _pdf2image()
+        if self.path:
+            return pdf2image.convert_from_path(self.path, **kwargs)
+        return pdf2image.convert_from_bytes(self._raw_bytes, **kwargs)
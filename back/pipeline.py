@@ -0,0 +1,554 @@
+from __future__ import annotations
+
+import random
+import time
+import uuid
+import weakref
+from datetime import datetime
+from typing import Iterator, NamedTuple, Optional
+
+import numpy as np
+
+try:
+    from .config import Config
+    from .detections import DetectionSet
+    from .page_cache import page_digest
+    from .previews import PreviewRenderer, preview_size, to_data_uri
+    from .uploads import UploadTooLarge
+    from .utils import (
+        ImageFrames, build_fallback_summary, build_page_annotations, extract_page_crops, guess_document_type,
+        iter_page_crops, load_pages_from_upload, ocr_text_pages, save_detection_result_pdf,
+        simple_summarize
+    )
+except ImportError:
+    from config import Config
+    from detections import DetectionSet
+    from page_cache import page_digest
+    from previews import PreviewRenderer, preview_size, to_data_uri
+    from uploads import UploadTooLarge
+    from utils import (
+        ImageFrames, build_fallback_summary, build_page_annotations, extract_page_crops, guess_document_type,
+        iter_page_crops, load_pages_from_upload, ocr_text_pages, save_detection_result_pdf,
+        simple_summarize
+    )
+
+
+# Что можно получить из одного прохода детекции (опция запроса outputs=...)
+OUTPUTS = ('annotations', 'summary', 'pdf', 'crops', 'dataset')
+
+RANDOM_SUMMARIES = [
+    "Система работает: всё выглядит корректно.",
+    "Авто-обзор выполнен. Признаков проблем не обнаружено.",
+    "Демо-режим: анализ завершён успешно.",
+    "Обработка завершена. Никаких критичных замечаний."
+]
+
+
+class DecodeError(ValueError):
+    """Загрузку не удалось прочитать как изображение/PDF (ответ 400)."""
+
+
+def build_timings(total_time_ms, page_count, cache_hits):
+    """Тайминги ответа с долей страниц, взятых из кэша."""
+    return {
+        'processing_time_ms': round(total_time_ms, 2),
+        'page_count': page_count,
+        'page_cache_hits': cache_hits,
+        'page_cache_hit_rate': round(cache_hits / page_count, 4) if page_count else 0.0
+    }
+
+
+class PageInfo(NamedTuple):
+    """Страница без пикселей: номер (с 1), размер и SHA-1 содержимого (page_digest)."""
+    number: int
+    width: int
+    height: int
+    digest: bytes
+
+
+class DocumentPages:
+    """Страницы документа: PageInfo в памяти, пиксели — по запросу (image(), images()).
+
+    Кадры многостраничного TIFF/HEIF не хранятся: они заново декодируются из загрузки
+    (ImageFrames.seek), и каждый кадр живёт, только пока его обрабатывают. Страницы PDF
+    и одиночные изображения держатся декодированными. Загрузка удаляется, когда на
+    страницы не остаётся ссылок (документ, запись ResultStore, теневой прогон).
+    """
+
+    def __init__(self, frames: Optional[ImageFrames] = None):
+        self._info = []
+        self._images = {}  # номер -> изображение (только без frames)
+        self._frames = frames
+        if frames is not None:
+            weakref.finalize(self, frames.close)
+
+    def add(self, number: int, image: np.ndarray) -> PageInfo:
+        info = PageInfo(number, image.shape[1], image.shape[0], page_digest(image))
+        self._info.append(info)
+        if self._frames is None:
+            self._images[number] = image
+        return info
+
+    def image(self, number: int) -> np.ndarray:
+        if self._frames is not None:
+            return self._frames.seek(number - 1)
+        return self._images[number]
+
+    def images(self) -> Iterator[tuple[int, np.ndarray]]:
+        """(номер, изображение) по порядку; кадр TIFF/HEIF декодируется, когда до него дошли."""
+        for info in self._info:
+            yield info.number, self.image(info.number)
+
+    def find(self, number: int) -> Optional[int]:
+        """Индекс страницы с номером number или None."""
+        return next((i for i, info in enumerate(self._info) if info.number == number), None)
+
+    @property
+    def nbytes(self) -> int:
+        """Занимаемое место: декодированные страницы или размер загрузки TIFF/HEIF."""
+        if self._frames is not None:
+            return self._frames.size
+        return sum(image.nbytes for image in self._images.values())
+
+    def __len__(self):
+        return len(self._info)
+
+    def __iter__(self) -> Iterator[PageInfo]:
+        return iter(self._info)
+
+    def __getitem__(self, index) -> PageInfo:
+        return self._info[index]
+
+
+class DocumentResult:
+    """Один проход детекции по документу: страницы и детекции по страницам.
+
+    Все представления (аннотации, саммари, PDF, кропы, датасет) выводятся отсюда
+    без повторной загрузки и инференса. Держит PdfSource открытым — закрывать
+    через close() или with.
+    """
+
+    def __init__(self, filename: str, pdf_source=None, detector=None, frames: Optional[ImageFrames] = None):
+        self.filename = filename
+        self.pdf_source = pdf_source
+        self.detector = detector  # версия модели, на которой сделан проход
+        self.pages = DocumentPages(frames)
+        self.results = []    # результаты detector.detect по страницам
+        self.errors = []     # [{'page', 'error'}] — страницы, на которых упала детекция
+        self._result_id = None
+        self._page_texts = None
+        self.stored = None  # None — ещё не сохраняли, False — не поместился в ResultStore
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.pdf_source is not None:
+            self.pdf_source.close()
+            self.pdf_source = None
+
+    @property
+    def is_pdf(self) -> bool:
+        return self.pdf_source is not None
+
+    @property
+    def is_paged(self) -> bool:
+        """Документ со страницами (PDF, многостраничный TIFF/HEIF): у детекций проставляется page."""
+        return self.is_pdf or len(self.pages) > 1 or any(page.number != 1 for page in self.pages)
+
+    @property
+    def result_id(self) -> str:
+        if self._result_id is None:
+            self._result_id = f"result_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        return self._result_id
+
+    @property
+    def model_version(self) -> Optional[str]:
+        return getattr(self.detector, 'version', None)
+
+    @property
+    def detections_by_page(self) -> list[DetectionSet]:
+        return [res['detections'] for res in self.results]
+
+    @property
+    def detections(self) -> DetectionSet:
+        return DetectionSet.concat(self.detections_by_page)
+
+    @property
+    def blank_pages(self) -> list[int]:
+        """Номера пустых страниц — для них модель не вызывалась."""
+        return [page.number for page, res in zip(self.pages, self.results) if res.get('blank')]
+
+    @property
+    def counts(self) -> dict:
+        counts = {'signature': 0, 'stamp': 0, 'qr_code': 0}
+        for res in self.results:
+            for key in counts:
+                counts[key] += res['count_by_class'][key]
+        return counts
+
+    @property
+    def total_time_ms(self) -> float:
+        return sum(res['processing_time_ms'] for res in self.results)
+
+    @property
+    def cache_hits(self) -> int:
+        return sum(int(res['cache_hit']) for res in self.results)
+
+    def page_texts(self) -> list[str]:
+        """Текст по страницам: текстовый слой PDF или OCR изображений (один раз на документ)."""
+        if self._page_texts is None:
+            texts = []
+            if self.is_pdf:
+                all_texts = self.pdf_source.extract_text_pages()
+                texts = [all_texts[page.number - 1] for page in self.pages if page.number - 1 < len(all_texts)]
+            if not any(texts):
+                # Пустые страницы в OCR не отправляем; страницы распознаются по одной,
+                # чтобы в памяти был один рендер высокого разрешения
+                blank = set(self.blank_pages)
+                try:
+                    texts = []
+                    for page in self.pages:
+                        page_text = [] if page.number in blank else ocr_text_pages([self._ocr_image(page)], enhance=True)
+                        texts.append(page_text[0] if page_text else '')
+                except Exception:
+                    texts = []
+            self._page_texts = texts
+        return self._page_texts
+
+    def _ocr_image(self, page: PageInfo) -> np.ndarray:
+        """Страница для OCR: скан PDF перерисовывается целиком в PDF_CROP_DPI, а не берётся грубый рендер детекции."""
+        if self.is_pdf:
+            shape = (page.height, page.width, 3)
+            rendered = self.pdf_source.render_region(page.number - 1, (0, 0, page.width, page.height), shape)
+            if rendered is not None:
+                return rendered
+        return self.pages.image(page.number)
+
+
+class DetectionPipeline:
+    """Загрузка -> растеризация -> детекция по страницам, общее для всех эндпоинтов.
+
+    Детектор — один фиксированный (detector) или версия из ModelRegistry (registry):
+    активная либо закреплённая запросом (model=...).
+    """
+
+    def __init__(self, detector=None, result_store=None, summary_client=None, output_dir=None, registry=None,
+                 previews: Optional[PreviewRenderer] = None, crop_index=None):
+        self.detector = detector
+        self.registry = registry
+        self.previews = previews or PreviewRenderer(
+            max_dim=Config.PREVIEW_MAX_DIM, quality=Config.PREVIEW_QUALITY, fmt=Config.PREVIEW_FORMAT
+        )
+        self.result_store = result_store
+        self.summary_client = summary_client
+        self.output_dir = output_dir or Config.OUTPUT_DIR
+        self.crop_index = crop_index  # CropIndex: поиск повторно использованных подписей/печатей
+
+    def _detector(self, model: Optional[str] = None):
+        if self.registry is not None:
+            return self.registry.get(model)
+        return self.detector
+
+    def run(self, file, filename: str, classes=None, page_ranges=None, roi=None,
+            model: Optional[str] = None, conf: Optional[float] = None, iou: Optional[float] = None) -> DocumentResult:
+        """Один проход детекции; страницы PDF и кадры TIFF/HEIF детектируются по мере декодирования.
+
+        Raises:
+            UnknownModel: версия model не загружена в реестр
+            UploadTooLarge: файл больше Config.MAX_FILE_SIZE
+            DecodeError: файл не читается как изображение/PDF
+        """
+        # Версия фиксируется на весь документ: подмена модели посреди прохода его не затрагивает
+        detector = self._detector(model)
+        try:
+            stream, pdf_source = load_pages_from_upload(
+                file, filename, page_ranges, max_bytes=Config.MAX_FILE_SIZE, keep_frames=True
+            )
+        except UploadTooLarge:
+            raise
+        except Exception as e:
+            raise DecodeError(f'Failed to decode file: {e}') from e
+
+        # Кадры TIFF/HEIF после детекции не хранятся — страницы перечитывают их из загрузки
+        frames = stream if isinstance(stream, ImageFrames) else None
+        doc = DocumentResult(filename, pdf_source, detector, frames)
+        try:
+            for page_num, image in self._decoded(stream):
+                try:
+                    res = detector.detect(image, classes=classes, roi=roi, conf=conf, iou=iou)
+                except Exception as e:
+                    # Упавшая страница не роняет документ: пустой результат + запись в errors
+                    doc.errors.append({'page': page_num, 'error': str(e)})
+                    res = self._empty_result(detector)
+                doc.pages.add(page_num, image)
+                doc.results.append(res)
+        except BaseException:
+            doc.close()
+            raise
+        if doc.is_paged:
+            for page, res in zip(doc.pages, doc.results):
+                res['detections'] = res['detections'].with_page(page.number)
+                res['raw'] = res['raw'].with_page(page.number)
+        if self.registry is not None:
+            self.registry.maybe_shadow(doc.model_version, doc.pages.images(), doc.results, classes=classes, roi=roi)
+        return doc
+
+    @staticmethod
+    def _decoded(stream):
+        """Ошибки растеризации по ходу итерации -> DecodeError (а не ошибка детекции)."""
+        pages = iter(stream)
+        while True:
+            try:
+                item = next(pages)
+            except StopIteration:
+                return
+            except Exception as e:
+                raise DecodeError(f'Failed to decode file: {e}') from e
+            yield item
+
+    @staticmethod
+    def _empty_result(detector):
+        return {
+            'success': True,
+            'detections': DetectionSet.empty(detector.class_names),
+            'count': 0,
+            'count_by_class': {'signature': 0, 'stamp': 0, 'qr_code': 0},
+            'processing_time_ms': 0.0,
+            'avg_confidence': 0,
+            'cache_hit': False,
+            'raw': DetectionSet.empty(detector.class_names)
+        }
+
+    def derive(self, doc: DocumentResult, outputs, inline_crops: bool = False,
+               summary_mode: Optional[str] = None, index_crops: bool = True) -> dict:
+        """Собирает запрошенные представления результата в один словарь ответа.
+
+        index_crops=False — подписи/печати ищутся в индексе кропов, но не добавляются в него.
+        """
+        data = {'page_count': len(doc.pages)}
+        if doc.model_version:
+            data['model_version'] = doc.model_version
+        if doc.errors:
+            data['errors'] = doc.errors
+        blank_pages = doc.blank_pages
+        if blank_pages:
+            data['blank_pages'] = blank_pages
+        data['skipped_pages'] = len(blank_pages)
+
+        annotations = self.annotations(doc)
+        if 'annotations' in outputs:
+            data.update(annotations)
+            # Сохранённый результат: смена порогов через /rethreshold без повторного инференса
+            data.update(self.store(doc))
+            data.update(self.duplicates(doc, index_crops))
+        if 'crops' in outputs:
+            data.update(self.crops(doc, inline_crops))
+        if 'pdf' in outputs:
+            # JSON рядом с PDF — аннотации и (если есть) кропы
+            json_summary = {**annotations, 'crops': data.get('crops', [])}
+            data.update(self.pdf(doc, json_summary))
+        if 'dataset' in outputs:
+            data.update(self.dataset(doc))
+        if 'summary' in outputs:
+            data.update(self.summary(doc, summary_mode))
+        return data
+
+    def annotations(self, doc: DocumentResult) -> dict:
+        detections = doc.detections
+        return {
+            'success': True,
+            'detections': detections.to_dicts(),
+            'count': len(detections),
+            'count_by_class': doc.counts,
+            'processing_time_ms': round(doc.total_time_ms, 2),
+            'avg_confidence': detections.avg_confidence(),
+            'cache_hit': bool(doc.results) and doc.cache_hits == len(doc.results),
+            'timings': build_timings(doc.total_time_ms, len(doc.pages), doc.cache_hits),
+            **self._orientation(doc)
+        }
+
+    @staticmethod
+    def _orientation(doc: DocumentResult) -> dict:
+        """Страницы, которые перед детекцией были повёрнуты/выровнены (боксы — в исходных координатах)."""
+        pages = [{'page': page.number, **res['orientation']}
+                 for page, res in zip(doc.pages, doc.results) if 'orientation' in res]
+        return {'orientation': pages} if pages else {}
+
+    def store(self, doc: DocumentResult) -> dict:
+        """Кладёт результат в ResultStore (один раз на документ): ленивые кропы и /rethreshold."""
+        if self.result_store is None:
+            return {}
+        if doc.stored is None:
+            doc.stored = self.result_store.put(
+                doc.result_id, doc.pages, doc.detections_by_page,
+                pdf_bytes=doc.pdf_source.raw_bytes if doc.is_pdf else None,
+                raw_by_page=[res['raw'] for res in doc.results],
+                model_version=doc.model_version
+            )
+        return {'result_id': doc.result_id} if doc.stored else {}
+
+    def duplicates(self, doc: DocumentResult, index: bool = True) -> dict:
+        """Подписи и печати документа, уже встречавшиеся в прошлых документах; кропы документа идут в индекс.
+
+        У кропа — SHA-1 его страницы: повторная загрузка того же файла не находит сама себя.
+        """
+        if self.crop_index is None or not len(doc.detections):
+            return {}
+        contents = {page.number: page.digest.hex() for page in doc.pages}
+        # Копии кропов: кадр страницы не держится до конца индексации всего документа
+        cut = [(crop_data, crop_image.copy()) for crop_data, crop_image in iter_page_crops(
+            doc.pages.images(), doc.detections_by_page, padding=0, classes=['signature', 'stamp'])]
+        for crop_data, _ in cut:
+            # page нет только у одностраничного изображения
+            crop_data['content'] = contents.get(crop_data.get('page'), contents[doc.pages[0].number])
+        found = self.crop_index.index_document(doc.result_id, doc.filename, cut, doc.model_version, store=index)
+        return {'duplicates': found} if found else {}
+
+    def crops(self, doc: DocumentResult, inline: bool = False) -> dict:
+        """Результат сохраняется для ленивых кропов (/crops/<result_id>); inline — кропы сразу в ответе."""
+        data = self.store(doc)
+        data['crops'] = extract_page_crops(doc.pages.images(), doc.detections_by_page, doc.pdf_source) if inline else []
+        return data
+
+    def rethreshold(self, entry: dict, conf: Optional[float] = None, iou: Optional[float] = None,
+                    classes=None) -> dict:
+        """Аннотации сохранённого результата с другими conf / iou / classes — без растеризации и инференса.
+
+        Raises:
+            UnknownModel: версия, сделавшая проход, уже выгружена
+            ValueError: conf ниже сохранённого нижнего порога raw_floor
+        """
+        detector = self._detector(entry.get('model_version'))
+        if conf is not None and conf < detector.raw_floor:
+            raise ValueError(f'conf must be >= {detector.raw_floor} (stored prediction floor)')
+        started = time.perf_counter()
+        # Страница нужна только для декодирования QR: без него кадры TIFF/HEIF не перечитываются
+        pages = entry['pages'].images() if detector.qr_decode else ((page.number, None) for page in entry['pages'])
+        by_page = [
+            detector.refine(raw, image, classes=classes, conf=conf, iou=iou)
+            for (_, image), raw in zip(pages, entry['raw'])
+        ]
+        detections = DetectionSet.concat(by_page, names=detector.class_names)
+        return {
+            'success': True,
+            'detections': detections.to_dicts(),
+            'count': len(detections),
+            'count_by_class': detections.count_by_class(),
+            'processing_time_ms': round((time.perf_counter() - started) * 1000, 2),
+            'avg_confidence': detections.avg_confidence(),
+            'conf': detector.conf_threshold if conf is None else conf,
+            'iou': detector.merge_iou if iou is None else iou,
+        }
+
+    def pdf(self, doc: DocumentResult, json_summary: dict) -> dict:
+        """PDF с разметкой (по странице на лист) + JSON и превью для фронта."""
+        filename = f"{doc.result_id}.pdf"
+        save_detection_result_pdf(self._annotated_pages(doc), json_summary, self.output_dir, filename)
+        return {'filename': filename, **self.preview_images(doc)}
+
+    @staticmethod
+    def _annotated_pages(doc: DocumentResult):
+        """Страницы с разметкой по одной: рисуются в один буфер, который переиспользуется,
+        пока размер страниц не меняется (память — O(страницы), а не O(документа))."""
+        buffer = None
+        for (_, image), detections in zip(doc.pages.images(), doc.detections_by_page):
+            if buffer is None or buffer.shape != image.shape:
+                buffer = np.empty_like(image)
+            yield doc.detector.draw_detections(image, detections, out=buffer)
+
+    def preview_images(self, doc: DocumentResult) -> dict:
+        """Уменьшенные превью: первая страница — сразу в ответе, остальные — ссылками.
+
+        Страницы после первой кодируются только когда фронт их запросит
+        (/previews/<result_id>/<page>), поэтому длинный документ не превращается
+        в одну огромную картинку.
+        """
+        page_num = doc.pages[0].number
+        image = doc.pages.image(page_num)
+        draw = doc.detector.draw_detections
+        original = self.previews.render(doc.result_id, page_num, image)
+        annotated = self.previews.render(doc.result_id, page_num, image, doc.detections_by_page[0], draw)
+        data = {
+            'image_with_boxes': to_data_uri(annotated['data'], annotated['mime']),
+            'original_image': to_data_uri(original['data'], original['mime']),
+        }
+        if self.store(doc):
+            pages = []
+            for page in doc.pages:
+                width, height = preview_size((page.height, page.width), self.previews.max_dim)
+                pages.append({
+                    'page': page.number,
+                    'width': width,
+                    'height': height,
+                    'url': f'/previews/{doc.result_id}/{page.number}',
+                    'annotated_url': f'/previews/{doc.result_id}/{page.number}?annotated=1',
+                })
+            data['previews'] = pages
+        return data
+
+    def dataset(self, doc: DocumentResult) -> dict:
+        """Схема /detect_dataset: file -> page_N -> annotations, сквозная нумерация аннотаций."""
+        file_root = {}
+        ann_index = 1
+        for page, detections in zip(doc.pages, doc.detections_by_page):
+            entry = build_page_annotations(detections, (page.width, page.height), ann_index)
+            ann_index += len(entry['annotations'])
+            file_root[f'page_{page.number}'] = entry
+        return {
+            'annotations': {doc.filename: file_root},
+            'counts_total': doc.counts
+        }
+
+    def summary(self, doc: DocumentResult, mode: Optional[str] = None) -> dict:
+        """Саммари по Config.SUMMARIZE_MODE: 'counts', 'random' или 'llm' (текст + LLM с фолбэками)."""
+        mode = (mode or Config.SUMMARIZE_MODE or 'counts').lower()
+        counts = doc.counts
+        summary = ''
+
+        if mode == 'random':
+            summary = random.choice(RANDOM_SUMMARIES)
+        elif mode == 'llm':
+            # Текст по страницам: длинные документы саммаризуются по фрагментам, без обрезки
+            page_texts = doc.page_texts()
+            full_text = '\n'.join(t for t in page_texts if t)
+            if self.summary_client is not None and self.summary_client.available:
+                try:
+                    summary = self.summary_client.summarize(page_texts, counts=counts, language='ru') or ''
+                except Exception:
+                    summary = ''
+            if not summary:
+                summary = simple_summarize(full_text or '') or ''
+            if not summary:
+                doc_type, reason = guess_document_type(full_text or '')
+                summary = build_fallback_summary(counts, doc_type, reason)
+        else:
+            summary = self._counts_summary(counts)
+
+        return {
+            'summary': summary,
+            'text_preview': '',
+            'word_count': 0,
+            'count_by_class': counts,
+            'avg_confidence': doc.detections.avg_confidence(),
+            'note': ''
+        }
+
+    @staticmethod
+    def _counts_summary(counts: dict) -> str:
+        # counts-режим: простая логика на основе количества детекций
+        sig = counts['signature']
+        stp = counts['stamp']
+        qr = counts['qr_code']
+        if sig > 0 and stp > 0:
+            return f"Найдено подписей: {sig} и печатей: {stp}. Документ, вероятно, подписан и заверен. QR: {qr}."
+        if sig > 0:
+            return f"Обнаружено подписей: {sig}. Документ, вероятно, подписан. QR: {qr}."
+        if stp > 0:
+            return f"Обнаружено печатей/штампов: {stp}. Документ, вероятно, заверен. QR: {qr}."
+        if qr > 0:
+            return f"Найдено QR-кодов: {qr}. Подписей и печатей не обнаружено."
+        return "Подписей, печатей и QR-кодов не обнаружено."
@@ -0,0 +1,120 @@
+import base64
+from typing import Optional
+
+import cv2
+import numpy as np
+
+try:
+    from .lru import BoundedLRU
+    from .metrics import metrics
+except ImportError:
+    from lru import BoundedLRU
+    from metrics import metrics
+
+
+MIME_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+
+def downscale(image: np.ndarray, max_dim: int) -> tuple[np.ndarray, float]:
+    """Уменьшает так, чтобы большая сторона была <= max_dim (INTER_AREA); возвращает (изображение, масштаб)."""
+    size = preview_size(image.shape, max_dim)
+    if size == (image.shape[1], image.shape[0]):
+        return image, 1.0
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA), size[0] / image.shape[1]
+
+
+def preview_size(shape, max_dim: int) -> tuple[int, int]:
+    """(ширина, высота) превью страницы формы shape — без уменьшения и кодирования."""
+    h, w = shape[:2]
+    scale = min(1.0, float(max_dim) / max(h, w)) if max_dim else 1.0
+    if scale >= 1.0:
+        return w, h
+    return max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+
+
+def encode_preview(image: np.ndarray, fmt: str = 'webp', quality: int = 75) -> tuple[bytes, str]:
+    """Кодирует превью в WebP или прогрессивный JPEG; без поддержки WebP в OpenCV — JPEG.
+
+    Returns:
+        (байты, MIME-тип)
+    """
+    if fmt == 'webp':
+        ok, buffer = cv2.imencode('.webp', image, [cv2.IMWRITE_WEBP_QUALITY, int(quality)])
+        if ok:
+            return buffer.tobytes(), MIME_TYPES['webp']
+    # Прогрессивный JPEG: браузер показывает грубую версию до загрузки всего файла
+    ok, buffer = cv2.imencode('.jpg', image, [
+        cv2.IMWRITE_JPEG_QUALITY, int(quality),
+        cv2.IMWRITE_JPEG_PROGRESSIVE, 1,
+        cv2.IMWRITE_JPEG_OPTIMIZE, 1
+    ])
+    if not ok:
+        raise ValueError('Unable to encode preview image')
+    return buffer.tobytes(), MIME_TYPES['jpeg']
+
+
+def to_data_uri(data: bytes, mime: str) -> str:
+    return f'data:{mime};base64,{base64.b64encode(data).decode("ascii")}'
+
+
+class PreviewCache:
+    """Закодированные превью (LRU, ограничение по байтам): повторный показ страницы без перекодирования."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = int(max_bytes)
+        self._entries = BoundedLRU(self.max_bytes)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        metrics.incr('preview_cache_hits' if entry is not None else 'preview_cache_misses')
+        return entry
+
+    def put(self, key, data: bytes, mime: str, width: int, height: int):
+        entry = {'data': data, 'mime': mime, 'width': width, 'height': height}
+        self._entries.put(key, entry, len(data))
+        return entry
+
+
+class PreviewRenderer:
+    """Превью страниц: уменьшение до max_dim, разметка в масштабе превью, кодирование и кэш.
+
+    Ключ кэша — (result_id, страница, с разметкой или без, max_dim, формат): для
+    результата он не меняется, поэтому закодированное превью можно отдавать повторно.
+    """
+
+    def __init__(self, max_dim: int = 1280, quality: int = 75, fmt: str = 'webp', cache: Optional[PreviewCache] = None):
+        self.max_dim = max_dim
+        self.quality = quality
+        self.fmt = fmt if fmt in MIME_TYPES else 'jpeg'
+        self.cache = cache
+
+    def render(self, result_id: str, page_num: int, image: np.ndarray, detections=None, drawer=None,
+               max_dim: Optional[int] = None, fmt: Optional[str] = None) -> dict:
+        """Превью страницы; detections + drawer — нарисовать разметку (в координатах страницы).
+
+        image — страница или функция без аргументов, которая её декодирует (только при промахе кэша).
+
+        Returns:
+            {'data', 'mime', 'width', 'height'}
+        """
+        max_dim = max_dim or self.max_dim
+        fmt = fmt if fmt in MIME_TYPES else self.fmt
+        key = (result_id, page_num, detections is not None, max_dim, fmt)
+        if self.cache is not None:
+            entry = self.cache.get(key)
+            if entry is not None:
+                return entry
+
+        if callable(image):
+            image = image()
+        small, scale = downscale(image, max_dim)
+        if detections is not None and drawer is not None:
+            # Рисуем уже на уменьшенной копии: дешевле и подписи боксов остаются читаемыми
+            if small is image:
+                small = image.copy()
+            drawer(small, detections.transformed(sx=scale, sy=scale), out=small)
+        data, mime = encode_preview(small, fmt, self.quality)
+        h, w = small.shape[:2]
+        if self.cache is not None:
+            return self.cache.put(key, data, mime, w, h)
+        return {'data': data, 'mime': mime, 'width': w, 'height': h}
@@ -0,0 +1,75 @@
+import threading
+
+import cv2
+import numpy as np
+
+
+# cv2.QRCodeDetector не потокобезопасен — держим по экземпляру на поток
+_local = threading.local()
+
+
+def _qr_detector():
+    det = getattr(_local, 'detector', None)
+    if det is None:
+        det = cv2.QRCodeDetector()
+        _local.detector = det
+    return det
+
+
+def decode_qr_codes(image: np.ndarray) -> list[dict]:
+    """Находит и декодирует QR-коды на изображении (OpenCV, без YOLO).
+
+    Returns:
+        список {'bbox': [x1, y1, x2, y2], 'payload': str | None}
+    """
+    if image is None or image.size == 0:
+        return []
+    try:
+        ok, payloads, points, _ = _qr_detector().detectAndDecodeMulti(image)
+    except cv2.error:
+        return []
+    if not ok or points is None:
+        return []
+
+    found = []
+    for payload, pts in zip(payloads, points):
+        pts = np.asarray(pts, dtype=np.float32).reshape(-1, 2)
+        x1, y1 = pts.min(axis=0)
+        x2, y2 = pts.max(axis=0)
+        found.append({
+            'bbox': [float(x1), float(y1), float(x2), float(y2)],
+            'payload': payload or None
+        })
+    return found
+
+
+def decode_qr_crop(image: np.ndarray, bbox, padding: int = 16):
+    """Пытается декодировать QR внутри bbox (с паддингом — нужна «тихая зона»)."""
+    h, w = image.shape[:2]
+    x1, y1, x2, y2 = map(int, bbox)
+    x1, y1 = max(0, x1 - padding), max(0, y1 - padding)
+    x2, y2 = min(w, x2 + padding), min(h, y2 + padding)
+    if x2 <= x1 or y2 <= y1:
+        return None
+    for found in decode_qr_codes(image[y1:y2, x1:x2]):
+        if found['payload']:
+            return found['payload']
+    return None
+
+
+def annotate_qr_detections(image: np.ndarray, detections, qr_class: int):
+    """Декодирует QR в YOLO-боксах класса qr_code и помечает подтверждённые.
+
+    Возвращает DetectionSet с доп. полями `payload` (str | None) и `qr_verified` (bool)
+    у детекций класса qr_code.
+    """
+    qr_rows = np.flatnonzero(detections.cls == qr_class)
+    if not qr_rows.size:
+        return detections
+    payloads = np.full(len(detections), None, dtype=object)
+    verified = np.full(len(detections), None, dtype=object)
+    for i in qr_rows.tolist():
+        payload = decode_qr_crop(image, detections.boxes[i])
+        payloads[i] = payload
+        verified[i] = payload is not None
+    return detections.with_extra('payload', payloads).with_extra('qr_verified', verified)
@@ -0,0 +1,207 @@
+"""Слой ответов API: потоковая сериализация JSON и сжатие gzip/brotli.
+
+Ответ собирается по частям: верхние ключи (и элементы верхних списков)
+сериализуются по отдельности, так что в памяти не лежит вся JSON-строка
+большого ответа — только текущий кусок. orjson используется, если установлен
+(иначе стандартный json). Сжатие выбирается по Accept-Encoding и тоже идёт
+потоком, поэтому длинные ответы уходят клиенту по мере готовности.
+"""
+import json
+import zlib
+from functools import lru_cache
+from typing import Iterator, Optional
+
+import numpy as np
+from flask import Response
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    from .metrics import metrics
+except ImportError:
+    from metrics import metrics
+
+
+# Типы, которые имеет смысл сжимать (картинки/PDF/ZIP уже сжаты)
+COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'image/svg+xml'}
+
+
+@lru_cache(maxsize=1)
+def _orjson():
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+@lru_cache(maxsize=1)
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def _default(obj):
+    """Типы, которых не знает сериализатор: numpy-скаляры и массивы, множества, даты (как во Flask)."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return DefaultJSONProvider.default(obj)
+
+
+def dumps(obj) -> bytes:
+    """JSON в UTF-8 (orjson, если доступен)."""
+    orjson = _orjson()
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def iter_json(obj, depth: int = 2) -> Iterator[bytes]:
+    """Сериализация по частям: словари и списки до глубины depth раскрываются поэлементно."""
+    if depth <= 0 or not isinstance(obj, (dict, list, tuple)):
+        yield dumps(obj)
+        return
+    if isinstance(obj, dict):
+        yield b'{'
+        for i, (key, value) in enumerate(obj.items()):
+            yield (b',' if i else b'') + dumps(key if isinstance(key, str) else str(key)) + b':'
+            yield from iter_json(value, depth - 1)
+        yield b'}'
+    else:
+        yield b'['
+        for i, value in enumerate(obj):
+            if i:
+                yield b','
+            yield from iter_json(value, depth - 1)
+        yield b']'
+
+
+def _coalesce(pieces: Iterator[bytes], chunk_size: int) -> Iterator[bytes]:
+    """Склеивает мелкие куски в блоки ~chunk_size (меньше записей в сокет)."""
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+class StreamingJSONProvider(DefaultJSONProvider):
+    """JSON-провайдер Flask: orjson + потоковое тело для больших ответов.
+
+    Ответ до chunk_size байт отдаётся целиком (с Content-Length), больший —
+    кусками по мере сериализации (chunked).
+    """
+
+    chunk_size = 64 * 1024
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj).decode('utf-8')
+
+    def response(self, *args, **kwargs) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        chunks = _coalesce(iter_json(obj), self.chunk_size)
+        first = next(chunks, b'')
+        rest = next(chunks, None)
+        if rest is None:
+            return self._app.response_class(first, mimetype=self.mimetype)
+
+        def body():
+            yield first
+            yield rest
+            yield from chunks
+
+        metrics.incr('responses_streamed')
+        return self._app.response_class(body(), mimetype=self.mimetype)
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """'br' или 'gzip' по заголовку Accept-Encoding (с учётом q=0); None — без сжатия."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    candidates = (['br'] if _brotli() is not None else []) + ['gzip']
+    wildcard = accepted.get('*', 0.0)
+    best = max(candidates, key=lambda name: accepted.get(name, wildcard), default=None)
+    if best is None or accepted.get(best, wildcard) <= 0:
+        return None
+    return best
+
+
+def _compress_stream(chunks, encoding: str, level: int) -> Iterator[bytes]:
+    if encoding == 'br':
+        compressor = _brotli().Compressor(quality=level)
+        for chunk in chunks:
+            data = compressor.process(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+        return
+    # wbits=31: формат gzip (заголовок + CRC), а не голый zlib
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_response(response: Response, accept_encoding: Optional[str], min_size: int = 1024,
+                      gzip_level: int = 6, brotli_quality: int = 5) -> Response:
+    """Сжимает ответ (after_request), если клиент умеет и это имеет смысл.
+
+    Не трогаются: уже закодированные, частичные (206) и пустые ответы, несжимаемые
+    типы и тела короче min_size. Сильный ETag становится слабым — сжатое тело
+    семантически то же, и If-None-Match с ним по-прежнему даёт 304.
+    """
+    mimetype = response.mimetype or ''
+    if mimetype not in COMPRESSIBLE_TYPES and not mimetype.startswith('text/'):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if response.content_length is not None and response.content_length < min_size:
+        return response
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding is None:
+        return response
+
+    level = brotli_quality if encoding == 'br' else gzip_level
+    source = response.response
+    # Исходный итератор (файл send_file, генератор) закрывается вместе с ответом
+    if hasattr(source, 'close'):
+        response.call_on_close(source.close)
+    chunks = source if response.direct_passthrough else response.iter_encoded()
+    response.direct_passthrough = False
+    response.response = _compress_stream(chunks, encoding, level)
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    response.headers.pop('Accept-Ranges', None)
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    metrics.incr(f'responses_{encoding}')
+    return response
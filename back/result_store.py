@@ -0,0 +1,38 @@
+try:
+    from .lru import BoundedLRU
+except ImportError:
+    from lru import BoundedLRU
+
+
+class ResultStore:
+    """Недавние результаты /detect в памяти (LRU, ограничение по байтам).
+
+    Хранит страницы, детекции и сырые предсказания, чтобы кропы,
+    производные (прозрачные PNG и т.п.) и пересчёт с другими порогами
+    строились лениво — только когда их запросят. Кадры TIFF/HEIF не хранятся:
+    DocumentPages держит загрузку и декодирует кадр по запросу.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = int(max_bytes)
+        self._entries = BoundedLRU(self.max_bytes)
+
+    def put(self, result_id, pages, detections_by_page, pdf_bytes=None, raw_by_page=None, model_version=None):
+        """pages — DocumentPages, detections_by_page — DetectionSet на каждую страницу.
+
+        raw_by_page — сырые предсказания страниц (для смены порогов без инференса).
+        Возвращает False, если результат больше всего хранилища и не сохранён.
+        """
+        size = pages.nbytes + len(pdf_bytes or b'')
+        size += sum(raw.boxes.nbytes + raw.conf.nbytes for raw in raw_by_page or ())
+        entry = {
+            'pages': pages,
+            'detections': detections_by_page,
+            'pdf_bytes': pdf_bytes,
+            'raw': raw_by_page,
+            'model_version': model_version,
+        }
+        return self._entries.put(result_id, entry, size)
+
+    def get(self, result_id):
+        return self._entries.get(result_id)
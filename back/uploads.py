@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import mmap
+import os
+import tempfile
+from typing import Optional
+
+
+class UploadTooLarge(ValueError):
+    """Файл больше допустимого размера (ответ 413)."""
+
+
+class SpooledUpload:
+    """Загрузка, сброшенная на диск кусками и отображённая в память (mmap).
+
+    В памяти процесса никогда не лежит целиком: изображения декодируются прямо
+    из mmap, PDF открываются по пути. Лимит размера проверяется при копировании,
+    поэтому слишком большой файл обрывается, не дочитываясь до конца.
+    """
+
+    def __init__(self, file, max_bytes: Optional[int] = None, chunk_size: int = 1024 * 1024):
+        stream = getattr(file, 'stream', file)
+        name = getattr(file, 'filename', None) or ''
+        suffix = '.' + name.rsplit('.', 1)[1].lower() if '.' in name else ''
+
+        handle = tempfile.NamedTemporaryFile(prefix='upload_', suffix=suffix, delete=False)
+        self.path = handle.name
+        self.size = 0
+        self._mmap = None
+        try:
+            with handle:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    self.size += len(chunk)
+                    if max_bytes is not None and self.size > max_bytes:
+                        raise UploadTooLarge(
+                            f'File is too large. Maximum size: {max_bytes // (1024 * 1024)} MB'
+                        )
+                    handle.write(chunk)
+            if self.size:
+                with open(self.path, 'rb') as mapped:
+                    self._mmap = mmap.mmap(mapped.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def buffer(self):
+        """Содержимое без копирования (mmap, только чтение)."""
+        return self._mmap if self._mmap is not None else b''
+
+    def read_bytes(self) -> bytes:
+        """Копия содержимого — только для данных, которые переживают запрос."""
+        return bytes(self.buffer)
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # На mmap ещё смотрит numpy-массив — отображение закроет сборщик мусора
+                pass
+            self._mmap = None
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                # Windows не удаляет файл, пока он открыт (воркер рендера) — временная папка
+                pass
+            self.path = None
@@ -4,36 +4,46 @@ import base64
 import io
 import json
 import os
-from typing import Optional
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import Iterable, Iterator, Optional
 
 import cv2
 import numpy as np
 from PIL import Image
 
 try:
-    from pdf2image import convert_from_bytes
-    _PDF2IMAGE_AVAILABLE = True
-except Exception:
-    _PDF2IMAGE_AVAILABLE = False
+    from .pdf_render import PdfSource
+    from .uploads import SpooledUpload, UploadTooLarge
+except ImportError:
+    from pdf_render import PdfSource
+    from uploads import SpooledUpload, UploadTooLarge
+
+
+# Тяжёлые опциональные зависимости (EasyOCR тянет torch, pillow_heif — libheif)
+# импортируются при первом использовании, а не при импорте utils
+@lru_cache(maxsize=1)
+def _register_heif() -> bool:
+    """Подключает HEIC/HEIF к Pillow; False — pillow_heif не установлен."""
+    try:
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+        return True
+    except Exception:
+        return False
 
-try:
-    import fitz  # PyMuPDF
-    _PYMUPDF_AVAILABLE = True
-except Exception:
-    _PYMUPDF_AVAILABLE = False
 
-# OCR (EasyOCR – без системной установки)
-try:
-    import easyocr
-    _EASYOCR_AVAILABLE = True
-except Exception:
-    _EASYOCR_AVAILABLE = False
-
-try:
-    import pillow_heif
-    pillow_heif.register_heif_opener()
-except Exception:
-    pass
+@lru_cache(maxsize=4)
+def _ocr_reader(languages: tuple[str, ...]):
+    """EasyOCR Reader на набор языков (загружается один раз); None — EasyOCR не установлен."""
+    try:
+        import easyocr
+    except Exception:
+        return None
+    return easyocr.Reader(list(languages), gpu=False)
 
 
 def allowed_file(filename: str, allowed_extensions: set[str]) -> bool:
@@ -41,81 +51,315 @@ def allowed_file(filename: str, allowed_extensions: set[str]) -> bool:
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
 
-def _pil_bytes_to_cv2(img_bytes: bytes) -> np.ndarray:
-    """Decode bytes with Pillow and convert to OpenCV BGR array."""
-    pil_img = Image.open(io.BytesIO(img_bytes))
+def parse_classes(value: Optional[str], known: list[str]) -> Optional[list[str]]:
+    """Parse `classes=signature,stamp` request option into canonical class names.
+
+    Returns None when the option is empty (all classes).
+    """
+    if not value:
+        return None
+    aliases = {'qr': 'qr_code', 'qrcode': 'qr_code', 'seal': 'stamp', 'sign': 'signature'}
+    classes = []
+    for part in str(value).split(','):
+        name = part.strip().lower().replace('-', '_').replace(' ', '_')
+        if not name:
+            continue
+        name = aliases.get(name, name)
+        if name not in known:
+            raise ValueError(f'Unknown class "{part.strip()}". Allowed: {known}')
+        if name not in classes:
+            classes.append(name)
+    return classes or None
+
+
+def parse_outputs(value: Optional[str], known, default) -> list[str]:
+    """Parse `outputs=annotations,summary` request option (what to derive from one detection pass).
+
+    Returns `default` when the option is empty.
+    """
+    if not value:
+        return list(default)
+    outputs = []
+    for part in str(value).split(','):
+        name = part.strip().lower()
+        if not name:
+            continue
+        if name not in known:
+            raise ValueError(f'Unknown output "{part.strip()}". Allowed: {list(known)}')
+        if name not in outputs:
+            outputs.append(name)
+    return outputs or list(default)
+
+
+def parse_flag(value: Optional[str], default: bool = False) -> bool:
+    """Parse boolean request option (`1/0`, `true/false`, `yes/no`)."""
+    if value is None or str(value).strip() == '':
+        return default
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def parse_threshold(value: Optional[str], name: str = 'threshold') -> Optional[float]:
+    """Parse a 0..1 request option (`conf=0.3`); None when empty."""
+    if value is None or str(value).strip() == '':
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f'Invalid {name}: {value!r} (expected a number between 0 and 1)')
+    if not 0.0 <= number <= 1.0:
+        raise ValueError(f'Invalid {name}: {value!r} (expected a number between 0 and 1)')
+    return number
+
+
+def parse_page_ranges(value: Optional[str]) -> Optional[list[tuple[int, int]]]:
+    """Parse `pages=1-3,5,-1` into 1-based inclusive ranges.
+
+    Negative numbers count from the end (-1 is the last page). Returns None
+    when the option is empty (all pages).
+    """
+    if not value:
+        return None
+    ranges = []
+    for part in str(value).replace(' ', '').split(','):
+        if not part:
+            continue
+        match = re.fullmatch(r'(-?\d+)(?:-(-?\d+))?', part)
+        if not match:
+            raise ValueError(f'Invalid page range "{part}". Example: pages=1-3,5,-1')
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) is not None else start
+        if start == 0 or end == 0:
+            raise ValueError('Page numbers are 1-based (use -1 for the last page)')
+        ranges.append((start, end))
+    return ranges or None
+
+
+def resolve_page_selection(ranges: Optional[list[tuple[int, int]]], page_count: int) -> list[int]:
+    """Turn parsed page ranges into sorted 0-based page indices for a document."""
+    if not ranges:
+        return list(range(page_count))
+    selected = set()
+    for start, end in ranges:
+        start = start + page_count + 1 if start < 0 else start
+        end = end + page_count + 1 if end < 0 else end
+        start, end = max(1, start), min(page_count, end)
+        selected.update(range(start - 1, end))
+    return sorted(selected)
+
+
+def parse_roi(value: Optional[str]) -> Optional[tuple[float, float, float, float]]:
+    """Parse `roi=x1,y1,x2,y2` in normalized [0, 1] page coordinates."""
+    if not value:
+        return None
+    try:
+        x1, y1, x2, y2 = (float(v) for v in str(value).split(','))
+    except ValueError:
+        raise ValueError('Invalid roi. Expected "x1,y1,x2,y2" in 0..1, e.g. roi=0,0.66,1,1') from None
+    if not (0.0 <= x1 < x2 <= 1.0 and 0.0 <= y1 < y2 <= 1.0):
+        raise ValueError('Invalid roi: coordinates must satisfy 0 <= x1 < x2 <= 1 and 0 <= y1 < y2 <= 1')
+    if (x1, y1, x2, y2) == (0.0, 0.0, 1.0, 1.0):
+        return None
+    return x1, y1, x2, y2
+
+
+def _pil_bytes_to_cv2(img_bytes) -> np.ndarray:
+    """Decode bytes (or a file path) with Pillow and convert to OpenCV BGR array."""
+    _register_heif()
+    pil_img = Image.open(img_bytes if isinstance(img_bytes, str) else io.BytesIO(img_bytes))
     pil_rgb = pil_img.convert('RGB')
     np_img = np.array(pil_rgb)
     return cv2.cvtColor(np_img, cv2.COLOR_RGB2BGR)
 
 
-def _decode_pdf(raw_bytes: bytes) -> list[np.ndarray]:
-    """Convert all pages of a PDF document into image arrays.
+def _decode_pdf(raw_bytes: bytes, pages: Optional[list[int]] = None) -> list[np.ndarray]:
+    """Convert pages of a PDF document into image arrays.
+    
+    Args:
+        pages: 0-based page indices to render (None — all pages)
     
     Returns:
         List of numpy arrays (one per page)
     """
-    attempts: list[str] = []
+    with PdfSource(raw_bytes) as source:
+        return source.render_pages(pages)
 
-    if _PDF2IMAGE_AVAILABLE:
-        try:
-            pages = convert_from_bytes(raw_bytes, dpi=200)
-            if pages:
-                images = []
-                for page in pages:
-                    buf = io.BytesIO()
-                    page.save(buf, format='JPEG', quality=95)
-                    images.append(_pil_bytes_to_cv2(buf.getvalue()))
-                return images
-            attempts.append('pdf2image returned no pages')
-        except Exception as err:
-            attempts.append(f'pdf2image: {err}')
-
-    if _PYMUPDF_AVAILABLE:
-        try:
-            with fitz.open(stream=raw_bytes, filetype='pdf') as pdf_doc:
-                if pdf_doc.page_count == 0:
-                    attempts.append('PyMuPDF: empty document')
-                else:
-                    images = []
-                    for page_num in range(pdf_doc.page_count):
-                        page = pdf_doc.load_page(page_num)
-                        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2), alpha=False)
-                        images.append(_pil_bytes_to_cv2(pix.tobytes('png')))
-                    return images
-        except Exception as err:
-            attempts.append(f'PyMuPDF: {err}')
-
-    details = '; '.join(attempts) if attempts else 'no PDF backends available'
-    raise ValueError(
-        'Cannot convert PDF to image. Install pdf2image + Poppler or PyMuPDF. '
-        f'Details: {details}'
-    )
-
-
-def load_image_from_upload(file, filename: Optional[str] = None):
+
+def load_image_from_upload(file, filename: Optional[str] = None, max_bytes: Optional[int] = None):
     """Read upload stream into OpenCV image(s).
     
+    The upload is spooled to a temp file and memory-mapped, never read into memory whole.
+    
+    Raises:
+        UploadTooLarge: the upload exceeds max_bytes
+    
     Returns:
-        For PDF: list of numpy arrays (one per page)
+        For PDF and multi-frame TIFF/HEIF: list of numpy arrays (one per page)
         For images: single numpy array
     """
-    raw_bytes = file.read()
+    ext = ''
+    if filename and '.' in filename:
+        ext = filename.rsplit('.', 1)[1].lower()
+
+    with SpooledUpload(file, max_bytes) as upload:
+        if ext == 'pdf':
+            with PdfSource(path=upload.path) as source:
+                return source.render_pages()  # Returns list
+        frames = _open_frames(upload) if ext in MULTIFRAME_EXTENSIONS else None
+        if frames is not None:
+            return [image for _, image in frames.iter_frames()]
+
+        return _decode_image(upload.buffer, upload.path)
 
+
+def load_pages_from_upload(file, filename: Optional[str] = None,
+                           page_ranges: Optional[list[tuple[int, int]]] = None,
+                           max_bytes: Optional[int] = None,
+                           render_workers: Optional[int] = None,
+                           keep_frames: bool = False) -> tuple[Iterator[tuple[int, np.ndarray]], Optional[PdfSource]]:
+    """Read only the requested pages of an upload.
+
+    The upload is spooled to a temp file in chunks (max_bytes is enforced while
+    copying) and memory-mapped: images decode straight from the mapping, PDFs
+    are opened by path.
+
+    render_workers caps parallel PDF rasterization for this document (1 — serial,
+    for callers that already decode documents in parallel).
+
+    keep_frames: for multi-frame TIFF/HEIF return the ImageFrames itself as the
+    page iterator; the upload then outlives the stream, so frames can be decoded
+    again with ImageFrames.seek, and the caller closes it.
+
+    Raises:
+        UploadTooLarge: the upload exceeds max_bytes
+
+    Returns:
+        (iterator of (page_number (1-based), image), PdfSource for PDFs else None).
+        PDF pages are yielded as soon as they are rasterized, so detection can
+        start before the whole document is rendered. The PdfSource also
+        re-renders regions at high DPI and must be closed by the caller
+        (closing it removes the spooled upload). Multi-frame TIFF/HEIF files
+        are yielded frame by frame the same way (see ImageFrames).
+    """
     ext = ''
     if filename and '.' in filename:
         ext = filename.rsplit('.', 1)[1].lower()
 
+    upload = SpooledUpload(file, max_bytes)
     if ext == 'pdf':
-        return _decode_pdf(raw_bytes)  # Returns list
+        source = PdfSource.from_upload(upload)
+        try:
+            indices = None
+            if page_ranges:
+                indices = resolve_page_selection(page_ranges, source.page_count)
+                if not indices:
+                    return iter(()), source
+        except Exception:
+            source.close()
+            raise
+        pages = ((i + 1, image) for i, image in source.iter_pages(indices, workers=render_workers))
+        return pages, source
+
+    frames = _open_frames(upload) if ext in MULTIFRAME_EXTENSIONS else None
+    if frames is not None:
+        try:
+            indices = resolve_page_selection(page_ranges, frames.frame_count)
+        except Exception:
+            frames.close()
+            raise
+        if keep_frames:
+            frames.indices, frames.keep_upload = indices, True
+            return frames, None
+        return frames.iter_frames(indices), None
+
+    with upload:
+        if page_ranges and not resolve_page_selection(page_ranges, 1):
+            return iter(()), None
+        return iter([(1, _decode_image(upload.buffer, upload.path))]), None
+
+
+# Форматы, в которых бывает несколько страниц-кадров (факсы и сканы в TIFF, HEIF-последовательности)
+MULTIFRAME_EXTENSIONS = {'tif', 'tiff', 'heic', 'heif'}
 
+
+def _open_frames(upload: SpooledUpload) -> Optional['ImageFrames']:
+    """ImageFrames для файла с несколькими кадрами; None — один кадр или Pillow не открыл
+    (тогда декодирует _decode_image: быстрее через OpenCV и с понятной ошибкой)."""
+    try:
+        frames = ImageFrames(upload)
+    except Exception:
+        return None
+    if frames.frame_count > 1:
+        return frames
+    frames.close(upload=False)
+    return None
+
+
+class ImageFrames:
+    """Многостраничное изображение (TIFF/HEIF) как поток страниц, аналог PdfSource.iter_pages.
+
+    Pillow читает только заголовки кадров; каждый кадр декодируется при seek()
+    и отдаётся до декодирования следующего, так что в памяти один кадр, а не весь
+    файл. Загрузка (SpooledUpload) удаляется, когда поток страниц закончился,
+    если не выставлен keep_upload — тогда её закрывает владелец через close().
+    """
+
+    def __init__(self, upload: SpooledUpload):
+        _register_heif()
+        self._upload = upload
+        self._image = Image.open(upload.path)
+        self.frame_count = getattr(self._image, 'n_frames', 1)
+        self.size = upload.size
+        self.indices = None        # кадры для итерации по самому объекту (0-based), None — все
+        self.keep_upload = False   # True — после потока кадров загрузка остаётся для seek()
+
+    def __iter__(self) -> Iterator[tuple[int, np.ndarray]]:
+        return self.iter_frames(self.indices)
+
+    def iter_frames(self, indices: Optional[list[int]] = None) -> Iterator[tuple[int, np.ndarray]]:
+        """(номер страницы (с 1), BGR-кадр) по 0-based indices (None — все кадры)."""
+        try:
+            for index in (range(self.frame_count) if indices is None else indices):
+                yield index + 1, self._decode(self._image, index)
+        finally:
+            self.close(upload=not self.keep_upload)
+
+    def seek(self, index: int) -> np.ndarray:
+        """BGR-кадр index (0-based), декодированный заново из загрузки — для страниц, пиксели которых не хранятся.
+
+        Каждый вызов открывает файл заново, поэтому безопасен из нескольких потоков.
+        """
+        if self._upload.path is None:
+            raise ValueError('Image frames are closed')
+        with Image.open(self._upload.path) as image:
+            return self._decode(image, index)
+
+    @staticmethod
+    def _decode(image, index: int) -> np.ndarray:
+        image.seek(index)
+        frame = np.array(image.convert('RGB'))
+        return cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+
+    def close(self, upload: bool = True):
+        """Закрывает файл Pillow; upload=False — оставить загрузку открытой для другого декодера."""
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+        if upload:
+            self._upload.close()
+
+
+def _decode_image(raw_bytes, path: Optional[str] = None) -> np.ndarray:
+    """Decode an image from bytes or an mmap without copying; Pillow fallback reads `path` if given."""
     np_bytes = np.frombuffer(raw_bytes, np.uint8)
+    if not np_bytes.size:
+        raise ValueError('Empty file')
     img = cv2.imdecode(np_bytes, cv2.IMREAD_COLOR)
+    del np_bytes  # не держим ссылку на mmap дольше декодирования
     if img is not None:
         return img
 
     try:
-        return _pil_bytes_to_cv2(raw_bytes)
+        return _pil_bytes_to_cv2(path or raw_bytes)
     except Exception as err:
         raise ValueError(
             'Cannot decode file as image. Supported formats: '
@@ -129,18 +373,8 @@ def extract_text_from_pdf_bytes(raw_bytes: bytes) -> str:
 
     Возвращает объединённый текст со всех страниц.
     """
-    if not _PYMUPDF_AVAILABLE:
-        return ''
-    try:
-        text_parts: list[str] = []
-        with fitz.open(stream=raw_bytes, filetype='pdf') as pdf_doc:
-            for page_num in range(pdf_doc.page_count):
-                page = pdf_doc.load_page(page_num)
-                txt = page.get_text('text') or ''
-                text_parts.append(txt.strip())
-        return '\n'.join(tp for tp in text_parts if tp)
-    except Exception:
-        return ''
+    with PdfSource(raw_bytes) as source:
+        return source.extract_text()
 
 
 def _enhance_for_ocr(bgr: np.ndarray) -> np.ndarray:
@@ -156,13 +390,18 @@ def _enhance_for_ocr(bgr: np.ndarray) -> np.ndarray:
 
 def ocr_text_from_images(images: list[np.ndarray], languages: Optional[list[str]] = None, enhance: bool = True) -> str:
     """OCR по списку изображений с помощью EasyOCR (с опциональным препроцессингом)."""
+    return '\n'.join(t for t in ocr_text_pages(images, languages, enhance) if t)
+
+
+def ocr_text_pages(images: list[np.ndarray], languages: Optional[list[str]] = None, enhance: bool = True) -> list[str]:
+    """OCR постранично: текст каждой страницы отдельно (для саммари по страницам)."""
     if not images:
-        return ''
-    if not _EASYOCR_AVAILABLE:
-        return ''
-    langs = languages or ['ru', 'en']
+        return []
+    langs = tuple(languages or ['ru', 'en'])
     try:
-        reader = easyocr.Reader(langs, gpu=False)
+        reader = _ocr_reader(langs)
+        if reader is None:
+            return []
         texts: list[str] = []
         for img in images:
             rgb = _enhance_for_ocr(img) if enhance else cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
@@ -173,11 +412,10 @@ def ocr_text_from_images(images: list[np.ndarray], languages: Optional[list[str]
             merged = []
             merged.extend([r for r in results if r])
             merged.extend([r for r in results_inv if r])
-            if merged:
-                texts.append('\n'.join([r for r in merged if isinstance(r, str)]))
-        return '\n'.join(t for t in texts if t)
+            texts.append('\n'.join([r for r in merged if isinstance(r, str)]))
+        return texts
     except Exception:
-        return ''
+        return []
 
 
 def extract_crops_np(image: np.ndarray, detections: list, padding: int = 20) -> list[np.ndarray]:
@@ -259,8 +497,8 @@ def simple_summarize(text: str, max_sentences: int = 3) -> str:
     try:
         vectorizer = TfidfVectorizer(max_features=10000, stop_words=None)
         X = vectorizer.fit_transform(sents)
-        # Сумма TF-IDF по словам в предложении
-        scores = X.toarray().sum(axis=1)
+        # Сумма TF-IDF по словам в предложении — прямо по разреженной матрице, без toarray()
+        scores = np.asarray(X.sum(axis=1)).ravel()
         top_idx = np.argsort(scores)[::-1][:max_sentences]
         # Сохраняем порядок как в исходном тексте
         top_idx_sorted = sorted(top_idx)
@@ -293,36 +531,73 @@ def save_detection_result(image: np.ndarray, detections: dict, output_dir: str,
     return image_path, json_path
 
 
-def save_detection_result_pdf(images: list[np.ndarray] | np.ndarray, detections: dict, output_dir: str, filename: str) -> tuple[str, str]:
+def write_image_pdf(path: str, pages: Iterable[np.ndarray], resolution: float = 100.0, quality: int = 90) -> int:
+    """Пишет страницы-изображения (BGR или серые) в PDF потоком, по JPEG на страницу.
+
+    В памяти одновременно только текущая страница и её JPEG: страницы могут
+    приходить из генератора и рисоваться в один переиспользуемый буфер.
+    Размер листа — пиксели / resolution дюймов. Возвращает число страниц.
+    """
+    offsets = {}
+    kids = []
+    with open(path, 'wb') as handle:
+        def write_object(number: int, header: str, stream: Optional[bytes] = None):
+            offsets[number] = handle.tell()
+            handle.write(f'{number} 0 obj\n{header}\n'.encode('ascii'))
+            if stream is not None:
+                handle.write(b'stream\n')
+                handle.write(stream)
+                handle.write(b'\nendstream\n')
+            handle.write(b'endobj\n')
+
+        handle.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        write_object(1, '<< /Type /Catalog /Pages 2 0 R >>')
+        number = 3
+        for image in pages:
+            h, w = image.shape[:2]
+            ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not ok:
+                raise ValueError('Failed to encode page for PDF')
+            colorspace = '/DeviceGray' if image.ndim == 2 else '/DeviceRGB'
+            write_object(number, (
+                f'<< /Type /XObject /Subtype /Image /Width {w} /Height {h} /ColorSpace {colorspace} '
+                f'/BitsPerComponent 8 /Filter /DCTDecode /Length {jpeg.size} >>'
+            ), jpeg.tobytes())
+            page_w, page_h = w * 72.0 / resolution, h * 72.0 / resolution
+            content = f'q {page_w:.2f} 0 0 {page_h:.2f} 0 0 cm /Im0 Do Q'.encode('ascii')
+            write_object(number + 1, f'<< /Length {len(content)} >>', content)
+            write_object(number + 2, (
+                f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_w:.2f} {page_h:.2f}] '
+                f'/Resources << /XObject << /Im0 {number} 0 R >> >> /Contents {number + 1} 0 R >>'
+            ))
+            kids.append(number + 2)
+            number += 3
+
+        write_object(2, f'<< /Type /Pages /Kids [{" ".join(f"{kid} 0 R" for kid in kids)}] /Count {len(kids)} >>')
+        xref = handle.tell()
+        handle.write(f'xref\n0 {number}\n0000000000 65535 f \n'.encode('ascii'))
+        handle.write(''.join(f'{offsets[i]:010d} 00000 n \n' for i in range(1, number)).encode('ascii'))
+        handle.write(f'trailer\n<< /Size {number} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('ascii'))
+    return len(kids)
+
+
+def save_detection_result_pdf(images: Iterable[np.ndarray] | np.ndarray, detections: dict, output_dir: str, filename: str) -> tuple[str, str]:
     """Сохраняет аннотированные изображения в один PDF и JSON метаданные.
 
-    images: один np.ndarray (BGR) или список изображений (BGR)
+    images: один np.ndarray (BGR) или последовательность/генератор изображений (BGR) —
+    страницы пишутся в PDF по одной, весь документ в памяти не собирается
     filename: имя файла с расширением .pdf
     """
-    # Нормализуем к списку PIL-изображений в RGB
     if isinstance(images, np.ndarray):
-        images_list = [images]
-    else:
-        images_list = list(images)
-
-    pil_list = []
-    for img in images_list:
-        if img is None:
-            continue
-        rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        pil_list.append(Image.fromarray(rgb))
-
-    if not pil_list:
-        raise ValueError('No images to save into PDF')
+        images = [images]
 
     # Пути
     pdf_path = os.path.join(output_dir, 'images', filename)
     os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
 
-    first = pil_list[0]
-    rest = pil_list[1:] if len(pil_list) > 1 else []
-    # Сохраняем многостраничный PDF
-    first.save(pdf_path, format='PDF', resolution=100.0, save_all=bool(rest), append_images=rest)
+    if not write_image_pdf(pdf_path, (img for img in images if img is not None)):
+        os.remove(pdf_path)
+        raise ValueError('No images to save into PDF')
 
     # JSON рядом, как и раньше
     json_name = filename.rsplit('.', 1)[0] + '.json'
@@ -343,22 +618,115 @@ def create_response(success: bool, data: Optional[dict] = None, error: Optional[
     return payload, status_code
 
 
-def extract_detection_crops(image: np.ndarray, detections: list, padding: int = 10) -> list[dict]:
+def build_page_annotations(detections, page_size: tuple[int, int], start_index: int = 1) -> dict:
+    """Страница в схеме /detect_dataset.
+
+    Args:
+        detections: DetectionSet страницы (None — страница без аннотаций)
+        page_size: (width, height)
+        start_index: номер первой аннотации (нумерация сквозная по документу)
+
+    Returns:
+        {'annotations': [{'annotation_N': {'category', 'bbox', 'area'}}], 'page_size': {...}}
+    """
+    width, height = page_size
+    entry = {
+        'annotations': [],
+        'page_size': {'width': width, 'height': height}
+    }
+    if detections is None:
+        return entry
+
+    for idx, ((x1, y1, x2, y2), class_name) in enumerate(zip(detections.boxes.tolist(), detections.class_names())):
+        box_w = x2 - x1
+        box_h = y2 - y1
+        entry['annotations'].append({
+            f'annotation_{start_index + idx}': {
+                'category': class_name,
+                'bbox': {
+                    'x': int(x1),
+                    'y': int(y1),
+                    'width': float(box_w),
+                    'height': float(box_h)
+                },
+                'area': float(box_w * box_h)
+            }
+        })
+    return entry
+
+
+def extract_detection_crops(image: np.ndarray, detections: list, padding: int = 10,
+                            render_region=None, start_index: int = 0) -> list[dict]:
     """
     Вырезает области детекций из изображения и возвращает в base64
     
     Args:
         image: numpy array изображения (BGR)
-        detections: список детекций с bbox и метаданными
+        detections: DetectionSet
         padding: отступ вокруг bbox в пикселях
+        render_region: callable((x1, y1, x2, y2)) -> кроп в высоком разрешении или None
+        start_index: сквозная нумерация annotation_N для многостраничных документов
     
     Returns:
         список словарей с вырезанными изображениями
     """
+    cut = _cut_detection_crops(image, detections, padding, render_region, start_index)
+    return _encode_crops(cut)
+
+
+def extract_page_crops(pages: Iterable, detections_by_page: list, pdf_source: Optional[PdfSource] = None,
+                       padding: int = 10, classes: Optional[list[str]] = None, batch_size: int = 32) -> list[dict]:
+    """Кропы по всем страницам документа, без склейки страниц в одно изображение.
+
+    pages — (page_number, image) по страницам, detections_by_page — DetectionSet на каждую страницу;
+    для PDF области перерисовываются в высоком DPI.
+    classes — оставить только эти классы (нумерация annotation_N не меняется).
+    Кодирование — пачками по batch_size: страница не держится в памяти дольше своей пачки.
+    """
     crops = []
+    cut = iter_page_crops(pages, detections_by_page, pdf_source, padding, classes)
+    while True:
+        batch = list(islice(cut, batch_size))
+        if not batch:
+            return crops
+        crops.extend(_encode_crops(batch))
+
+
+def cut_page_crops(pages: list, detections_by_page: list, pdf_source: Optional[PdfSource] = None,
+                   padding: int = 10, classes: Optional[list[str]] = None) -> list[tuple[dict, np.ndarray]]:
+    """Как extract_page_crops, но без base64: [(метаданные кропа, BGR-кроп)]."""
+    return list(iter_page_crops(pages, detections_by_page, pdf_source, padding, classes))
+
+
+def iter_page_crops(pages: Iterable, detections_by_page: list, pdf_source: Optional[PdfSource] = None,
+                    padding: int = 10, classes: Optional[list[str]] = None) -> Iterator[tuple[dict, np.ndarray]]:
+    """Как cut_page_crops, но лениво: следующий кроп вырезается (и перерисовывается из PDF) по запросу."""
+    start_index = 0
+    for (page_num, page_image), detections in zip(pages, detections_by_page):
+        render_region = None
+        if pdf_source is not None:
+            def render_region(box, idx=page_num - 1, shape=page_image.shape):
+                return pdf_source.render_region(idx, box, shape)
+        yield from _iter_detection_crops(
+            page_image, detections, padding, render_region, start_index, classes
+        )
+        start_index += len(detections)
+
+
+def _cut_detection_crops(image, detections, padding, render_region=None, start_index=0, classes=None):
+    """Вырезает кропы и метаданные по DetectionSet; кодирование — отдельно, пачкой."""
+    return list(_iter_detection_crops(image, detections, padding, render_region, start_index, classes))
+
+
+def _iter_detection_crops(image, detections, padding, render_region=None, start_index=0, classes=None):
+    names = detections.class_names()
+    boxes = detections.boxes.astype(np.int32).tolist()
+    confs = detections.conf.tolist()
+    pages = detections.page.tolist()
     
-    for idx, det in enumerate(detections):
-        x1, y1, x2, y2 = map(int, det['bbox'])
+    for idx, (x1, y1, x2, y2) in enumerate(boxes):
+        if classes and names[idx] not in classes:
+            continue
         
         # Добавляем padding с учетом границ изображения
         crop_x1 = max(0, x1 - padding)
@@ -366,16 +734,17 @@ def extract_detection_crops(image: np.ndarray, detections: list, padding: int =
         crop_x2 = min(image.shape[1], x2 + padding)
         crop_y2 = min(image.shape[0], y2 + padding)
         
-        # Вырезаем область
-        crop_img = image[crop_y1:crop_y2, crop_x1:crop_x2]
-        
-        # Конвертируем в base64
-        crop_base64 = image_to_base64(crop_img)
+        # Вырезаем область (для PDF — перерисовка в высоком DPI, если доступна)
+        crop_img = None
+        if render_region is not None:
+            crop_img = render_region((crop_x1, crop_y1, crop_x2, crop_y2))
+        if crop_img is None:
+            crop_img = image[crop_y1:crop_y2, crop_x1:crop_x2]
         
         crop_data = {
-            'id': f'annotation_{idx + 1}',
-            'class': det['class_name'],
-            'confidence': round(det['confidence'] * 100, 1),
+            'id': f'annotation_{start_index + idx + 1}',
+            'class': names[idx],
+            'confidence': round(confs[idx] * 100, 1),
             'bbox': {
                 'x1': float(x1),
                 'y1': float(y1),
@@ -390,7 +759,7 @@ def extract_detection_crops(image: np.ndarray, detections: list, padding: int =
                 'x2': crop_x2,
                 'y2': crop_y2
             },
-            'image': crop_base64,
+            'image': None,
             'size': {
                 'width': crop_img.shape[1],
                 'height': crop_img.shape[0]
@@ -398,9 +767,38 @@ def extract_detection_crops(image: np.ndarray, detections: list, padding: int =
         }
         
         # Добавляем номер страницы если есть
-        if 'page' in det:
-            crop_data['page'] = det['page']
+        if pages[idx]:
+            crop_data['page'] = pages[idx]
         
+        yield crop_data, crop_img
+
+
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
+
+
+def get_encode_pool() -> ThreadPoolExecutor:
+    """Общий пул потоков для кодирования изображений (cv2.imencode отпускает GIL)."""
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            _encode_pool = ThreadPoolExecutor(
+                max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='crop-encode'
+            )
+        return _encode_pool
+
+
+def _encode_crops(cut: list) -> list[dict]:
+    """JPEG + base64 для всех кропов в пуле потоков (cv2.imencode отпускает GIL)."""
+    if not cut:
+        return []
+    images = [crop_img for _, crop_img in cut]
+    if len(images) == 1:
+        encoded = [image_to_base64(images[0])]
+    else:
+        encoded = list(get_encode_pool().map(image_to_base64, images))
+    crops = []
+    for (crop_data, _), crop_base64 in zip(cut, encoded):
+        crop_data['image'] = crop_base64
         crops.append(crop_data)
-    
     return crops
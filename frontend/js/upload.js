@@ -197,10 +197,16 @@ function displayResults(result, img) {
         }
     }
 
-    // Показываем миниатюры: используем crops из бэкенда если есть, иначе вырезаем на клиенте
+    // Остальные страницы PDF — отдельными превью, грузятся по мере прокрутки
+    appendPagePreviews('processedImageWrapper', data.previews, 'annotated_url');
+    appendPagePreviews('originalImageWrapper', data.previews, 'url');
+
+    // Показываем миниатюры: crops из ответа, иначе лениво по crops_url, иначе вырезаем на клиенте
     if (data.crops && data.crops.length > 0) {
         console.log('✅ Используем готовые crops из бэкенда');
         displayCropsFromBackend(data.crops);
+    } else if (data.crops_url && data.detections && data.detections.length > 0) {
+        loadCropsLazily(data, sourceImageForThumbs);
     } else if (data.detections && data.detections.length > 0) {
         console.log('⚠️ Crops нет, вырезаем на клиенте');
         extractAndDisplayThumbnails(sourceImageForThumbs, data.detections, data.image_with_boxes);
@@ -234,6 +240,43 @@ function displayResults(result, img) {
     document.getElementById('confidenceBar').style.width = avgConfidence + '%';
 }
 
+// Превью страниц 2..N (первая уже в ответе): ленивые <img> с заранее известным размером
+function appendPagePreviews(wrapperId, previews, urlKey) {
+    const wrapper = document.getElementById(wrapperId);
+    if (!wrapper) return;
+    wrapper.querySelectorAll('.page-preview').forEach(el => el.remove());
+    if (!previews || previews.length < 2) return;
+
+    previews.slice(1).forEach(preview => {
+        const pageImg = document.createElement('img');
+        pageImg.className = 'page-preview';
+        pageImg.loading = 'lazy';
+        pageImg.decoding = 'async';
+        pageImg.width = preview.width;
+        pageImg.height = preview.height;
+        pageImg.alt = `Page ${preview.page}`;
+        pageImg.src = preview[urlKey];
+        pageImg.style.cssText = 'width: 100%; height: auto; display: block; margin-top: 8px;';
+        wrapper.appendChild(pageImg);
+    });
+}
+
+// Кропы не встроены в ответ /detect (по умолчанию) — запрашиваем их отдельно
+async function loadCropsLazily(data, sourceImageForThumbs) {
+    try {
+        const response = await fetch(data.crops_url);
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const result = await response.json();
+        if (result.crops && result.crops.length > 0) {
+            displayCropsFromBackend(result.crops);
+            return;
+        }
+    } catch (error) {
+        console.warn('⚠️ Не удалось загрузить crops, вырезаем на клиенте', error);
+    }
+    extractAndDisplayThumbnails(sourceImageForThumbs, data.detections, data.image_with_boxes);
+}
+
 // Отображение готовых crops из бэкенда
 function displayCropsFromBackend(crops) {
     const signatureThumbs = document.getElementById('signatureThumbs');
@@ -803,89 +846,44 @@ function renderSummary(data) {
     section.scrollIntoView({ behavior: 'smooth', block: 'start' });
 }
 
-// === СКАЧИВАНИЕ ШТАМПОВ БЕЗ ФОНА (PNG с альфой) ===
+// === СКАЧИВАНИЕ КРОПОВ БЕЗ ФОНА (PNG с альфой) ===
+// Фон удаляется на сервере, ZIP приходит потоком: браузер только сохраняет файл
 const downloadStampsNoBgBtn = document.getElementById('downloadStampsNoBgBtn');
 if (downloadStampsNoBgBtn) {
-    downloadStampsNoBgBtn.addEventListener('click', async () => {
-        await downloadNoBgFromContainer('stampThumbs', 'stamp', 'stamps_no_bg.zip');
+    downloadStampsNoBgBtn.addEventListener('click', () => {
+        downloadNoBgFromServer('stamp');
     });
 }
 
 // Новые кнопки: подписи и QR
 const downloadSigsNoBgBtn = document.getElementById('downloadSigsNoBgBtn');
 if (downloadSigsNoBgBtn) {
-    downloadSigsNoBgBtn.addEventListener('click', async () => {
-        await downloadNoBgFromContainer('signatureThumbs', 'signature', 'signatures_no_bg.zip');
+    downloadSigsNoBgBtn.addEventListener('click', () => {
+        downloadNoBgFromServer('signature');
     });
 }
 
 const downloadQrNoBgBtn = document.getElementById('downloadQrNoBgBtn');
 if (downloadQrNoBgBtn) {
-    downloadQrNoBgBtn.addEventListener('click', async () => {
-        await downloadNoBgFromContainer('qrThumbs', 'qr', 'qr_no_bg.zip');
+    downloadQrNoBgBtn.addEventListener('click', () => {
+        downloadNoBgFromServer('qr_code');
     });
 }
 
-async function downloadNoBgFromContainer(containerId, prefix, zipName) {
-    const container = document.getElementById(containerId);
-    if (!container) return;
-    const imgs = Array.from(container.querySelectorAll('img'));
-    if (imgs.length === 0) {
+function downloadNoBgFromServer(className) {
+    if (!lastResult || !lastResult.crops_url) {
         alert('Nothing to download');
         return;
     }
-
-    const zip = new JSZip();
-    let idx = 1;
-    for (const img of imgs) {
-        const pngBytes = await makeTransparentPngFromImage(img);
-        if (pngBytes) {
-            const fname = `${prefix}_${String(idx).padStart(2,'0')}.png`;
-            zip.file(fname, pngBytes);
-            idx++;
-        }
-    }
-    const blob = await zip.generateAsync({ type: 'blob' });
-    saveAs(blob, zipName);
-}
-
-async function makeTransparentPngFromImage(imgEl) {
-    // Рисуем в canvas, определяем фон как почти белый/светлый и делаем его прозрачным
-    const canvas = document.createElement('canvas');
-    const ctx = canvas.getContext('2d');
-    canvas.width = imgEl.naturalWidth || imgEl.width;
-    canvas.height = imgEl.naturalHeight || imgEl.height;
-    ctx.drawImage(imgEl, 0, 0, canvas.width, canvas.height);
-
-    const imgData = ctx.getImageData(0, 0, canvas.width, canvas.height);
-    const data = imgData.data;
-
-    // Пороговые значения: фон (почти белый) -> прозрачный
-    // Также удаляем почти-одноцветный фон (серовато-белый)
-    const WHITE_THR = 235;      // яркость
-    const DIFF_THR = 22;        // допустимая разница каналов для белого
-
-    for (let i = 0; i < data.length; i += 4) {
-        const r = data[i];
-        const g = data[i + 1];
-        const b = data[i + 2];
-        const maxc = Math.max(r, g, b);
-        const minc = Math.min(r, g, b);
-        const isWhiteish = (r > WHITE_THR && g > WHITE_THR && b > WHITE_THR && (maxc - minc) < DIFF_THR);
-        if (isWhiteish) {
-            data[i + 3] = 0; // alpha = 0
-        } else {
-            data[i + 3] = 255;
-        }
+    const hasCrops = (lastResult.detections || []).some(d => d.class_name === className);
+    if (!hasCrops) {
+        alert('Nothing to download');
+        return;
     }
-
-    ctx.putImageData(imgData, 0, 0);
-
-    // Немного подчистим края: свёртка/растушёвка минимальная — опционально (пропускаем для простоты)
-
-    // Вернём как PNG bytes
-    const blob = await new Promise(resolve => canvas.toBlob(resolve, 'image/png'));
-    if (!blob) return null;
-    const arrbuf = await blob.arrayBuffer();
-    return new Uint8Array(arrbuf);
+    const link = document.createElement('a');
+    link.href = `${lastResult.crops_url}/nobg.zip?classes=${encodeURIComponent(className)}`;
+    link.download = '';
+    document.body.appendChild(link);
+    link.click();
+    link.remove();
 }
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Модули back/ импортируются как пакет: from back.page_cache import PageCache
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
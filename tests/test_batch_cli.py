@@ -0,0 +1,97 @@
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+from back import batch_cli
+from back.detections import DetectionSet
+
+
+NAMES = ('signature', 'stamp', 'qr_code')
+
+
+class _StubDetector:
+    """detect_batch без модели: по одной подписи на страницу; fail_on — номер вызова, на котором «падает процесс»."""
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.calls = 0
+        self.pages = 0
+
+    def detect_batch(self, images, classes=None, roi=None):
+        self.calls += 1
+        if self.calls == self.fail_on:
+            raise RuntimeError('killed')
+        self.pages += len(images)
+        return [{
+            'detections': DetectionSet.from_arrays([[1, 1, 5, 5]], [0], [0.9], names=NAMES),
+            'count_by_class': {'signature': 1, 'stamp': 0, 'qr_code': 0},
+        } for _ in images]
+
+
+@pytest.fixture
+def scans(tmp_path):
+    source = tmp_path / 'scans'
+    source.mkdir()
+    for n in range(5):
+        cv2.imwrite(str(source / f'doc{n}.png'), np.full((20, 30, 3), 40 * n, np.uint8))
+    return source
+
+
+def _records(path):
+    return [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+
+
+def test_interrupted_run_resumes_without_duplicates_or_gaps(scans, tmp_path):
+    output = tmp_path / 'out' / 'scans.jsonl'
+    checkpoint = output.with_name('scans.jsonl.checkpoint')
+    with pytest.raises(RuntimeError):
+        batch_cli.run_batch([str(scans)], str(output), batch_size=1, workers=1, detector=_StubDetector(fail_on=4))
+    assert len(_records(output)) == 3
+
+    # Падение между записью и checkpoint, плюс недописанная строка в конце JSONL
+    names = checkpoint.read_text(encoding='utf-8').splitlines()
+    checkpoint.write_text(''.join(name + '\n' for name in names[:-1]), encoding='utf-8')
+    with open(output, 'a', encoding='utf-8') as handle:
+        handle.write('{"file": "torn')
+
+    detector = _StubDetector()
+    assert batch_cli.run_batch([str(scans)], str(output), batch_size=1, workers=1, detector=detector) == 2
+    assert detector.pages == 2
+
+    files = [record['file'] for record in _records(output)]
+    expected = sorted(str(path) for path in scans.iterdir())
+    assert sorted(files) == expected
+    assert sorted(checkpoint.read_text(encoding='utf-8').splitlines()) == expected
+
+    # Всё обработано — повторный запуск ничего не делает
+    assert batch_cli.run_batch([str(scans)], str(output), workers=1, detector=_StubDetector(fail_on=1)) == 0
+
+
+def test_records_follow_detect_dataset_schema(scans, tmp_path):
+    output = tmp_path / 'scans.jsonl'
+    batch_cli.run_batch([str(scans / 'doc1.png')], str(output), workers=1, detector=_StubDetector())
+    [record] = _records(output)
+    name = str(scans / 'doc1.png')
+    assert record['counts_total'] == {'signature': 1, 'stamp': 0, 'qr_code': 0}
+    page = record['annotations'][name]['page_1']
+    assert page['page_size'] == {'width': 30, 'height': 20}
+    assert page['annotations'][0]['annotation_1']['category'] == 'signature'
+
+
+def test_parquet_is_written_in_row_groups(scans, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    records = tmp_path / 'scans.jsonl'
+    batch_cli.run_batch([str(scans)], str(records), workers=1, detector=_StubDetector())
+    with open(records, 'a', encoding='utf-8') as handle:
+        handle.write(json.dumps({'file': 'broken.pdf', 'annotations': {'broken.pdf': {}}, 'error': 'bad'}) + '\n')
+
+    output = tmp_path / 'scans.parquet'
+    batch_cli._write_parquet(records, output, row_group=2)
+    parquet = pq.ParquetFile(output)
+    assert parquet.metadata.num_rows == 6
+    assert parquet.metadata.num_row_groups == 3
+    table = parquet.read().to_pylist()
+    assert table[-1]['error'] == 'bad' and table[-1]['page'] is None
+    assert {row['category'] for row in table[:-1]} == {'signature'}
@@ -0,0 +1,81 @@
+import sqlite3
+
+import cv2
+import numpy as np
+
+from back.crop_index import CropIndex, crop_hash
+
+
+def _signature(seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    image = np.full((80, 160, 3), 255, np.uint8)
+    points = np.stack([np.linspace(10, 150, 8), rng.integers(10, 70, 8)], axis=1).astype(np.int32)
+    cv2.polylines(image, [points], False, (0, 0, 0), 3)
+    return image
+
+
+def _cut(image, content, page=1, crop_id='annotation_1'):
+    return [({'id': crop_id, 'class': 'signature', 'bbox': [0, 0, 160, 80], 'page': page, 'content': content},
+             image)]
+
+
+def test_crop_hash_is_stable_under_padding_and_scale():
+    image = _signature(1)
+    digest, aspect = crop_hash(image)
+    padded = cv2.copyMakeBorder(image, 20, 20, 20, 20, cv2.BORDER_CONSTANT, value=(255, 255, 255))
+    scaled = cv2.resize(padded, None, fx=1.5, fy=1.5, interpolation=cv2.INTER_LINEAR)
+    other, other_aspect = crop_hash(scaled)
+    assert digest.shape == (32,)
+    assert np.unpackbits(digest ^ other).sum() <= 24
+    assert abs(aspect - other_aspect) < 0.15 * aspect
+
+
+def test_query_finds_same_crop_and_filters_class(tmp_path):
+    index = CropIndex(tmp_path / 'index.sqlite')
+    digest, aspect = crop_hash(_signature(1))
+    crop_id = index.add(digest, aspect, 'signature', result_id='r1', document='a.pdf', page=2)
+    matches = index.query(digest, aspect, 'signature')
+    assert [(match['id'], match['distance'], match['page']) for match in matches] == [(crop_id, 0, 2)]
+    assert index.query(digest, aspect, 'stamp') == []
+    assert index.query(digest, aspect, 'signature', exclude_result='r1') == []
+    assert index.query(*crop_hash(_signature(2)), 'signature', max_distance=8) == []
+
+
+def test_reupload_of_same_content_is_not_a_duplicate(tmp_path):
+    index = CropIndex(tmp_path / 'index.sqlite')
+    image = _signature(1)
+    assert index.index_document('r1', 'a.pdf', _cut(image, 'page-a')) == []
+    # Тот же файл ещё раз: с собой не совпадает и повторно не добавляется
+    assert index.index_document('r2', 'a.pdf', _cut(image, 'page-a')) == []
+    assert index.stats()['crops'] == 1
+    # Та же подпись на другой странице — дубликат
+    found = index.index_document('r3', 'b.pdf', _cut(image, 'page-b'))
+    assert [match['result_id'] for match in found[0]['matches']] == ['r1']
+    # store=False: только поиск
+    index.index_document('r4', 'c.pdf', _cut(image, 'page-c'), store=False)
+    assert index.stats()['crops'] == 2
+
+
+def test_max_crops_evicts_oldest(tmp_path):
+    index = CropIndex(tmp_path / 'index.sqlite', max_crops=2)
+    digests = [crop_hash(_signature(seed)) for seed in range(3)]
+    ids = [index.add(digest, aspect, 'signature', result_id=f'r{n}') for n, (digest, aspect) in enumerate(digests)]
+    assert index.stats()['crops'] == 2
+    assert index.query(*digests[0], 'signature', max_distance=0) == []
+    assert index.query(*digests[2], 'signature', max_distance=0)[0]['id'] == ids[2]
+    keys = sqlite3.connect(index.path).execute('SELECT COUNT(*) FROM crop_keys WHERE crop_id = ?', (ids[0],))
+    assert keys.fetchone()[0] == 0
+
+
+def test_index_without_content_column_is_migrated(tmp_path):
+    path = tmp_path / 'index.sqlite'
+    connection = sqlite3.connect(path)
+    connection.executescript(
+        'CREATE TABLE crops (id INTEGER PRIMARY KEY, hash BLOB NOT NULL, class TEXT NOT NULL, aspect REAL NOT NULL, '
+        'result_id TEXT, document TEXT, page INTEGER, bbox TEXT, model_version TEXT, created_at TEXT);'
+    )
+    connection.close()
+    index = CropIndex(path)
+    digest, aspect = crop_hash(_signature(1))
+    index.add(digest, aspect, 'signature', content='page-a')
+    assert index.indexed_contents(['page-a', 'page-b']) == {'page-a'}
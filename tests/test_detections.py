@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from back.detections import DetectionSet
+
+
+NAMES = ('signature', 'stamp', 'qr_code')
+
+
+def _set(boxes, classes, confs, source='original'):
+    return DetectionSet.from_arrays(np.asarray(boxes, dtype=np.float32).reshape(-1, 4), classes, confs,
+                                    source=source, names=NAMES)
+
+
+def _iou(a, b):
+    """IoU двух боксов — как в прежнем слиянии списков словарей."""
+    x1, y1, x2, y2 = max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
+    intersection = 0 if x2 < x1 or y2 < y1 else (x2 - x1) * (y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0
+
+
+def _merge_reference(first, second, iou_threshold=0.5):
+    """Последовательное слияние списков словарей, которое заменил DetectionSet.merge."""
+    if not second:
+        return first
+    if not first:
+        return second
+    merged = list(first)
+    for det2 in second:
+        for i, det1 in enumerate(merged):
+            if _iou(det1['bbox'], det2['bbox']) > iou_threshold and det1['class'] == det2['class']:
+                if det2['confidence'] > det1['confidence']:
+                    merged[i] = det2
+                break
+        else:
+            merged.append(det2)
+    return merged
+
+
+def test_duplicate_of_same_class_keeps_higher_confidence():
+    original = _set([[0, 0, 10, 10]], [0], [0.4])
+    inverted = _set([[1, 1, 10, 10]], [0], [0.9], source='inverted')
+    merged = original.merge(inverted)
+    assert len(merged) == 1
+    assert merged.to_dicts()[0]['source'] == 'inverted'
+    assert merged.conf.tolist() == pytest.approx([0.9])
+
+    weaker = _set([[1, 1, 10, 10]], [0], [0.2], source='inverted')
+    assert original.merge(weaker).to_dicts()[0]['source'] == 'original'
+
+
+def test_overlap_of_different_classes_is_kept():
+    merged = _set([[0, 0, 10, 10]], [0], [0.8]).merge(_set([[0, 0, 10, 10]], [1], [0.7]))
+    assert merged.cls.tolist() == [0, 1]
+
+
+def test_overlap_at_threshold_is_not_a_duplicate():
+    # IoU ровно 0.5: дубликат только при IoU > порога
+    merged = _set([[0, 0, 10, 10]], [0], [0.5]).merge(_set([[0, 0, 10, 5]], [0], [0.9]))
+    assert len(merged) == 2
+
+
+def test_merge_with_empty_returns_other_side():
+    detections = _set([[0, 0, 10, 10]], [2], [0.6])
+    empty = DetectionSet.empty(NAMES)
+    assert detections.merge(empty) is detections
+    assert empty.merge(detections) is detections
+
+
+def test_replacement_takes_part_in_later_matches():
+    # Второй бокс заменяет первый; третий сравнивается уже с заменённым и совпадает с ним
+    original = _set([[0, 0, 10, 10]], [0], [0.3])
+    other = _set([[0, 0, 14, 10], [4, 0, 14, 10]], [0, 0], [0.6, 0.5])
+    merged = original.merge(other)
+    assert merged.boxes.tolist() == [[0, 0, 14, 10]]
+    assert merged.conf.tolist() == pytest.approx([0.6])
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_sequential_merge(seed):
+    rng = np.random.default_rng(seed)
+
+    def random_set(n, source):
+        xy = rng.uniform(0, 60, (n, 2))
+        wh = rng.uniform(10, 30, (n, 2))
+        return _set(np.hstack([xy, xy + wh]).round(1), rng.integers(0, 2, n), rng.uniform(0.1, 1, n).round(3),
+                    source=source)
+
+    first, second = random_set(int(rng.integers(0, 8)), 'original'), random_set(int(rng.integers(0, 8)), 'inverted')
+    expected = _merge_reference(first.to_dicts(), second.to_dicts())
+    assert first.merge(second).to_dicts() == expected
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from back import download_model
+
+PAYLOAD = bytes(range(256)) * 4096  # 1 МБ
+CHUNK = 256 * 1024
+EXPECTED = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+def _handler(state):
+    """state: honor_range, head (разрешён ли HEAD), fail_after (сколько Range-ответов отдать), ranges (журнал)."""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            if not state['head']:
+                self.send_response(405)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(PAYLOAD)))
+            self.send_header('Accept-Ranges', 'bytes')  # обещает Range во всех режимах
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+
+        def do_GET(self):
+            match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+            body, status = PAYLOAD, 200
+            if state['honor_range'] and match:
+                start, end = int(match.group(1)), int(match.group(2))
+                if state['fail_after'] is not None and len(state['ranges']) >= state['fail_after']:
+                    body, status = b'', 500
+                else:
+                    state['ranges'].append(start // CHUNK)
+                    body, status = PAYLOAD[start:end + 1], 206
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+@pytest.fixture
+def server():
+    state = {'honor_range': True, 'head': True, 'fail_after': None, 'ranges': []}
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _handler(state))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/model.pt', state
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _fetch(url, cache_dir, workers=4):
+    return download_model.fetch(url, sha256=EXPECTED, cache_dir=cache_dir,
+                                workers=workers, chunk_size=CHUNK, timeout=10)
+
+
+@pytest.mark.parametrize('mode', ['ranges', 'ignores-range', 'no-head'])
+def test_fetch_with_and_without_range_support(server, mode, tmp_path):
+    url, state = server
+    state['honor_range'] = mode != 'ignores-range'
+    state['head'] = mode != 'no-head'
+    blob = _fetch(url, tmp_path)
+    assert blob.read_bytes() == PAYLOAD
+    assert not list((tmp_path / 'partial').iterdir())
+    if mode == 'no-head':
+        assert state['ranges'] == []
+
+
+def test_interrupted_fetch_resumes_missing_chunks(server, tmp_path):
+    url, state = server
+    state['fail_after'] = 2
+    with pytest.raises(Exception):
+        _fetch(url, tmp_path, workers=1)
+    [state_file] = (tmp_path / 'partial').glob('*.part.json')
+    done = json.loads(state_file.read_text())['done']
+    assert done == [0, 1]
+
+    state['fail_after'], state['ranges'] = None, []
+    blob = _fetch(url, tmp_path)
+    # Докачиваются только недостающие куски, итог сверен по SHA-256
+    assert sorted(state['ranges']) == [2, 3]
+    assert blob.name == EXPECTED and blob.read_bytes() == PAYLOAD
+    assert not list((tmp_path / 'partial').iterdir())
@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from back.llm import SummaryClient, map_reduce_summary, perplexity_complete, split_chunks
+from back.metrics import metrics
+
+
+def test_split_chunks_packs_pages_without_splitting_them():
+    pages = ['a' * 40, 'b' * 40, '', 'c' * 40]
+    assert split_chunks(pages, max_chars=100) == ['a' * 40 + '\n\n' + 'b' * 40, 'c' * 40]
+    assert split_chunks('  short  ', max_chars=100) == ['short']
+    assert split_chunks(['', '  '], max_chars=100) == []
+
+
+def test_split_chunks_cuts_long_page_by_sections_then_hard():
+    page = 'x' * 30 + '\n\n' + 'y' * 30 + '\n\n' + 'z' * 130
+    chunks = split_chunks([page], max_chars=70)
+    assert all(len(chunk) <= 70 for chunk in chunks)
+    assert chunks[0] == 'x' * 30 + '\n\n' + 'y' * 30
+    assert ''.join(chunks[1:]).replace('\n', '') == 'z' * 130
+
+
+def test_map_reduce_summary_summarizes_chunks_then_reduces():
+    calls = []
+
+    def complete(system, user):
+        calls.append(user)
+        return f'note{len(calls)}'
+
+    pages = ['a' * 600, 'b' * 600, 'c' * 600]
+    assert map_reduce_summary(complete, pages, max_chars=1000) == 'note4'
+    assert calls[:3] == pages
+    assert all(note in calls[3] for note in ('note1', 'note2', 'note3'))
+
+
+def test_map_reduce_summary_reuses_cached_chunk_notes():
+    cache, calls = {}, []
+
+    class Cache:
+        get = staticmethod(cache.get)
+        put = staticmethod(cache.__setitem__)
+
+    def complete(system, user):
+        calls.append(user)
+        return 'note:' + user[:1]
+
+    map_reduce_summary(complete, ['a' * 600, 'b' * 600], max_chars=1000, chunk_cache=Cache())
+    calls.clear()
+    map_reduce_summary(complete, ['a' * 600, 'c' * 600], max_chars=1000, chunk_cache=Cache())
+    # Заново в LLM — только изменившийся фрагмент и сведение
+    assert calls[0] == 'c' * 600 and len(calls) == 2
+
+
+class _StubLLM:
+    """Локальный OpenAI-совместимый chat/completions: /<name> отвечает '<name>:<последние символы запроса>'.
+
+    delays — задержка ответа по имени эндпоинта; calls — число запросов по имени.
+    """
+
+    def __init__(self):
+        self.delays = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                name = self.path.strip('/')
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with stub._lock:
+                    stub.calls[name] = stub.calls.get(name, 0) + 1
+                time.sleep(stub.delays.get(name, 0))
+                user = body['messages'][-1]['content']
+                answer = json.dumps({'choices': [{'message': {'content': f'{name}:{user[-8:]}'}}]}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(answer)))
+                self.end_headers()
+                self.wfile.write(answer)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def provider(self, name):
+        url = f'http://127.0.0.1:{self.server.server_address[1]}/{name}'
+        return name, lambda system, user: perplexity_complete('test-key', system, user, url=url, timeout=10)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = _StubLLM()
+    yield server
+    server.close()
+
+
+def test_hedge_wins_when_primary_is_slow(stub):
+    stub.delays['slow'] = 1.5
+    client = SummaryClient(providers=[stub.provider('slow'), stub.provider('fast')], hedge_delay=0.1, timeout=10)
+    started = time.monotonic()
+    assert client.summarize('Договор поставки') == 'fast:поставки'
+    assert time.monotonic() - started < 1.0
+    assert stub.calls == {'slow': 1, 'fast': 1}
+
+
+def test_identical_concurrent_requests_make_one_upstream_call(stub):
+    stub.delays['llm'] = 0.3
+    client = SummaryClient(providers=[stub.provider('llm')])
+    before = metrics.get('llm_coalesced', 0)
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        results = list(pool.map(lambda _: client.summarize('Акт выполненных работ'), range(5)))
+    assert results == ['llm:ых работ'] * 5
+    assert stub.calls == {'llm': 1}
+    assert metrics.get('llm_coalesced', 0) - before == 4
+
+
+def test_repeated_request_is_served_from_cache(stub):
+    client = SummaryClient(providers=[stub.provider('llm')])
+    before = metrics.get('llm_cache_hits', 0)
+    first = client.summarize('Счёт на оплату', counts={'signature': 1})
+    assert client.summarize('Счёт на оплату', counts={'signature': 1}) == first
+    assert stub.calls == {'llm': 1}
+    assert metrics.get('llm_cache_hits', 0) - before == 1
+    # Другие счётчики детекций — другой ответ
+    client.summarize('Счёт на оплату', counts={'signature': 2})
+    assert stub.calls == {'llm': 2}
+
+
+def test_chunk_notes_are_cached_across_documents(stub):
+    client = SummaryClient(providers=[stub.provider('llm')], chunk_chars=1000)
+    client.summarize(['a' * 600, 'b' * 600])
+    assert stub.calls == {'llm': 3}  # два фрагмента и сведение
+    client.summarize(['a' * 600, 'c' * 600])
+    assert stub.calls == {'llm': 5}  # изменившийся фрагмент и сведение
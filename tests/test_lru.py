@@ -0,0 +1,30 @@
+from back.lru import BoundedLRU
+
+
+def test_evicts_least_recently_used_by_count():
+    cache = BoundedLRU(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1  # 'a' становится свежей
+    cache.put('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+
+def test_size_limit_and_oversized_entries():
+    cache = BoundedLRU(10)
+    assert cache.put('a', 'x', size=4)
+    assert cache.put('b', 'y', size=4)
+    assert cache.put('c', 'z', size=4)  # вытесняет 'a'
+    assert 'a' not in cache and cache.total == 8
+
+    assert not cache.put('huge', 'w', size=11)
+    assert 'huge' not in cache and cache.total == 8
+
+
+def test_replacing_a_key_updates_total():
+    cache = BoundedLRU(10)
+    cache.put('a', 'x', size=6)
+    cache.put('a', 'y', size=3)
+    assert cache.total == 3 and cache.get('a') == 'y'
+    assert cache.pop('a') == 'y' and cache.total == 0
@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+from back.model_registry import ModelRegistry, UnknownModel
+
+
+class _Detector:
+    def __init__(self, version):
+        self.version = version
+
+
+def _gated_factory(gate: threading.Event, fail: bool = False):
+    def factory(version, path):
+        gate.wait(5)
+        if fail:
+            raise RuntimeError('broken weights')
+        return _Detector(version)
+    return factory
+
+
+def test_load_async_registers_and_activates():
+    registry = ModelRegistry(lambda version, path: _Detector(version))
+    registry.load_async('v1', 'v1.pt').join(5)
+    assert registry.get().version == 'v1'
+    assert registry.status()['models']['v1']['state'] == 'ready'
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_unload_while_loading_cancels_the_load(fail, monkeypatch):
+    errors = []
+    monkeypatch.setattr(threading, 'excepthook', errors.append)
+    gate = threading.Event()
+    registry = ModelRegistry(_gated_factory(gate, fail=fail))
+    thread = registry.load_async('v2', 'v2.pt')
+    registry.unload('v2')
+    gate.set()
+    thread.join(5)
+    # Ни KeyError в потоке загрузки, ни «воскрешения» выгруженной версии
+    assert errors == []
+    assert 'v2' not in registry.status()['models']
+    with pytest.raises(UnknownModel):
+        registry.get('v2')
+
+
+def test_unload_during_resolve_skips_the_load():
+    gate = threading.Event()
+    loaded = []
+    registry = ModelRegistry(lambda version, path: loaded.append(version) or _Detector(version))
+    thread = registry.load_async('v3', resolve=lambda: gate.wait(5) and 'v3.pt')
+    registry.unload('v3')
+    gate.set()
+    thread.join(5)
+    assert loaded == []
+    assert 'v3' not in registry.status()['models']
+
+
+def test_reload_after_cancel_registers_new_load():
+    gate = threading.Event()
+    registry = ModelRegistry(_gated_factory(gate))
+    first = registry.load_async('v4', 'old.pt')
+    registry.unload('v4')
+    second = registry.load_async('v4', 'new.pt')
+    gate.set()
+    first.join(5)
+    second.join(5)
+    assert registry.status()['models']['v4']['path'] == 'new.pt'
@@ -0,0 +1,116 @@
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+from back.organize_dataset import Sample, split_samples
+
+
+RATIOS = (0.7, 0.15, 0.15)
+
+
+def _samples(per_class: int, classes=(0, 1, 2)) -> list[Sample]:
+    samples = []
+    for cls in classes:
+        for n in range(per_class):
+            sample = Sample(f'{cls}/{n}.jpg', Path(f'{cls}_{n}.jpg'), None, None, None)
+            sample.classes = [cls]
+            samples.append(sample)
+    return samples
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_rounding_remainders_do_not_pile_up_in_one_split(seed):
+    samples = _samples(10)
+    split_samples(samples, RATIOS, seed)
+    overall = Counter(sample.split for sample in samples)
+    assert overall['train'] == 21
+    assert sorted([overall['val'], overall['test']]) == [4, 5]
+    for cls in range(3):
+        stratum = Counter(sample.split for sample in samples if sample.classes == [cls])
+        assert stratum['train'] == 7 and stratum['val'] + stratum['test'] == 3
+
+
+def test_tie_breaks_are_not_always_the_same_split():
+    heavier = set()
+    for seed in range(20):
+        samples = _samples(10)
+        split_samples(samples, RATIOS, seed)
+        overall = Counter(sample.split for sample in samples)
+        heavier.add(max(('val', 'test'), key=lambda split: overall[split]))
+    assert heavier == {'val', 'test'}
+
+
+def test_split_is_reproducible_and_keeps_existing_assignments():
+    first, second = _samples(10), _samples(10)
+    split_samples(first, RATIOS, seed=3)
+    split_samples(second, RATIOS, seed=3)
+    assert [sample.split for sample in first] == [sample.split for sample in second]
+
+    grown = _samples(14)
+    previous = {sample.key: sample.split for sample in first}
+    for sample in grown:
+        sample.split = previous.get(sample.key)
+    split_samples(grown, RATIOS, seed=3)
+    assert all(sample.split == previous[sample.key] for sample in grown if sample.key in previous)
+
+
+def test_parse_labels_checks_class_range_and_box_bounds():
+    from back.organize_dataset import parse_labels
+
+    text = '\n'.join([
+        '0 0.5 0.5 0.2 0.2',
+        '3 0.5 0.5 0.1 0.1',     # класс вне диапазона
+        '1.5 0.5 0.5 0.1 0.1',   # дробный класс
+        '1 0.95 0.5 0.2 0.2',    # бокс выходит за кадр
+        '2 0.5 0.5 0 0.1',       # нулевой размер
+        '2 0.5',                 # не 5 значений
+        '',
+        '2 0.1 0.1 0.2 0.2',     # ровно у края — в пределах допуска
+    ])
+    classes, errors = parse_labels(text, num_classes=3)
+    assert classes.tolist() == [0, 2]
+    assert errors == [
+        'line 6: expected 5 values, got 2',
+        'line 2: class out of range',
+        'line 3: class out of range',
+        'line 5: non-positive box size',
+        'line 4: box outside image',
+    ]
+    assert parse_labels('a b c d e', 3)[1] == ['non-numeric values']
+
+
+def _write(path: Path, data: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(data)
+
+
+def test_rerun_touches_only_changed_files_and_drops_stale_labels(tmp_path, monkeypatch):
+    from back import organize_dataset as module
+
+    source, output = tmp_path / 'src', tmp_path / 'out'
+    for n in range(6):
+        _write(source / f'img{n}.jpg', f'image {n}')
+        _write(source / f'img{n}.txt', f'{n % 3} 0.5 0.5 0.2 0.2\n')
+    first = module.organize_dataset(source, output, num_classes=3, workers=1, mode='copy')
+    split = {key: entry['split'] for key, entry in first['files'].items()}
+
+    placed, validated = [], []
+    place_file, validate = module.place_file, module._validate
+    monkeypatch.setattr(module, 'place_file',
+                        lambda src, dst, mode: placed.append(src.name) or place_file(src, dst, mode))
+    monkeypatch.setattr(module, '_validate', lambda sample, n: validated.append(sample.key) or validate(sample, n))
+
+    assert module.organize_dataset(source, output, num_classes=3, workers=1, mode='copy')['files'] == first['files']
+    assert placed == [] and validated == []
+
+    (source / 'img1.txt').unlink()
+    _write(source / 'img2.txt', '1 0.5 0.5 0.35 0.3\n')
+    second = module.organize_dataset(source, output, num_classes=3, workers=1, mode='copy')
+    assert sorted(validated) == ['img1.jpg', 'img2.jpg']
+    assert sorted(placed) == ['img1.jpg', 'img2.jpg', 'img2.txt']
+    assert {key: entry['split'] for key, entry in second['files'].items()} == split
+    # Разметка, удалённая из источника, удалена и из датасета
+    assert not (output / 'labels' / split['img1.jpg'] / 'img1.txt').exists()
+    assert (output / 'images' / split['img1.jpg'] / 'img1.jpg').exists()
+    assert (output / 'labels' / split['img2.jpg'] / 'img2.txt').read_text() == '1 0.5 0.5 0.35 0.3\n'
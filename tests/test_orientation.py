@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from back.detections import DetectionSet
+from back.orientation import Orientation
+
+
+SHAPE = (300, 200, 3)
+BOX = [20.0, 40.0, 60.0, 100.0]
+
+
+def _marked_page():
+    page = np.full(SHAPE, 255, np.uint8)
+    x1, y1, x2, y2 = (int(v) for v in BOX)
+    page[y1:y2, x1:x2] = 0
+    return page
+
+
+def _ink_box(image):
+    ys, xs = np.nonzero(image[..., 0] < 128)
+    return [xs.min(), ys.min(), xs.max() + 1, ys.max() + 1]
+
+
+@pytest.mark.parametrize('rotation', [0, 90, 180, 270])
+def test_quarter_turn_matrix_matches_apply_and_maps_back(rotation):
+    orientation = Orientation(rotation)
+    fixed = orientation.apply(_marked_page())
+    matrix, size = orientation.matrix(SHAPE)
+    assert size == (fixed.shape[1], fixed.shape[0])
+
+    detections = DetectionSet.from_arrays([_ink_box(fixed)], [0], [0.9])
+    original = orientation.to_original(detections, SHAPE)
+    assert original.boxes[0].tolist() == pytest.approx(BOX, abs=1.0)
+
+
+@pytest.mark.parametrize('rotation, skew', [(0, 3.0), (90, -2.5), (180, 4.0)])
+def test_deskewed_box_maps_back_around_original(rotation, skew):
+    orientation = Orientation(rotation, skew)
+    fixed = orientation.apply(_marked_page())
+    assert orientation.matrix(SHAPE)[1] == (fixed.shape[1], fixed.shape[0])
+
+    detections = DetectionSet.from_arrays([_ink_box(fixed)], [0], [0.9])
+    box = orientation.to_original(detections, SHAPE).boxes[0].tolist()
+    # Описанный бокс повёрнутого прямоугольника шире исходного, но содержит его
+    assert box[0] <= BOX[0] + 1 and box[1] <= BOX[1] + 1
+    assert box[2] >= BOX[2] - 1 and box[3] >= BOX[3] - 1
+    assert box[2] - box[0] < (BOX[2] - BOX[0]) * 1.5
+
+
+def test_identity_returns_same_detections():
+    detections = DetectionSet.from_arrays([BOX], [0], [0.9])
+    orientation = Orientation(0, 0.1)
+    assert orientation.identity
+    assert orientation.to_original(detections, SHAPE) is detections
+
+
+def test_orienter_cache_is_keyed_by_exact_content(monkeypatch):
+    from back import orientation as module
+    from back.page_cache import page_hash
+
+    calls = []
+    monkeypatch.setattr(module, 'estimate_orientation', lambda image, *args: calls.append(1) or Orientation(90))
+    orienter = module.PageOrienter(cache_size=8)
+    page = np.random.default_rng(0).integers(0, 255, SHAPE, dtype=np.uint8)
+    touched = page.copy()
+    touched[150, 100] += 1
+    # dHash у страниц одинаковый, содержимое — нет
+    assert (page_hash(page) == page_hash(touched)).all()
+
+    orienter.orient(page)
+    orienter.orient(page.copy())
+    orienter.orient(touched)
+    assert len(calls) == 2
@@ -0,0 +1,77 @@
+import cv2
+import numpy as np
+import pytest
+
+from back.detections import DetectionSet
+from back.page_cache import PageCache
+
+
+@pytest.fixture(scope='module')
+def page():
+    image = np.full((1400, 1000, 3), 255, np.uint8)
+    for i in range(30):
+        cv2.putText(image, f'Lorem ipsum dolor sit amet consectetur {i}', (60, 80 + i * 40), 0, 0.9, (0, 0, 0), 2)
+    return image
+
+
+@pytest.fixture(scope='module')
+def stamped(page):
+    image = page.copy()
+    cv2.circle(image, (700, 1200), 70, (200, 60, 0), 4)
+    return image
+
+
+def _detections(n):
+    return DetectionSet(np.tile([[10, 10, 50, 50]], (n, 1)), [1] * n, [0.9] * n, names=('signature', 'stamp'))
+
+
+def test_exact_repeat_is_a_hit(page):
+    cache = PageCache()
+    found, token = cache.lookup(page)
+    assert found is None
+    cache.store(token, _detections(2))
+
+    found, _ = cache.lookup(page.copy())
+    assert found is not None and len(found) == 2
+
+
+def test_stamped_page_is_not_a_repeat_by_default(page, stamped):
+    cache = PageCache()
+    _, token = cache.lookup(page)
+    cache.store(token, _detections(0))
+
+    found, _ = cache.lookup(stamped)
+    assert found is None
+
+
+def test_fuzzy_mode_reuses_recompressed_page_but_not_stamped(page, stamped):
+    cache = PageCache(similarity=0.9)
+    _, token = cache.lookup(page)
+    cache.store(token, _detections(1))
+
+    _, encoded = cv2.imencode('.jpg', page, [cv2.IMWRITE_JPEG_QUALITY, 70])
+    found, _ = cache.lookup(cv2.imdecode(encoded, cv2.IMREAD_COLOR))
+    assert found is not None and len(found) == 1
+
+    found, _ = cache.lookup(stamped)
+    assert found is None
+
+
+def test_variant_is_part_of_the_key(page):
+    cache = PageCache()
+    _, token = cache.lookup(page, variant=('v1', 0.25))
+    cache.store(token, _detections(1))
+
+    assert cache.lookup(page, variant=('v2', 0.25))[0] is None
+    assert cache.lookup(page, variant=('v1', 0.25))[0] is not None
+
+
+def test_hit_is_rescaled_to_page_size(page):
+    cache = PageCache(similarity=0.9)
+    _, token = cache.lookup(page)
+    cache.store(token, _detections(1))
+
+    half = cv2.resize(page, (500, 700), interpolation=cv2.INTER_AREA)
+    found, _ = cache.lookup(half)
+    assert found is not None
+    np.testing.assert_allclose(found.boxes[0], [5, 5, 25, 25])
@@ -0,0 +1,64 @@
+import gc
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+from back.page_cache import page_digest
+from back.pipeline import DocumentPages
+from back.result_store import ResultStore
+from back.utils import ImageFrames, load_pages_from_upload
+
+
+def _tiff(frames):
+    buffer = io.BytesIO()
+    images = [Image.fromarray(frame[:, :, ::-1]) for frame in frames]
+    images[0].save(buffer, format='TIFF', save_all=True, append_images=images[1:])
+    return buffer.getvalue()
+
+
+def _frames(count=3):
+    return [np.random.default_rng(n).integers(0, 255, (40, 30, 3), np.uint8) for n in range(count)]
+
+
+def test_tiff_pages_keep_metadata_and_decode_frames_on_demand():
+    frames = _frames()
+    stream, pdf_source = load_pages_from_upload(io.BytesIO(_tiff(frames)), 'scan.tif', keep_frames=True)
+    assert pdf_source is None and isinstance(stream, ImageFrames)
+
+    pages = DocumentPages(stream)
+    for number, image in stream:
+        pages.add(number, image)
+    assert [(page.number, page.width, page.height) for page in pages] == [(1, 30, 40), (2, 30, 40), (3, 30, 40)]
+    assert [page.digest for page in pages] == [page_digest(frame) for frame in frames]
+    assert pages._images == {}
+    assert np.array_equal(pages.image(2), frames[1])
+    assert [number for number, _ in pages.images()] == [1, 2, 3]
+    assert pages.find(3) == 2 and pages.find(4) is None
+
+    # Загрузка живёт, пока на страницы есть ссылки (в т.ч. из ResultStore)
+    store = ResultStore()
+    store.put('r1', pages, [None] * 3)
+    path = stream._upload.path
+    del pages, stream
+    gc.collect()
+    assert os.path.exists(path)
+    store._entries.pop('r1')
+    gc.collect()
+    assert not os.path.exists(path)
+
+
+def test_page_selection_and_in_memory_pages():
+    frames = _frames()
+    stream, _ = load_pages_from_upload(io.BytesIO(_tiff(frames)), 'scan.tif', [(2, 3)], keep_frames=True)
+    pages = DocumentPages(stream)
+    for number, image in stream:
+        pages.add(number, image)
+    assert [page.number for page in pages] == [2, 3]
+    assert np.array_equal(pages.image(3), frames[2])
+
+    # PDF-страницы и одиночные изображения держатся в памяти; размер для ResultStore — по пикселям
+    single = DocumentPages()
+    single.add(1, frames[0])
+    assert single.image(1) is frames[0] and single.nbytes == frames[0].nbytes
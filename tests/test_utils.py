@@ -0,0 +1,59 @@
+from itertools import islice
+
+import numpy as np
+import pytest
+
+from back.detections import DetectionSet
+from back.utils import cut_page_crops, iter_page_crops, parse_page_ranges, resolve_page_selection
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, None),
+    ('', None),
+    ('3', [(3, 3)]),
+    ('1-3, 5,-1', [(1, 3), (5, 5), (-1, -1)]),
+    ('2--1', [(2, -1)]),
+    (',,4,', [(4, 4)]),
+])
+def test_parse_page_ranges(value, expected):
+    assert parse_page_ranges(value) == expected
+
+
+@pytest.mark.parametrize('value', ['0', '1-0', 'a', '1-2-3', '1..3'])
+def test_parse_page_ranges_rejects_invalid(value):
+    with pytest.raises(ValueError):
+        parse_page_ranges(value)
+
+
+def test_resolve_page_selection():
+    assert resolve_page_selection(None, 3) == [0, 1, 2]
+    # Отрицательные — с конца; повторы схлопываются, выход за документ обрезается
+    assert resolve_page_selection(parse_page_ranges('-2--1,1,1-2,9-12'), 5) == [0, 1, 3, 4]
+    assert resolve_page_selection(parse_page_ranges('7'), 5) == []
+
+
+class _CountingPdf:
+    """render_region без PDF: считает перерисовки."""
+
+    def __init__(self):
+        self.rendered = 0
+
+    def render_region(self, page_index, bbox, page_shape, dpi=None):
+        self.rendered += 1
+        return None
+
+
+def test_iter_page_crops_cuts_lazily_with_document_numbering():
+    names = ('signature', 'stamp', 'qr_code')
+    pages = [(n, np.zeros((50, 50, 3), np.uint8)) for n in (1, 2)]
+    detections = [DetectionSet.from_arrays([[0, 0, 10, 10], [20, 20, 30, 30]], [0, 1], [0.9, 0.8], names=names)
+                  for _ in pages]
+    pdf = _CountingPdf()
+    crops = iter_page_crops(pages, detections, pdf)
+    first = list(islice(crops, 3))
+    assert pdf.rendered == 3
+    rest = list(crops)
+    assert pdf.rendered == 4
+    expected = cut_page_crops(pages, detections)
+    assert [data['id'] for data, _ in first + rest] == [data['id'] for data, _ in expected] == [
+        'annotation_1', 'annotation_2', 'annotation_3', 'annotation_4']